@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from collections import OrderedDict
+from logging import getLogger
+
+
+log = getLogger(__name__)
+
+
+class BatchSizeController:
+    """ Controller for the number of documents sent in each bulk request.
+
+    With no target latency, the batch size is fixed. Otherwise, the
+    size is tuned after each request using additive increase and
+    multiplicative decrease (AIMD): while requests complete within the
+    target latency, the size grows by a fixed step, but when a request
+    is slower than the target, the size shrinks in proportion (by at
+    most half), and when any documents are rejected by an overloaded
+    server, it is halved. Batches are also limited to an approximate
+    number of bytes, using the average document size observed so far.
+    """
+
+    def __init__(self, batch_size, target_latency=None, min_size=10, max_size=10000,
+                 max_bytes=10 * 1024 * 1024):
+        if batch_size < 1:
+            raise ValueError("Batch size must be at least 1")
+        self.size = batch_size
+        self.target_latency = target_latency
+        self.min_size = min(min_size, batch_size)
+        self.max_size = max(max_size, batch_size)
+        self.max_bytes = max_bytes
+        self.step = max(1, batch_size // 10)
+        self.batches = 0
+        self.documents = 0
+        self.bytes = 0
+
+    @property
+    def adaptive(self):
+        return self.target_latency is not None
+
+    def observe(self, count, result):
+        """ Record the outcome of a bulk request for `count` documents,
+        adjusting the batch size if adaptive. Return a dictionary of
+        metrics describing the request and the decision made.
+        """
+        self.batches += 1
+        self.documents += count
+        self.bytes += result.size
+        size = self.size
+        reason = None
+        if not self.adaptive:
+            pass
+        elif result.rejected:
+            size, reason = size // 2, "rejected"
+        elif result.latency > self.target_latency:
+            size, reason = int(size * max(0.5, self.target_latency / result.latency)), "slow"
+        elif count < self.size:
+            reason = "partial"  # too few documents to judge by
+        else:
+            size, reason = size + self.step, "fast"
+        if self.adaptive and self.bytes:
+            byte_limit = self.max_bytes * self.documents // self.bytes
+            if size > byte_limit:
+                size, reason = byte_limit, "bytes"
+            size = max(self.min_size, min(self.max_size, size))
+        if not self.adaptive:
+            decision = "fixed"
+        elif size > self.size:
+            decision = "increase"
+        elif size < self.size:
+            decision = "decrease"
+        else:
+            decision = "hold"
+        if decision in ("increase", "decrease"):
+            log.debug("Batch size %s from %d to %d (%s)" % (decision, self.size, size, reason))
+        metrics = OrderedDict([
+            ("batch", self.batches),
+            ("documents", count),
+            ("failed", len(result.errors)),
+            ("rejected", result.rejected),
+            ("bytes", result.size),
+            ("took", result.took),
+            ("latency", round(result.latency, 4)),
+            ("decision", decision),
+            ("reason", reason),
+            ("batch_size", size),
+        ])
+        self.size = size
+        return metrics
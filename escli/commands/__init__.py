@@ -48,8 +48,15 @@ class CLI:
     def process(self):
         """ Process the parsed arguments.
         """
+        return self.execute(self.args)
+
+    @classmethod
+    def execute(cls, args):
+        """ Execute the command selected by a set of parsed arguments,
+        logging any error raised, and return an exit status.
+        """
         try:
-            return self.args.f(self.args) or 0
+            return args.f(args) or 0
         except ClientAuthError as ex:
             log.error(str(ex))
             log.warning("Check that the ESCLI_API_KEY or ESCLI_USER/ESCLI_PASSWORD "
@@ -68,6 +75,9 @@ class CLI:
         """ Build and return an ArgumentParser for the given SPI.
         """
         # TODO: avoid local imports
+        from escli.commands.aggregate import AggregateCommand
+        from escli.commands.batch import BatchCommand
+        from escli.commands.copy import CopyCommand
         from escli.commands.formats import FormatsCommand
         from escli.commands.indexes import IndexCreateCommand, IndexDeleteCommand, IndexListCommand
         from escli.commands.info import InfoCommand
@@ -82,9 +92,12 @@ class CLI:
             IndexDeleteCommand(spi),
             IndexListCommand(spi),
             SearchCommand(spi),
+            AggregateCommand(spi),
             IngestCommand(spi),
+            CopyCommand(spi),
             InfoCommand(spi),
             JsonifyCommand(spi),
+            BatchCommand(spi),
         ]
         parser = ArgumentParser(description=cls.build_description(commands),
                                 formatter_class=RawDescriptionHelpFormatter)
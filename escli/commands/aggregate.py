@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from escli.commands import Command
+from escli.io import print_data
+
+
+METRIC_FUNCTIONS = ("avg", "cardinality", "max", "min", "stats", "sum", "value_count")
+
+
+class AggregateCommand(Command):
+    """ Perform an aggregation against a given target.
+    """
+
+    def get_name(self):
+        return "agg"
+
+    def get_description(self):
+        return self.__doc__.strip()
+
+    def register(self, subparsers):
+        parser = subparsers.add_parser(self.get_name(), description=self.get_description())
+        parser.add_argument("target", metavar="TARGET",
+                            help="Aggregation target. For Elasticsearch, this will be an index name.")
+        parser.add_argument("query", metavar="QUERY", nargs="?", default=None,
+                            help="Query to select documents for aggregation. For Elasticsearch, "
+                                 "this should be a query expression such as 'FIELD=VALUE'.")
+        parser.add_argument("-g", "--group-by", metavar="FIELD[:INTERVAL]", action="append", default=[],
+                            help="Field by which to group documents. Documents are grouped by distinct "
+                                 "value unless an interval (such as '1h', 'day' or 'month') is given, "
+                                 "in which case they are grouped by date histogram. This option can be "
+                                 "passed multiple times.")
+        parser.add_argument("-m", "--metric", metavar="FUNCTION:FIELD", action="append", default=[],
+                            help="Metric to calculate for each group, where FUNCTION is one of %s. "
+                                 "This option can be passed multiple times." % ", ".join(METRIC_FUNCTIONS))
+        parser.add_argument("-f", "--format", default="simple",
+                            help="Output table format")
+        parser.add_argument("-n", "--page-size", type=int, default=1000,
+                            help="Number of groups to retrieve per request.")
+        parser.set_defaults(f=self.aggregate)
+        return parser
+
+    def aggregate(self, args):
+        """ Execute the aggregation and display the results, streaming
+        groups to the output as each page is retrieved.
+        """
+        group_by = []
+        for spec in args.group_by:
+            field, _, interval = spec.partition(":")
+            group_by.append((field, interval or None))
+        metrics = []
+        for spec in args.metric:
+            function, _, field = spec.partition(":")
+            if function not in METRIC_FUNCTIONS or not field:
+                raise ValueError("Invalid metric %r" % spec)
+            metrics.append((function, field))
+        rows = self.spi.client.aggregate(args.target, args.query, group_by=group_by, metrics=metrics,
+                                         page_size=args.page_size)
+        print_data(rows, args.format)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from concurrent.futures import ThreadPoolExecutor
+from fileinput import FileInput
+from io import StringIO
+from json import loads
+from logging import getLogger
+from shlex import split as shlex_split
+from threading import local
+import sys
+
+from escli.commands import CLI, Command
+from escli.commands.search import SearchCommand
+
+
+log = getLogger(__name__)
+
+
+class BatchCommand(Command):
+    """ Execute a batch of commands over a single session.
+    """
+
+    def get_name(self):
+        return "batch"
+
+    def get_description(self):
+        return self.__doc__.strip()
+
+    def register(self, subparsers):
+        parser = subparsers.add_parser(self.get_name(), description=self.get_description())
+        parser.add_argument("file", metavar="FILE", nargs="?", default="-",
+                            help="File from which to read commands, one per line. Each line can hold "
+                                 "either the arguments to escli, as they would be passed on the "
+                                 "command line, or a JSON array of those arguments. The filename '-' "
+                                 "can be used to read from standard input (default).")
+        parser.add_argument("-j", "--jobs", type=int, default=1,
+                            help="Number of commands to execute concurrently. Output is always "
+                                 "written in the order that commands appear in the batch (default=1)")
+        parser.add_argument("-g", "--group-size", type=int, default=100,
+                            help="Maximum number of consecutive searches to combine into a single "
+                                 "multi-search request. A value of 1 disables grouping (default=100)")
+        parser.set_defaults(f=self.run)
+        return parser
+
+    def run(self, args):
+        """ Execute all commands in the batch, returning a non-zero status
+        if any fail.
+        """
+        parser = CLI.default_parser(self.spi)
+        units = list(group_searches(parse_commands(parser, args.file), args.group_size))
+        if args.jobs == 1:
+            statuses = [self.execute(unit) for unit in units]
+        else:
+            statuses = []
+            capture = OutputCapture(sys.stdout)
+            sys.stdout = capture
+            try:
+                with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+                    for status, output in executor.map(lambda unit: capture.call(self.execute, unit), units):
+                        capture.stream.write(output)
+                        statuses.append(status)
+            finally:
+                sys.stdout = capture.stream
+        return 1 if any(statuses) else 0
+
+    def execute(self, unit):
+        """ Execute a unit of work, which is either a single command or a
+        group of consecutive searches, returning an exit status.
+        """
+        if len(unit) == 1:
+            line_no, parsed = unit[0]
+            if parsed is None:
+                return 2
+            log.debug("Executing command from line %d" % line_no)
+            return CLI.execute(parsed)
+        command = unit[0][1].f.__self__
+        log.debug("Executing %d searches from lines %d-%d" % (len(unit), unit[0][0], unit[-1][0]))
+        try:
+            results = self.spi.client.multi_search([command.search_arguments(parsed) for _, parsed in unit])
+        except Exception as ex:
+            log.error(str(ex))
+            return 1
+        status = 0
+        for (line_no, parsed), result in zip(unit, results):
+            if isinstance(result, Exception):
+                log.error("Search at line %d failed: %s" % (line_no, result))
+                status = 1
+            else:
+                command.print_hits(parsed, result)
+        return status
+
+
+def parse_commands(parser, filename):
+    """ Read and parse commands from a file, yielding a (line_no, args)
+    tuple for each. If a command cannot be parsed, an error is logged
+    and None is yielded in place of its arguments.
+    """
+    with FileInput([filename]) as file_input:
+        for line in file_input:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            line_no = file_input.filelineno()
+            try:
+                argv = loads(line) if line.startswith("[") else shlex_split(line)
+                yield line_no, parser.parse_args([str(arg) for arg in argv])
+            except ValueError as ex:
+                log.error("Invalid command at line %d (%s)" % (line_no, ex))
+                yield line_no, None
+            except SystemExit:
+                # The argument parser will already have reported the error
+                log.error("Invalid command at line %d" % line_no)
+                yield line_no, None
+
+
+def group_searches(commands, group_size):
+    """ Group parsed commands into units of work, each holding either a
+    single command or a run of consecutive searches of up to
+    `group_size` in length.
+    """
+    group = []
+    for line_no, parsed in commands:
+        if is_search(parsed) and group_size > 1:
+            group.append((line_no, parsed))
+            if len(group) == group_size:
+                yield group
+                group = []
+        else:
+            if group:
+                yield group
+                group = []
+            yield [(line_no, parsed)]
+    if group:
+        yield group
+
+
+def is_search(parsed):
+    """ Return true if a parsed command is a single page search, which
+    can be carried out as part of a multi-search request.
+    """
+    return (parsed is not None and isinstance(getattr(parsed.f, "__self__", None), SearchCommand)
+            and not SearchCommand.is_paged(parsed))
+
+
+class OutputCapture:
+    """ Stand-in for standard output, which diverts anything written by
+    a thread into a separate buffer for that thread. Output written by
+    other threads is passed through to the underlying stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = local()
+
+    def call(self, f, *args):
+        """ Call a function, capturing its output. Return a tuple of the
+        function's return value and the output captured.
+        """
+        self._local.buffer = buffer = StringIO()
+        try:
+            return f(*args), buffer.getvalue()
+        finally:
+            self._local.buffer = None
+
+    def write(self, s):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            return self.stream.write(s)
+        return buffer.write(s)
+
+    def flush(self):
+        if getattr(self._local, "buffer", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from importlib import import_module
+from itertools import islice
+from logging import getLogger
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+
+from escli.commands import Command
+
+
+log = getLogger(__name__)
+
+
+class CopyCommand(Command):
+    """ Copy documents from one index to another.
+    """
+
+    def get_name(self):
+        return "copy"
+
+    def get_description(self):
+        return self.__doc__.strip()
+
+    def register(self, subparsers):
+        parser = subparsers.add_parser(self.get_name(), description=self.get_description())
+        parser.add_argument("source", metavar="SRC",
+                            help="Name of the index from which to copy documents.")
+        parser.add_argument("target", metavar="DST",
+                            help="Name of the index into which to copy documents.")
+        parser.add_argument("query", metavar="QUERY", nargs="?", default=None,
+                            help="Query to select the documents to copy.")
+        parser.add_argument("--source-env", metavar="PREFIX",
+                            help="Prefix of the environment variables used to connect to the source "
+                                 "cluster, e.g. 'ESCLI_SRC' for ESCLI_SRC_ADDR, ESCLI_SRC_API_KEY, etc. "
+                                 "By default, the usual ESCLI_* variables are used.")
+        parser.add_argument("--target-env", metavar="PREFIX",
+                            help="Prefix of the environment variables used to connect to the target "
+                                 "cluster. By default, the usual ESCLI_* variables are used.")
+        parser.add_argument("-s", "--slices", type=int, default=4,
+                            help="Number of slices to read concurrently from the source (default=4).")
+        parser.add_argument("-w", "--writers", type=int, default=2,
+                            help="Number of concurrent bulk writers to the target (default=2).")
+        parser.add_argument("-b", "--batch-size", type=int, default=1000,
+                            help="Number of documents per read and write request (default=1000).")
+        parser.add_argument("--queue-size", type=int, default=8,
+                            help="Maximum number of batches held between the readers and writers "
+                                 "(default=8).")
+        parser.add_argument("-t", "--transform", metavar="MODULE:FUNCTION",
+                            help="Function through which to pass each document before it is written. "
+                                 "The function should return the transformed document, or None to "
+                                 "skip the document.")
+        parser.set_defaults(f=self.copy)
+        return parser
+
+    def copy(self, args):
+        """ Copy documents from the source index to the target index.
+        """
+        source_client = self.spi.create_client(args.source_env) if args.source_env else self.spi.client
+        target_client = self.spi.create_client(args.target_env) if args.target_env else self.spi.client
+        transform = load_transform(args.transform) if args.transform else None
+        pipeline = CopyPipeline(source_client, target_client, transform=transform,
+                                slices=args.slices, writers=args.writers,
+                                batch_size=args.batch_size, queue_size=args.queue_size)
+        pipeline.run(args.source, args.target, args.query)
+        log.info("Copied %d documents from %r to %r (%d failed)" % (
+            pipeline.copied, args.source, args.target, pipeline.failed))
+        return 1 if pipeline.failed else 0
+
+
+class CopyPipeline:
+    """ Pipeline for streaming documents between indexes, possibly on
+    different clusters.
+
+    Documents are read by one thread per slice of a point in time on the
+    source index, and are passed in batches through a bounded queue to a
+    pool of writer threads, which ingest each batch into the target index
+    using a bulk request. The bounded queue ensures that readers cannot
+    run ahead of the writers by more than a fixed number of batches.
+    """
+
+    def __init__(self, source_client, target_client, transform=None,
+                 slices=4, writers=2, batch_size=1000, queue_size=8):
+        self.source_client = source_client
+        self.target_client = target_client
+        self.transform = transform
+        self.slices = max(slices, 1)
+        self.writers = max(writers, 1)
+        self.batch_size = batch_size
+        self.queue = Queue(maxsize=queue_size)
+        self.copied = 0
+        self.failed = 0
+        self._lock = Lock()
+        self._stopped = Event()
+        self._errors = []
+
+    def run(self, source, target, query=None):
+        pit_id = self.source_client.open_point_in_time(source)
+        try:
+            readers = [Thread(target=self._guard, args=(self.read, pit_id, query, i), daemon=True)
+                       for i in range(self.slices)]
+            writers = [Thread(target=self._guard, args=(self.write, target), daemon=True)
+                       for _ in range(self.writers)]
+            for thread in readers + writers:
+                thread.start()
+            for thread in readers:
+                thread.join()
+            for _ in writers:
+                self._put(None)
+            for thread in writers:
+                thread.join()
+        finally:
+            self.source_client.close_point_in_time(pit_id)
+        if self._errors:
+            raise self._errors[0]
+
+    def _guard(self, f, *args):
+        try:
+            f(*args)
+        except Exception as ex:
+            self._errors.append(ex)
+            self._stopped.set()
+
+    def _put(self, batch):
+        # Block until there is space in the queue, unless the pipeline
+        # is stopped by an error in another thread.
+        while not self._stopped.is_set():
+            try:
+                self.queue.put(batch, timeout=0.1)
+            except Full:
+                continue
+            else:
+                return
+
+    def _get(self):
+        while not self._stopped.is_set():
+            try:
+                return self.queue.get(timeout=0.1)
+            except Empty:
+                continue
+        return None
+
+    def read(self, pit_id, query, slice_id):
+        if self.slices > 1:
+            hits = self.source_client.scan(pit_id, query, page_size=self.batch_size,
+                                           slice_id=slice_id, slice_count=self.slices)
+        else:
+            hits = self.source_client.scan(pit_id, query, page_size=self.batch_size)
+        while not self._stopped.is_set():
+            batch = list(islice(hits, self.batch_size))
+            if not batch:
+                break
+            if self.transform:
+                batch = [(doc_id, document) for doc_id, document in
+                         ((doc_id, self.transform(document)) for doc_id, document in batch)
+                         if document is not None]
+            if batch:
+                self._put(batch)
+
+    def write(self, target):
+        while True:
+            batch = self._get()
+            if batch is None:
+                break
+            ids = [doc_id for doc_id, _ in batch]
+            documents = [document for _, document in batch]
+            errors = self.target_client.bulk(target, documents, ids=ids).errors
+            for position, reason in errors:
+                log.error("Failed to copy document %r (%s)" % (ids[position], reason))
+            with self._lock:
+                self.copied += len(batch) - len(errors)
+                self.failed += len(errors)
+
+
+def load_transform(spec):
+    """ Load a transform function, given in the form 'MODULE:FUNCTION'.
+    """
+    module_name, _, function_name = spec.partition(":")
+    if not function_name:
+        raise ValueError("Transform must be given in the form MODULE:FUNCTION")
+    return getattr(import_module(module_name), function_name)
@@ -16,14 +16,40 @@
 # limitations under the License.
 
 
-from logging import getLogger
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from itertools import chain, islice
+from json import dumps
+from logging import basicConfig, getLogger, WARNING
+from os import cpu_count, getpid, path
+import sys
 
+from escli.batching import BatchSizeController
 from escli.commands import Command
-from escli.io import iter_json, iter_ndjson, csv_formats, iter_csv
+from escli.io import (iter_json, iter_ndjson, iter_ndjson_range, csv_formats, iter_csv, expand_files,
+                      input_extensions, ndjson_shard, sample_ndjson, LineIndexedFile)
+from escli.mapping import infer_mapping
+from escli.services import Client, SPI
+from escli.transform import Transform
+from escli.validation import Validator
 
 log = getLogger(__name__)
 
 
+# Minimum size in bytes of each shard into which a file is split when
+# loading in parallel. Each worker loading a shard must first index the
+# lines of the whole file, which smaller shards would not repay.
+MIN_SHARD_BYTES = 1 << 20
+
+# Index settings applied for the duration of a bulk load into a newly
+# created index. Refreshes and replication are both suspended, and are
+# reinstated once all documents have been loaded.
+BULK_LOAD_SETTINGS = {
+    "index.refresh_interval": "-1",
+    "index.number_of_replicas": "0",
+}
+
+
 class IngestCommand(Command):
     """ Load data into an Elasticsearch index.
     """
@@ -41,33 +67,506 @@ class IngestCommand(Command):
                                  "for Enterprise Search, this will be an engine name.")
         parser.add_argument("files", metavar="FILE", nargs="*",
                             help="Files from which to load data. Data must be in JSON format, "
-                                 "and the filename '-' can be used to read from standard input.")
+                                 "and the filename '-' can be used to read from standard input. "
+                                 "Directories and glob patterns are expanded to the files they "
+                                 "contain.")
         parser.add_argument("-f", "--format", default="json",
                             help="Input data format (default=json)")
+        parser.add_argument("-c", "--create", action="store_true",
+                            help="Create the target index before loading, using a mapping inferred "
+                                 "from a sample of the input data. Index settings are tuned for "
+                                 "bulk loading until all data has been loaded.")
+        parser.add_argument("--sample-size", type=int, default=1000,
+                            help="Number of documents to sample when inferring a mapping "
+                                 "(default=1000)")
+        parser.add_argument("-b", "--batch-size", type=int, default=500,
+                            help="Number of documents to send per bulk request, or the initial "
+                                 "number if a target latency is given (default=500)")
+        parser.add_argument("--target-latency", type=float, default=None, metavar="SECONDS",
+                            help="Tune the batch size automatically while loading, aiming for bulk "
+                                 "requests that complete in this number of seconds. Each worker "
+                                 "tunes its own batch size.")
+        parser.add_argument("--max-batch-bytes", type=int, default=10 * 1024 * 1024, metavar="BYTES",
+                            help="Approximate limit on the size of each bulk request when tuning "
+                                 "the batch size automatically (default=10485760)")
+        parser.add_argument("--metrics", metavar="FILE", default=None,
+                            help="Write metrics for each bulk request, including any change in "
+                                 "batch size, to a file as NDJSON. The filename '-' can be used to "
+                                 "write to standard output.")
+        parser.add_argument("-j", "--jobs", type=int, default=1,
+                            help="Number of worker processes with which to load files in parallel. "
+                                 "Each file is read, parsed and loaded by a single worker. A value "
+                                 "of 0 will use one worker per CPU. If there are fewer files than "
+                                 "workers, large NDJSON files are split into shards, which are "
+                                 "loaded by separate workers (default=1)")
+        parser.add_argument("--start-line", type=int, default=1,
+                            help="Line at which to begin loading, for resuming an interrupted load. "
+                                 "Requires a single NDJSON input file (default=1)")
+        parser.add_argument("--save-index", action="store_true",
+                            help="Save the line index built for an NDJSON input file, when sampling "
+                                 "it for --create or resuming with --start-line, as a hidden file "
+                                 "alongside that file, so that it can be reused by later loads")
+        parser.add_argument("-i", "--include", default=None,
+                            help="Fields to include in each document (comma-separated list).")
+        parser.add_argument("-x", "--exclude", default=None,
+                            help="Fields to exclude from each document (comma-separated list).")
+        parser.add_argument("--rename", metavar="OLD:NEW", action="append", default=[],
+                            help="Rename a field. This option can be given more than once.")
+        parser.add_argument("--cast", metavar="FIELD:TYPE", action="append", default=[],
+                            help="Cast the values of a field to another type, which can be one of "
+                                 "int, float, bool, str or auto. This option can be given more "
+                                 "than once.")
+        parser.add_argument("--set", metavar="FIELD=VALUE", action="append", default=[],
+                            help="Set a field to a constant value in every document. This option "
+                                 "can be given more than once.")
+        parser.add_argument("--timestamp", metavar="FIELD[:FORMAT]", action="append", default=[],
+                            help="Parse the values of a field as timestamps, converting them to ISO "
+                                 "8601 format. The input format can be iso (the default), "
+                                 "epoch_second, epoch_millis or a strptime format string. This "
+                                 "option can be given more than once.")
+        parser.add_argument("--validate", action="store_true",
+                            help="Check the input documents without loading them, reporting the file "
+                                 "and line of each document that does not match the mapping of the "
+                                 "target index, or the mapping that would be inferred if --create is "
+                                 "also given. Files are checked in parallel if multiple jobs are "
+                                 "requested. No documents are sent to the server.")
+        parser.add_argument("--schema", metavar="FILE", default=None,
+                            help="Validate documents against an index mapping or JSON Schema held in a "
+                                 "file, instead of the mapping of the target index. Requires --validate.")
         parser.set_defaults(f=self.load)
         return parser
 
     def load(self, args):
-        if args.format == "json":
-            self.load_json(args.target, args.files)
-        elif args.format == "ndjson":
-            self.load_ndjson(args.target, args.files)
-        elif args.format in csv_formats:
-            self.load_csv(args.target, args.files, dialect=csv_formats[args.format])
+        files = expand_files(args.files, input_extensions.get(args.format))
+        indexed = args.format == "ndjson" and bool(files) and "-" not in files
+        transform = Transform.parse(include=args.include, exclude=args.exclude, rename=args.rename,
+                                    cast=args.cast, constants=args.set, timestamps=args.timestamp)
+        transform_function = transform.compile() if transform else None
+        if args.schema and not args.validate:
+            raise ValueError("A schema can only be given for validation")
+        # When validating, documents that cannot be read are reported
+        # and counted as invalid. In parallel, the workers do this, so
+        # any errors in documents read here, to infer a mapping, are
+        # collected and left out.
+        if not args.validate:
+            errors = None
+        elif args.jobs == 1 or args.start_line != 1:
+            errors = ErrorCounter(log_invalid)
+        else:
+            errors = []
+        if args.start_line != 1:
+            if not indexed or len(files) != 1:
+                raise ValueError("A start line can only be given for a single NDJSON input file")
+            documents = read_from_line(files[0], args.start_line, args.save_index, errors)
+        else:
+            documents = read_documents(files, args.format, errors, skip_empty=args.create)
+        documents = transform_documents(documents, transform_function, errors)
+        if args.validate:
+            return self.validate(args, files, documents, transform, errors)
+        controller = BatchSizeController(args.batch_size, args.target_latency, max_bytes=args.max_batch_bytes)
+        if args.create:
+            sample, mapping = self.infer_mapping(args, files, documents, transform_function)
+            log.info("Creating index %r with inferred mapping %r" % (args.target, mapping))
+            self.spi.client.create_index(args.target, mappings=mapping)
+            with bulk_load_settings(self.spi.client, args.target), open_metrics(args.metrics) as metrics:
+                ingested, failed = self.ingest(args, files, chain(sample, documents), transform,
+                                               controller, metrics)
+        else:
+            with open_metrics(args.metrics) as metrics:
+                ingested, failed = self.ingest(args, files, documents, transform, controller, metrics)
+        log.info("Ingested %d documents into %r (%d failed)" % (ingested, args.target, failed))
+        return 1 if failed else 0
+
+    def infer_mapping(self, args, files, documents, transform_function):
+        """ Infer a mapping from a sample of the input documents. Return
+        any documents consumed from the `documents` iterator in taking
+        the sample, together with the mapping.
+        """
+        if args.format == "ndjson" and files and "-" not in files:
+            # Lines can be sampled at random from indexed files, which
+            # gives a more representative sample than the first few
+            # lines alone. Errors in the sample are left out, as each
+            # line sampled is read again, and reported, later.
+            ignored = []
+            return [], infer_mapping(document for document, _, _ in transform_documents(
+                sample_ndjson(files, args.sample_size, args.save_index, ignored), transform_function, ignored))
+        else:
+            # Values read from CSV files are all strings, and so only
+            # these are examined for numbers.
+            sample = list(islice(documents, args.sample_size))
+            return sample, infer_mapping((document for document, _, _ in sample),
+                                         numeric_strings=args.format in csv_formats)
+
+    def validate(self, args, files, documents, transform, errors):
+        """ Check documents against a schema or mapping, logging each
+        failure with the filename and line number from which the
+        document was read. Return 1 if any documents are invalid.
+        """
+        if args.schema:
+            validator = Validator.load(args.schema)
+        elif args.create:
+            sample, mapping = self.infer_mapping(args, files, documents,
+                                                 transform.compile() if transform else None)
+            log.info("Validating against inferred mapping %r" % (mapping,))
+            validator = Validator(mapping=mapping)
+            documents = chain(sample, documents)
+        else:
+            mappings = self.spi.client.get_mappings(args.target)
+            if len(mappings) != 1:
+                raise ValueError("Target %r must resolve to a single index for validation "
+                                 "(found %d)" % (args.target, len(mappings)))
+            validator = Validator(mapping=next(iter(mappings.values())))
+        if args.jobs == 1 or args.start_line != 1:
+            valid = validate_documents(documents, validator.compile(), errors)
+            invalid = len(errors)
+        else:
+            valid, invalid = self.validate_parallel(files, args.format, validator, args.jobs or cpu_count(),
+                                                    transform, skip_empty=args.create)
+        log.info("Validated %d documents (%d invalid)" % (valid + invalid, invalid))
+        return 1 if invalid else 0
+
+    def validate_parallel(self, files, fmt, validator, jobs, transform=None, skip_empty=False):
+        """ Validate files in parallel, using a pool of worker processes.
+        Files are split into shards in the same way as for loading, and
+        each worker reports invalid documents as it finds them. Return
+        the numbers of valid and invalid documents.
+        """
+        tasks = plan_tasks(files, fmt, jobs)
+        valid = invalid = 0
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_validation_worker,
+                                 initargs=(transform, validator, getLogger().getEffectiveLevel())) as executor:
+            futures = [executor.submit(validate_file, filename, fmt, shard, skip_empty)
+                       for filename, shard in tasks]
+            for future in as_completed(futures):
+                file_valid, file_invalid = future.result()
+                valid += file_valid
+                invalid += file_invalid
+        return valid, invalid
+
+    def ingest(self, args, files, documents, transform, controller, metrics=None):
+        """ Ingest documents, either directly from the given iterator or,
+        if multiple jobs are requested, by loading the files in parallel.
+        Return the number of documents ingested and the number that
+        failed.
+        """
+        if args.jobs == 1 or args.start_line != 1:
+            return ingest_documents(self.spi.client, args.target, documents, controller, metrics)
+        else:
+            return self.load_parallel(args.target, files, args.format, controller, args.jobs or cpu_count(),
+                                      transform, metrics, skip_empty=args.create)
+
+    def load_parallel(self, target, files, fmt, controller, jobs, transform=None, metrics=None,
+                      skip_empty=False):
+        """ Load files in parallel, using a pool of worker processes, each
+        of which holds its own client instance. Each file is loaded by a
+        single worker unless there are fewer files than workers, in
+        which case large NDJSON files are split into shards, each loaded
+        by a different worker. Any transform is compiled and applied
+        within each worker, and each worker starts with its own copy of
+        the batch size controller. Workers report failed documents as
+        each batch completes.
+        """
+        tasks = plan_tasks(files, fmt, jobs)
+        ingested = failed = 0
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                 initargs=(transform, controller, getLogger().getEffectiveLevel())) as executor:
+            futures = {executor.submit(ingest_file, target, filename, fmt, shard, skip_empty): (filename, shard)
+                       for filename, shard in tasks}
+            for future in as_completed(futures):
+                file_ingested, file_failed, file_metrics = future.result()
+                filename, shard = futures[future]
+                if metrics:
+                    for batch_metrics in file_metrics:
+                        batch_metrics["file"] = filename
+                        write_metrics(metrics, batch_metrics)
+                if shard is None:
+                    log.info("Ingested %d documents from file %r (%d failed)" % (
+                        file_ingested, filename, file_failed))
+                else:
+                    log.info("Ingested %d documents from shard %d of %d of file %r (%d failed)" % (
+                        file_ingested, shard[0] + 1, shard[1], filename, file_failed))
+                ingested += file_ingested
+                failed += file_failed
+        return ingested, failed
+
+
+def plan_tasks(files, fmt, jobs, min_shard_bytes=MIN_SHARD_BYTES):
+    """ Plan the parallel processing of files, returning a list of
+    (filename, shard) tuples. Files are processed whole, with a shard
+    of None, unless there are fewer files than jobs. In that case, the
+    jobs are shared between NDJSON files in proportion to their size,
+    and each file is split into that many shards, of at least
+    `min_shard_bytes` bytes. Each shard is an (index, count) tuple,
+    resolved to a range of whole lines by the worker that reads it, so
+    that no file is read here.
+    """
+    if not files or "-" in files:
+        raise ValueError("Standard input cannot be processed in parallel")
+    if fmt != "ndjson" or len(files) >= jobs:
+        return [(filename, None) for filename in files]
+    sizes = [path.getsize(filename) for filename in files]
+    total = sum(sizes) or 1
+    tasks = []
+    for filename, size in zip(files, sizes):
+        count = max(1, min(jobs * size // total, size // min_shard_bytes))
+        if count == 1:
+            tasks.append((filename, None))
+        else:
+            tasks.extend((filename, (index, count)) for index in range(count))
+    return tasks
+
+
+def read_task(filename, fmt, shard=None, errors=None, skip_empty=False):
+    """ Read the documents for a task planned by `plan_tasks`, within a
+    worker process. A shard of a file is located by byte offset, so
+    that no line index is needed.
+    """
+    if shard is None:
+        return read_documents([filename], fmt, errors, skip_empty)
+    start, stop, line_no = ndjson_shard(filename, *shard)
+    return iter_ndjson_range(filename, start, stop, line_no, errors)
+
+
+def read_documents(files, fmt, errors=None, skip_empty=False):
+    """ Read documents from the given files, yielding a (document,
+    filename, line_no) tuple for each. The line number will be None
+    for single document JSON files. Documents that cannot be parsed
+    are logged or, if a list of `errors` is supplied, appended to that
+    list as (filename, line_no, reason) tuples. If `skip_empty` is
+    true, empty CSV cells are left out of the documents read.
+    """
+    if fmt == "json":
+        for document, filename in iter_json(files, errors):
+            yield document, filename, None
+    elif fmt == "ndjson":
+        yield from iter_ndjson(files, errors)
+    elif fmt in csv_formats:
+        yield from iter_csv(files, dialect=csv_formats[fmt], errors=errors, skip_empty=skip_empty)
+    else:
+        raise ValueError("Unsupported input format %r" % fmt)
+
+
+def read_from_line(filename, start_line, save_index=False, errors=None):
+    """ Read documents from an NDJSON file, beginning at a given line
+    number. Return an iterator of (document, filename, line_no) tuples.
+    """
+    with LineIndexedFile(filename, save_index=save_index) as indexed_file:
+        if not 1 <= start_line <= len(indexed_file):
+            raise ValueError("Start line %d is out of range for file %r (%d lines)" % (
+                start_line, filename, len(indexed_file)))
+        start, stop = indexed_file.byte_range(start_line - 1, len(indexed_file))
+    return iter_ndjson_range(filename, start, stop, start_line, errors)
+
+
+def transform_documents(documents, transform, errors=None):
+    """ Apply a compiled transform function to each of a sequence of
+    (document, filename, line_no) tuples. Documents that cannot be
+    transformed are skipped, and are either logged or, if a list of
+    `errors` is supplied, appended to that list.
+    """
+    if transform is None:
+        yield from documents
+        return
+    for document, filename, line_no in documents:
+        try:
+            yield transform(document), filename, line_no
+        except (AttributeError, TypeError, ValueError) as ex:
+            if errors is not None:
+                errors.append((filename, line_no, "failed to transform: %s" % ex))
+            elif line_no is None:
+                log.error("Failed to transform document from file %r (%s)" % (filename, ex))
+            else:
+                log.error("Failed to transform document from file %r, line %d (%s)" % (filename, line_no, ex))
+
+
+class ErrorCounter:
+    """ Stand-in for a list of (filename, line_no, reason) errors, which
+    passes each error to a logging function as it is appended, and keeps
+    only a count. Errors are therefore reported while input is still
+    being read, rather than once it has all been processed.
+    """
+
+    def __init__(self, log_error):
+        self.log_error = log_error
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, error):
+        self.log_error(*error)
+        self.count += 1
+
+
+def validate_documents(documents, validate, errors):
+    """ Check each of a sequence of (document, filename, line_no) tuples
+    with a compiled validation function, appending a (filename, line_no,
+    reason) tuple to `errors` for each invalid document. `errors` may be
+    a list or an `ErrorCounter`. Return the number of valid documents.
+    """
+    valid = 0
+    for document, filename, line_no in documents:
+        problems = validate(document)
+        if problems:
+            errors.append((filename, line_no, "; ".join(problems)))
         else:
-            raise ValueError("Unsupported input format %r" % args.format)
-
-    def load_json(self, target, files):
-        for document, filename in iter_json(files):
-            res = self.spi.client.ingest(target, document)
-            log.info("Ingested JSON data from file %r with result %s" % (filename, res))
-
-    def load_ndjson(self, target, files):
-        for document, filename, line_no in iter_ndjson(files):
-            res = self.spi.client.ingest(target, document)
-            log.info("Ingested JSON data from file %r, line %d with result %s" % (filename, line_no, res))
-
-    def load_csv(self, target, files, dialect):
-        for document, filename, line_no in iter_csv(files, dialect):
-            res = self.spi.client.ingest(target, document)
-            log.info("Ingested CSV data from file %r, line %d with result %s" % (filename, line_no, res))
+            valid += 1
+    return valid
+
+
+def ingest_batches(client, target, documents, controller):
+    """ Ingest documents in batches, using one bulk request per batch,
+    with batch sizes determined by a `BatchSizeController`. For each
+    batch, yield the number of documents ingested, a list of (filename,
+    line_no, reason) tuples for those that failed, and a dictionary of
+    metrics for the bulk request.
+    """
+    while True:
+        batch = list(islice(documents, controller.size))
+        if not batch:
+            break
+        result = client.bulk(target, [document for document, _, _ in batch])
+        failures = [batch[position][1:] + (reason,) for position, reason in result.errors]
+        log.debug("Ingested batch of %d documents (%d failed)" % (len(batch), len(failures)))
+        yield len(batch) - len(failures), failures, controller.observe(len(batch), result)
+
+
+def ingest_documents(client, target, documents, controller, metrics=None):
+    """ Ingest documents in batches, logging each failure with the
+    filename and line number from which the document was read, and
+    writing metrics for each batch to the `metrics` file, if given.
+    Return the number of documents ingested and the number that failed.
+    """
+    ingested = failed = 0
+    for count, failures, batch_metrics in ingest_batches(client, target, documents, controller):
+        for filename, line_no, reason in failures:
+            log_failure(filename, line_no, reason)
+        if metrics:
+            write_metrics(metrics, batch_metrics)
+        ingested += count
+        failed += len(failures)
+    return ingested, failed
+
+
+@contextmanager
+def open_metrics(filename):
+    """ Context manager to open a metrics file for writing, yielding
+    None if no filename is given, or standard output for '-'.
+    """
+    if filename is None:
+        yield None
+    elif filename == "-":
+        yield sys.stdout
+    else:
+        with open(filename, "w") as f:
+            yield f
+
+
+def write_metrics(metrics, batch_metrics):
+    metrics.write(dumps(batch_metrics) + "\n")
+    metrics.flush()
+
+
+def log_failure(filename, line_no, reason):
+    if line_no is None:
+        log.error("Failed to ingest document from file %r (%s)" % (filename, reason))
+    else:
+        log.error("Failed to ingest document from file %r, line %d (%s)" % (filename, line_no, reason))
+
+
+def log_invalid(filename, line_no, reason):
+    if line_no is None:
+        log.error("Invalid document in file %r (%s)" % (filename, reason))
+    else:
+        log.error("Invalid document in file %r, line %d (%s)" % (filename, line_no, reason))
+
+
+_worker_client = None
+
+_worker_transform = None
+
+_worker_controller = None
+
+_worker_validate = None
+
+
+def init_worker_logging(level):
+    """ Configure logging within a worker process, if it has not been
+    inherited from the parent process, so that workers can report
+    failures directly.
+    """
+    if not getLogger().handlers:
+        basicConfig(format=SPI.log_format, level=level)
+
+
+def init_worker(transform, controller, log_level=WARNING):
+    """ Initialise a worker process, creating a client for its sole use,
+    compiling any transform to be applied to each document, and keeping
+    a batch size controller for use across all files it loads.
+    """
+    global _worker_client, _worker_transform, _worker_controller
+    init_worker_logging(log_level)
+    _worker_client = Client.create()
+    _worker_transform = transform.compile() if transform else None
+    _worker_controller = controller
+
+
+def ingest_file(target, filename, fmt, shard=None, skip_empty=False):
+    """ Read, parse and ingest a single file within a worker process.
+    If a shard is given, as an (index, count) tuple, only that part of
+    the file is read. Failed documents are logged as each batch
+    completes. Return the numbers of documents ingested and failed, and
+    a list of metrics dictionaries, one per batch.
+    """
+    documents = transform_documents(read_task(filename, fmt, shard, skip_empty=skip_empty), _worker_transform)
+    ingested = failed = 0
+    metrics = []
+    for count, failures, batch_metrics in ingest_batches(_worker_client, target, documents, _worker_controller):
+        for failure in failures:
+            log_failure(*failure)
+        ingested += count
+        failed += len(failures)
+        batch_metrics["worker"] = getpid()
+        metrics.append(batch_metrics)
+    return ingested, failed, metrics
+
+
+def init_validation_worker(transform, validator, log_level=WARNING):
+    """ Initialise a worker process for validation, compiling any
+    transform and the validator. No client is created.
+    """
+    global _worker_transform, _worker_validate
+    init_worker_logging(log_level)
+    _worker_transform = transform.compile() if transform else None
+    _worker_validate = validator.compile()
+
+
+def validate_file(filename, fmt, shard=None, skip_empty=False):
+    """ Read, parse and validate a single file, or a shard of a file,
+    within a worker process. Documents that are invalid, or that could
+    not be read, are logged as they are found. Return the numbers of
+    valid and invalid documents.
+    """
+    errors = ErrorCounter(log_invalid)
+    documents = transform_documents(read_task(filename, fmt, shard, errors, skip_empty),
+                                    _worker_transform, errors)
+    valid = validate_documents(documents, _worker_validate, errors)
+    return valid, len(errors)
+
+
+@contextmanager
+def bulk_load_settings(client, target):
+    """ Context manager to apply bulk load settings to an index, then
+    restore the original settings, force-merge and refresh the index on
+    exit.
+    """
+    settings = client.get_index_settings(target)
+    original_settings = {key: settings.get(key) for key in BULK_LOAD_SETTINGS}
+    client.update_index_settings(target, BULK_LOAD_SETTINGS)
+    try:
+        yield
+    finally:
+        log.info("Restoring settings %r for index %r" % (original_settings, target))
+        client.update_index_settings(target, original_settings)
+        client.force_merge_index(target)
+        client.refresh_index(target)
@@ -20,6 +20,8 @@ from csv import reader
 from json import dumps as json_dumps
 
 from escli.commands import Command
+from escli.io import simplify_type
+from escli.transform import Transform
 
 
 class JsonifyCommand(Command):
@@ -47,30 +49,17 @@ class JsonifyCommand(Command):
         with open(args.file, newline="") as csv_file:
             csv_reader = reader(csv_file)
             keys = None
+            if args.include == "" or args.include == "*":
+                transform = None
+            else:
+                transform = Transform.parse(include=args.include).compile()
             for line_no, line in enumerate(csv_reader):
                 if line_no == 0:
                     keys = line
-                    if args.include == "" or args.include == "*":
-                        include_keys = None
-                    else:
-                        include_keys = args.include.split(",")
                 else:
                     values = list(map(simplify_type, line))
                     data = dict(zip(keys, values))
-                    if include_keys:
-                        data = dict(zip(include_keys, [data[k] for k in include_keys]))
+                    if transform:
+                        data = transform(data)
                     print(json_dumps(data))
 
-
-def simplify_type(value):
-    try:
-        int_value = int(value)
-    except ValueError:
-        try:
-            float_value = float(value)
-        except ValueError:
-            return value
-        else:
-            return float_value
-    else:
-        return int_value
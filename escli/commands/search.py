@@ -17,13 +17,18 @@
 
 
 from escli.commands import Command
-from escli.io import print_data
+from escli.io import print_data, print_pages
+from escli.mapping import get_field_types
 
 
 class SearchCommand(Command):
     """ Perform a search query against a given target.
     """
 
+    def __init__(self, spi):
+        super().__init__(spi)
+        self._field_types = {}
+
     def get_name(self):
         return "search"
 
@@ -36,23 +41,88 @@ class SearchCommand(Command):
                             help="Search target. For Elasticsearch, this will be an index name; "
                                  "for Enterprise Search, this will be an engine name.")
         parser.add_argument("query", metavar="QUERY", nargs="?", default=None,
-                            help="Search query. For Elasticsearch, this should be in the form 'FIELD=VALUE'.")
+                            help="Search query. For Elasticsearch, this should be a query expression "
+                                 "such as 'FIELD=VALUE AND FIELD>VALUE'.")
         parser.add_argument("-f", "--format", default="simple",
                             help="Output table format")
         parser.add_argument("-i", "--include", default=None,
                             help="Fields to include in matching documents.")
+        parser.add_argument("-x", "--exclude", default=None,
+                            help="Fields to exclude from matching documents.")
+        parser.add_argument("--docvalue-fields", default=None,
+                            help="Fields to retrieve from doc values (comma-separated list).")
+        parser.add_argument("--stored-fields", default=None,
+                            help="Stored fields to retrieve (comma-separated list). Unless fields "
+                                 "to include are also given, source documents are not retrieved.")
         parser.add_argument("-s", "--sort",
                             help="Field to sort by. Prefixing the field name with '~' will sort in reverse order.")
         parser.add_argument("-n", "--page-size", type=int, default=10,
                             help="Number of results per page.")
         parser.add_argument("-p", "--page-number", type=int, default=1,
                             help="Page number to return.")
+        parser.add_argument("--pages", type=int, default=1,
+                            help="Number of consecutive pages to return, starting at the page "
+                                 "number given (default=1).")
+        parser.add_argument("-a", "--all", action="store_true",
+                            help="Return all pages, starting at the page number given.")
+        parser.add_argument("--prefetch", type=int, default=2,
+                            help="Number of pages to request ahead of the page being output, when "
+                                 "returning more than one page (default=2).")
         parser.set_defaults(f=self.search)
         return parser
 
     def search(self, args):
         """ Execute the search query and retrieve and display the results.
         """
-        hits = self.spi.client.search(args.target, args.query, fields=args.include,
-                                      sort=args.sort, page_size=args.page_size, page_number=args.page_number)
-        print_data(hits, args.format)
+        if self.is_paged(args):
+            pages = self.spi.client.search_pages(page_count=(None if args.all else args.pages),
+                                                 prefetch=args.prefetch, raw=self.is_raw(args),
+                                                 **self.search_arguments(args))
+            print_pages(pages, args.format, self.field_types(args))
+        else:
+            hits = self.spi.client.search(raw=self.is_raw(args), **self.search_arguments(args))
+            self.print_hits(args, hits)
+
+    @classmethod
+    def is_raw(cls, args):
+        """ Return true if hits can be read from the raw response one at
+        a time, and output as they are read. This is only done for NDJSON
+        output, when no other fields are merged into the documents.
+        """
+        return args.format == "ndjson" and not args.docvalue_fields and not args.stored_fields
+
+    @classmethod
+    def is_paged(cls, args):
+        """ Return true if more than one page of results is requested.
+        """
+        return args.all or args.pages != 1
+
+    def search_arguments(self, args):
+        """ Build a dictionary of keyword arguments for a client search,
+        from the parsed command line arguments.
+        """
+        return dict(target=args.target, query=args.query, fields=args.include, sort=args.sort,
+                    page_size=args.page_size, page_number=args.page_number, exclude_fields=args.exclude,
+                    docvalue_fields=split_fields(args.docvalue_fields),
+                    stored_fields=split_fields(args.stored_fields))
+
+    def field_types(self, args):
+        """ Return the mapped field types for the search target, which
+        are used to format tabular output. These are fetched only once
+        per target for each run of the command.
+        """
+        if args.format == "ndjson":
+            return None
+        if args.target not in self._field_types:
+            self._field_types[args.target] = get_field_types(self.spi.client, args.target)
+        return self._field_types[args.target]
+
+    def print_hits(self, args, hits):
+        print_data(hits, args.format, self.field_types(args))
+
+
+def split_fields(fields):
+    """ Split a comma-separated list of field names, or return None if
+    no fields are given.
+    """
+    return fields.split(",") if fields else None
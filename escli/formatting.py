@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Type-aware formatting of values for tabular output.
+
+Nested objects are flattened into dotted columns, and each column is
+given a formatter according to its field type, as taken from the index
+mapping where available. Columns with no known type are formatted
+according to the values they hold.
+"""
+
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+from json import dumps
+
+from escli.records import RecordBatch
+
+
+NUMERIC_TYPES = {"long", "integer", "short", "byte", "unsigned_long",
+                 "double", "float", "half_float", "scaled_float"}
+
+DATE_TYPES = {"date", "date_nanos"}
+
+OBJECT_TYPES = {None, "object", "nested"}
+
+
+def flatten_record(record, field_types=None, prefix=""):
+    """ Flatten the nested objects in a record into a single level
+    dictionary with dotted keys. Objects held in fields that are mapped
+    with a non-object type (such as 'flattened') are left intact.
+    """
+    flat = OrderedDict()
+    for key, value in record.items():
+        path = prefix + key
+        if isinstance(value, dict) and value and (field_types or {}).get(path) in OBJECT_TYPES:
+            flat.update(flatten_record(value, field_types, path + "."))
+        else:
+            flat[path] = value
+    return flat
+
+
+def flatten_records(records, field_types=None):
+    """ Flatten each of a sequence of records into a new `RecordBatch`.
+    """
+    batch = RecordBatch()
+    for record in records:
+        if any(isinstance(value, dict) for value in record.values()):
+            batch.append(flatten_record(record, field_types))
+        else:
+            batch.add(tuple(record.keys()), tuple(record.values()))
+    return batch
+
+
+def format_date(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        moment = datetime.fromtimestamp(value / 1000, timezone.utc)
+        return moment.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+    return str(value)
+
+
+def format_bool(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def format_any(value):
+    if isinstance(value, bool):
+        return format_bool(value)
+    elif isinstance(value, (dict, list)):
+        return dumps(value)
+    return str(value)
+
+
+FORMATTERS = {"boolean": format_bool}
+FORMATTERS.update(dict.fromkeys(NUMERIC_TYPES, str))
+FORMATTERS.update(dict.fromkeys(DATE_TYPES, format_date))
+
+
+def column_formatter(field_type):
+    """ Build a function to format the values of a column of the given
+    field type as strings. Arrays of scalars are joined with commas,
+    and any other objects are written as JSON.
+    """
+    format_scalar = FORMATTERS.get(field_type, format_any)
+
+    def format_value(value):
+        if value is None:
+            return ""
+        elif isinstance(value, list) and not any(isinstance(item, (dict, list)) for item in value):
+            return ", ".join(format_scalar(item) for item in value if item is not None)
+        elif isinstance(value, (dict, list)):
+            return dumps(value)
+        else:
+            return format_scalar(value)
+
+    return format_value
+
+
+def is_numeric(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class TableFormatter:
+    """ Formatter for the rows of a table with a fixed set of columns.
+
+    Each column is right-aligned if it holds numbers, either according
+    to its mapped type or, for columns with no known type, if all of
+    its values are numeric.
+    """
+
+    def __init__(self, columns, field_types=None, batch=None):
+        field_types = field_types or {}
+        self.columns = tuple(columns)
+        types = [field_types.get(column) for column in self.columns]
+        self.formatters = [column_formatter(field_type) for field_type in types]
+        self.aligns = ["right" if field_type in NUMERIC_TYPES else "left" for field_type in types]
+        if batch is not None:
+            untyped = [i for i, field_type in enumerate(types) if field_type is None]
+            numeric = set(untyped)
+            for row in batch.rows(self.columns):
+                for i in list(numeric):
+                    if row[i] is not None and not is_numeric(row[i]):
+                        numeric.discard(i)
+                if not numeric:
+                    break
+            for i in numeric:
+                self.aligns[i] = "right"
+
+    def rows(self, batch):
+        """ Format the records in a batch, yielding a list of strings for
+        each, aligned to the columns of the table.
+        """
+        formatters = self.formatters
+        for row in batch.rows(self.columns):
+            yield [formatter(value) for formatter, value in zip(formatters, row)]
@@ -16,14 +16,25 @@
 # limitations under the License.
 
 
+from array import array
+from bisect import bisect_right
 from csv import list_dialects, reader, writer
 from fileinput import FileInput
+from glob import glob
+from itertools import chain
 from json import dumps, loads, JSONDecodeError
 from logging import getLogger
-from sys import stdout
+from mmap import mmap, ACCESS_READ
+from os import fstat, getpid, path, remove, replace, walk
+from random import sample
+from struct import Struct
+import sys
 
 from tabulate import tabulate, tabulate_formats
 
+from escli.formatting import TableFormatter, flatten_records
+from escli.records import RecordBatch
+
 
 log = getLogger(__name__)
 
@@ -37,78 +48,471 @@ if "csv_excel_tab" in csv_formats:
 
 output_formats = set(tabulate_formats) | csv_formats.keys() | {"ndjson"}
 
+# Extensions of the files selected from directories given as input, by
+# input format. NDJSON is often saved with a plain '.json' extension.
+input_extensions = {"json": (".json",), "ndjson": (".ndjson", ".jsonl", ".json")}
+input_extensions.update(dict.fromkeys(csv_formats, (".csv", ".txt")))
+input_extensions["tsv"] = (".tsv", ".tab", ".txt")
+
+
+def print_data(data, fmt, field_types=None):
+    """ Print a sequence of records in the given format. The data may
+    be a `RecordBatch` or any iterable of mappings.
 
-def print_data(data, fmt):
+    For tabular formats, nested objects are flattened into dotted
+    columns, and values are formatted according to the field types
+    given, as a dictionary of dotted field names to mapping types. The
+    columns are the union of the keys of all records, with each row
+    aligned to those columns. For CSV output from a plain iterable,
+    which is written as it is read, the keys of the first record are
+    used instead.
+    """
     if fmt == "ndjson":
         for datum in data:
-            print(dumps(datum))
+            print(dumps(datum if isinstance(datum, dict) else dict(datum.items())))
     elif fmt in csv_formats:
-        csv_writer = writer(stdout, dialect=csv_formats[fmt])
-        for i, datum in enumerate(data):
-            if i == 0:
-                csv_writer.writerow(datum.keys())
-            csv_writer.writerow(datum.values())
+        csv_writer = writer(sys.stdout, dialect=csv_formats[fmt])
+        if isinstance(data, RecordBatch):
+            batch = flatten_records(data, field_types)
+            formatter = TableFormatter(batch.columns(), field_types)
+            csv_writer.writerow(formatter.columns)
+            csv_writer.writerows(formatter.rows(batch))
+        else:
+            formatter = None
+            for datum in data:
+                batch = flatten_records([datum], field_types)
+                if formatter is None:
+                    formatter = TableFormatter(batch.columns(), field_types)
+                    csv_writer.writerow(formatter.columns)
+                csv_writer.writerows(formatter.rows(batch))
     elif fmt in tabulate_formats:
-        print(tabulate(data, headers="keys", tablefmt=fmt))
+        batch = flatten_records(data, field_types)
+        formatter = TableFormatter(batch.columns(), field_types, batch)
+        # Values are formatted in advance, so tabulate has no need to
+        # detect column types or parse numbers.
+        print(tabulate(list(formatter.rows(batch)), headers=formatter.columns, tablefmt=fmt,
+                       disable_numparse=True, colalign=formatter.aligns or None))
     else:
         raise ValueError("Unsupported output format %r" % fmt)
 
 
-def multi_read(files):
+def print_pages(pages, fmt, field_types=None):
+    """ Print a sequence of record batches, one page of results at a
+    time, in the given format.
+
+    NDJSON and CSV output is written as each page arrives. CSV columns
+    are taken from the first page, with later pages aligned to them.
+    Other tabular formats require all pages to be collected first, so
+    that the table can be laid out as a whole.
+    """
+    if fmt == "ndjson":
+        for page in pages:
+            print_data(page, fmt)
+    elif fmt in csv_formats:
+        csv_writer = writer(sys.stdout, dialect=csv_formats[fmt])
+        formatter = None
+        for page in pages:
+            batch = flatten_records(page, field_types)
+            if formatter is None:
+                formatter = TableFormatter(batch.columns(), field_types)
+                csv_writer.writerow(formatter.columns)
+            csv_writer.writerows(formatter.rows(batch))
+    elif fmt in tabulate_formats:
+        print_data(RecordBatch(chain.from_iterable(pages)), fmt, field_types)
+    else:
+        raise ValueError("Unsupported output format %r" % fmt)
+
+
+def expand_files(files, extensions=None):
+    """ Expand a list of input filenames, replacing each directory with
+    the files it contains (recursively, in name order) and each glob
+    pattern with the files it matches. The '-' filename is retained as
+    is, as are any names that match nothing, so that these can be
+    reported when opened.
+
+    Hidden files and line index files are never selected by expansion.
+    Files found in directories can be further restricted to those with
+    one of the given `extensions`, such as the extensions for a format
+    listed in `input_extensions`.
+    """
+    expanded = []
+    for name in files:
+        if name == "-":
+            expanded.append(name)
+        elif path.isdir(name):
+            for dir_path, dir_names, file_names in walk(name):
+                dir_names[:] = sorted(d for d in dir_names if not d.startswith("."))
+                expanded.extend(path.join(dir_path, f) for f in sorted(file_names)
+                                if is_input_file(f) and (extensions is None or f.lower().endswith(extensions)))
+        elif any(ch in name for ch in "*?["):
+            matches = sorted(f for f in glob(name, recursive=True) if is_input_file(path.basename(f)))
+            expanded.extend(matches or [name])
+        else:
+            expanded.append(name)
+    return expanded
+
+
+def is_input_file(name):
+    return not name.startswith(".") and not name.endswith(LineIndexedFile.index_suffix)
+
+
+def multi_read(files, mode="r"):
     """ Iterate through a sequence of input files, reading and yielding
     a (filename, lines) tuple for each.
 
     Each item in `files` is a string holding the name of a file to
     read. This function wraps the built-in FileInput class from the
     fileinput module and, as such, an empty list or a '-' filename
-    will instead read from stdin.
+    will instead read from stdin. Files are read as text unless a
+    `mode` of 'rb' is given, in which case bytes are returned.
     """
+    empty = b"" if "b" in mode else ""
     last_filename = None
     lines = []
-    with FileInput(files) as file_input:
+    with FileInput(files, mode=mode) as file_input:
         for line in file_input:
             if file_input.isfirstline():
                 if last_filename is not None:
-                    yield last_filename, "".join(lines)
+                    yield last_filename, empty.join(lines)
                 last_filename = file_input.filename()
                 lines[:] = []
             lines.append(line)
     if last_filename is not None:
-        yield last_filename, "".join(lines)
+        yield last_filename, empty.join(lines)
 
 
-def iter_json(files):
+def parse_error(errors, filename, line_no, ex):
+    """ Report a failure to decode or parse input, either by appending a
+    (filename, line_no, reason) tuple to a list of errors, if given, or
+    by logging it.
+    """
+    what = "UTF-8" if isinstance(ex, UnicodeDecodeError) else "JSON"
+    if errors is not None:
+        errors.append((filename, line_no, "invalid %s: %s" % (what, ex)))
+    elif line_no is None:
+        log.error("Failed to parse %s in file %r (%s)" % (what, filename, ex))
+    else:
+        log.error("Failed to parse %s in file %r, line %d (%s)" % (what, filename, line_no, ex))
+
+
+def iter_json(files, errors=None):
     """ Iterate through each of the files supplied, parsing and yielding
-    a JSON document for each.
+    a JSON document for each. Parse failures are logged or, if a list
+    of `errors` is supplied, appended to that list.
     """
-    for filename, lines in multi_read(files):
-        src = "".join(lines)
+    for filename, src in multi_read(files, mode="rb"):
         try:
-            document = loads(src)
+            document = loads(src.decode("utf-8"))
+        except UnicodeDecodeError as ex:
+            parse_error(errors, filename, src.count(b"\n", 0, ex.start) + 1, ex)
         except JSONDecodeError as ex:
-            log.error("Failed to parse JSON in file %r (%s)" % (filename, ex))
+            parse_error(errors, filename, None, ex)
         else:
             yield document, filename
 
 
-def iter_ndjson(files):
-    with FileInput(files) as file_input:
-        for src in file_input:
-            if not src:
-                continue  # skip blank lines
-            try:
-                document = loads(src)
-            except JSONDecodeError as ex:
-                log.error("Failed to parse JSON in file %r, line %d (%s)" % (
-                    file_input.filename(), file_input.filelineno(), ex))
-            else:
+def iter_ndjson(files, errors=None):
+    """ Iterate through the lines of NDJSON files, yielding a (document,
+    filename, line_no) tuple for each. Lines are decoded one at a time,
+    so that a line which is not valid UTF-8 is reported in the same way
+    as one which is not valid JSON, without ending the read.
+    """
+    with FileInput(files, mode="rb") as file_input:
+        for line in file_input:
+            document = parse_line(line, file_input.filename(), file_input.filelineno(), errors)
+            if document is not None:
                 yield document, file_input.filename(), file_input.filelineno()
 
 
-def iter_csv(files, dialect):
-    with FileInput(files) as file_input:
-        csv_reader = reader(file_input, dialect=dialect)
+def decode_lines(file_input, errors=None):
+    """ Decode the lines read from a binary FileInput as UTF-8, reporting
+    and skipping any that cannot be decoded.
+    """
+    for line in file_input:
+        try:
+            yield line.decode("utf-8")
+        except UnicodeDecodeError as ex:
+            parse_error(errors, file_input.filename(), file_input.filelineno(), ex)
+
+
+def iter_ndjson_range(filename, start, stop, line_no, errors=None):
+    """ Iterate through the lines of an NDJSON file between two byte
+    offsets, yielding a (document, filename, line_no) tuple for each.
+    The first line in the range is numbered `line_no`. This allows a
+    shard of a file to be read, given the offsets and line number found
+    by `ndjson_shard`, without reading the rest of the file.
+    """
+    with open(filename, "rb") as f:
+        if stop <= start:
+            return
+        mapped = mmap(f.fileno(), 0, access=ACCESS_READ)
+        try:
+            while start < stop:
+                end = mapped.find(b"\n", start, stop)
+                if end == -1:
+                    end = stop
+                document = parse_line(mapped[start:end], filename, line_no, errors)
+                if document is not None:
+                    yield document, filename, line_no
+                start = end + 1
+                line_no += 1
+        finally:
+            mapped.close()
+
+
+def ndjson_shard(filename, index, count, chunk_size=1 << 20):
+    """ Return the (start, stop, line_no) of one of `count` shards of an
+    NDJSON file, as byte offsets and the number of its first line.
+    Shards are numbered from zero, are as near equal in size as whole
+    lines allow, and may be empty. No line index is needed: each
+    boundary is moved forward to the start of a line, and the first
+    line number is found by counting the newlines before the shard.
+    """
+    with open(filename, "rb") as f:
+        size = fstat(f.fileno()).st_size
+        if not size:
+            return 0, 0, 1
+        mapped = mmap(f.fileno(), 0, access=ACCESS_READ)
+        try:
+            start, stop = (line_start(mapped, size * i // count) for i in (index, index + 1))
+            # Newlines are counted a chunk at a time, to bound the
+            # memory used by copying out of the mapped file.
+            line_no = 1 + sum(mapped[offset:min(offset + chunk_size, start)].count(b"\n")
+                              for offset in range(0, start, chunk_size))
+        finally:
+            mapped.close()
+    return start, stop, line_no
+
+
+def line_start(mapped, offset):
+    """ Return the offset of the first line to start at or after the
+    given offset within a mapped file.
+    """
+    if offset == 0:
+        return 0
+    end = mapped.find(b"\n", offset - 1)
+    return len(mapped) if end == -1 else end + 1
+
+
+def parse_line(line, filename, line_no, errors=None):
+    """ Parse a single NDJSON line, supplied as bytes or a memoryview,
+    returning None for blank or unparseable lines.
+    """
+    line = bytes(line)
+    if not line.strip():
+        return None
+    try:
+        # Decoded explicitly, as `loads` would otherwise detect UTF-16
+        # and UTF-32 from the first bytes of the line.
+        return loads(line.decode("utf-8"))
+    except (JSONDecodeError, UnicodeDecodeError) as ex:
+        parse_error(errors, filename, line_no, ex)
+        return None
+
+
+class LineIndexedFile:
+    """ Memory-mapped NDJSON file, with an index of the byte offset at
+    which each line begins. The index allows any line, or any range of
+    lines, to be located without reading the lines before it.
+
+    Building the index requires one pass over the file. The index can
+    optionally be saved alongside the file, as a hidden file with an
+    '.idx' suffix (e.g. '.data.ndjson.idx' for 'data.ndjson'), and is
+    then reused by subsequent instances, for as long as the size and
+    modification time of the file remain unchanged. Hidden files are
+    never selected by `expand_files`.
+
+    Lines are returned as memoryview slices of the mapped file, so no
+    data is copied until a line is parsed. Any such views must be
+    released before the file is closed.
+    """
+
+    index_suffix = ".idx"
+
+    index_header = Struct("<8sQQ")
+
+    index_magic = b"ESCLIIDX"
+
+    def __init__(self, filename, save_index=False):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        try:
+            status = fstat(self._file.fileno())
+            self._signature = (status.st_size, status.st_mtime_ns)
+            if status.st_size:
+                self._mmap = mmap(self._file.fileno(), 0, access=ACCESS_READ)
+            else:
+                self._mmap = b""  # empty files cannot be mapped
+            self._view = memoryview(self._mmap)
+            self.offsets = self._load_index()
+            if self.offsets is None:
+                self.offsets = self._build_index()
+                if save_index:
+                    self._save_index()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def close(self):
+        view = getattr(self, "_view", None)
+        if view is not None:
+            view.release()
+        mapped = getattr(self, "_mmap", None)
+        if isinstance(mapped, mmap):
+            mapped.close()
+        self._file.close()
+
+    @property
+    def index_filename(self):
+        directory, name = path.split(self.filename)
+        return path.join(directory, "." + name + self.index_suffix)
+
+    def _build_index(self):
+        offsets = array("Q", [0])
+        size = len(self._mmap)
+        find = self._mmap.find
+        position = find(b"\n")
+        while position != -1:
+            offsets.append(position + 1)
+            position = find(b"\n", position + 1)
+        if offsets[-1] != size:
+            offsets.append(size)  # final line has no trailing newline
+        log.debug("Indexed %d lines in file %r" % (len(offsets) - 1, self.filename))
+        return offsets
+
+    def _load_index(self):
+        try:
+            with open(self.index_filename, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        header_size = self.index_header.size
+        if len(data) < header_size:
+            return None
+        magic, size, mtime_ns = self.index_header.unpack_from(data)
+        if magic != self.index_magic or (size, mtime_ns) != self._signature:
+            log.debug("Ignoring stale line index %r" % self.index_filename)
+            return None
+        offsets = array("Q")
+        offsets.frombytes(data[header_size:])
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        return offsets
+
+    def _save_index(self):
+        # The index is written to a temporary file and moved into place,
+        # as several workers may save the index of the same file at once.
+        offsets = array("Q", self.offsets)
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        temp_filename = "%s.%d.tmp" % (self.index_filename, getpid())
+        try:
+            with open(temp_filename, "wb") as f:
+                f.write(self.index_header.pack(self.index_magic, *self._signature))
+                f.write(offsets.tobytes())
+            replace(temp_filename, self.index_filename)
+        except OSError as ex:
+            log.warning("Failed to save line index %r (%s)" % (self.index_filename, ex))
+            if path.exists(temp_filename):
+                remove(temp_filename)
+        else:
+            log.debug("Saved line index %r" % self.index_filename)
+
+    def line(self, number):
+        """ Return a memoryview of a single line, excluding the line
+        terminator. Lines are numbered from zero.
+        """
+        start = self.offsets[number]
+        end = self.offsets[number + 1]
+        if end > start and self._view[end - 1] == 0x0A:
+            end -= 1
+        return self._view[start:end]
+
+    def byte_range(self, start, stop):
+        """ Return the byte offsets spanned by a range of lines.
+        """
+        return self.offsets[start], self.offsets[stop]
+
+    def iter_documents(self, start=0, stop=None, errors=None):
+        """ Parse and yield a (document, filename, line_no) tuple for
+        each line in a range. Line numbers in the yielded tuples count
+        from one, for consistency with other readers. Lines that cannot
+        be parsed are logged or, if a list of `errors` is supplied,
+        appended to that list.
+        """
+        if stop is None:
+            stop = len(self)
+        for number in range(start, stop):
+            line = self.line(number)
+            try:
+                document = parse_line(line, self.filename, number + 1, errors)
+            finally:
+                line.release()
+            if document is not None:
+                yield document, self.filename, number + 1
+
+
+def sample_ndjson(files, size, save_index=False, errors=None):
+    """ Select up to `size` lines at random from across a number of
+    NDJSON files, yielding a (document, filename, line_no) tuple for
+    each. Lines that cannot be parsed are logged or, if a list of
+    `errors` is supplied, appended to that list.
+    """
+    indexed_files = []
+    try:
+        for filename in files:
+            indexed_files.append(LineIndexedFile(filename, save_index=save_index))
+        bounds = [0]
+        for indexed_file in indexed_files:
+            bounds.append(bounds[-1] + len(indexed_file))
+        for number in sorted(sample(range(bounds[-1]), min(size, bounds[-1]))):
+            i = bisect_right(bounds, number) - 1
+            yield from indexed_files[i].iter_documents(number - bounds[i], number - bounds[i] + 1, errors)
+    finally:
+        for indexed_file in indexed_files:
+            indexed_file.close()
+
+
+def iter_csv(files, dialect, errors=None, skip_empty=False):
+    """ Read documents from CSV files, yielding a (document, filename,
+    line_no) tuple for each row. If `skip_empty` is true then, as with
+    the Elasticsearch 'csv' ingest processor, empty cells are left out
+    of the document rather than being included as empty strings. Lines
+    that are not valid UTF-8 are logged or, if a list of `errors` is
+    supplied, appended to that list.
+    """
+    with FileInput(files, mode="rb") as file_input:
+        csv_reader = reader(decode_lines(file_input, errors), dialect=dialect)
         keys = next(csv_reader)
         for values in csv_reader:
-            document = dict(zip(keys, values))
+            if skip_empty:
+                document = {key: value for key, value in zip(keys, values) if value != ""}
+            else:
+                document = dict(zip(keys, values))
             yield document, file_input.filename(), file_input.filelineno()
+
+
+def simplify_type(value):
+    """ Convert a string value to an int or a float, if it can be
+    interpreted as one, otherwise return it unchanged.
+    """
+    try:
+        int_value = int(value)
+    except ValueError:
+        try:
+            float_value = float(value)
+        except ValueError:
+            return value
+        else:
+            return float_value
+    else:
+        return int_value
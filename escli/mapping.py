@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from json import dump, load
+from logging import getLogger
+from math import isfinite
+from os import getenv, listdir, makedirs, path, remove, replace
+from re import compile as re_compile
+
+
+log = getLogger(__name__)
+
+
+DATE_PATTERN = re_compile(r"^\d{4}-\d{2}-\d{2}"
+                          r"(?:T\d{2}:\d{2}(?::\d{2}(?:[.,]\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?$")
+
+# Numbers as written in CSV files. Values with leading zeros (such as
+# zip codes) or digit separators are treated as strings, as are the
+# non-finite values NaN and Infinity, which cannot be indexed.
+INTEGER_PATTERN = re_compile(r"^-?(?:0|[1-9]\d*)$")
+FLOAT_PATTERN = re_compile(r"^-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?$")
+
+LONG_RANGE = (-2 ** 63, 2 ** 63 - 1)
+
+NUMERIC_TYPES = ("long", "double")
+
+
+def infer_mapping(documents, numeric_strings=False):
+    """ Infer an explicit index mapping from a sample of documents.
+
+    Each field is typed using the first value seen for it and widened
+    as necessary by subsequent values, so that every document in the
+    sample can be indexed under the resulting mapping. If
+    `numeric_strings` is true, as for documents read from CSV files,
+    string values that hold numbers are mapped as numeric fields.
+    """
+    properties = {}
+    for document in documents:
+        merge_properties(properties, document, numeric_strings)
+    return {"properties": properties}
+
+
+def infer_string_type(value, numeric_strings=False):
+    if numeric_strings:
+        if INTEGER_PATTERN.match(value):
+            return "long" if LONG_RANGE[0] <= int(value) <= LONG_RANGE[1] else "keyword"
+        elif FLOAT_PATTERN.match(value):
+            return "double"
+    if DATE_PATTERN.match(value):
+        return "date"
+    elif any(ch.isspace() for ch in value):
+        return "text"
+    else:
+        return "keyword"
+
+
+def infer_field_type(value, numeric_strings=False):
+    """ Infer the Elasticsearch field type for a single value, returning
+    None if no type can be inferred (e.g. for null values, empty strings
+    and non-finite numbers).
+
+    Strings are only mapped as numbers if `numeric_strings` is true, as
+    for values read from untyped sources such as CSV files.
+    """
+    if isinstance(value, bool):
+        return "boolean"
+    elif isinstance(value, int):
+        return "long"
+    elif isinstance(value, float):
+        return "double" if isfinite(value) else None
+    elif isinstance(value, str):
+        return infer_string_type(value, numeric_strings) if value else None
+    elif isinstance(value, dict):
+        return "object"
+    elif isinstance(value, list):
+        field_type = None
+        for item in value:
+            field_type = widen_field_type(field_type, infer_field_type(item, numeric_strings))
+        return field_type
+    else:
+        return None
+
+
+def widen_field_type(type_1, type_2):
+    """ Return the narrowest field type able to hold values of both of
+    the types given.
+    """
+    if type_1 is None or type_1 == type_2:
+        return type_2
+    elif type_2 is None:
+        return type_1
+    elif type_1 in NUMERIC_TYPES and type_2 in NUMERIC_TYPES:
+        return "double"
+    elif "text" in (type_1, type_2):
+        return "text"
+    else:
+        return "keyword"
+
+
+def merge_properties(properties, document, numeric_strings=False):
+    """ Merge the field types inferred from a document into an existing
+    dictionary of mapping properties.
+    """
+    for key, value in document.items():
+        field_type = infer_field_type(value, numeric_strings)
+        if field_type is None:
+            continue
+        field = properties.get(key)
+        if field_type == "object":
+            if field is None:
+                field = properties[key] = {"properties": {}}
+            elif "properties" not in field:
+                log.warning("Field %r holds both objects and scalar values; "
+                            "ignoring object values" % key)
+                continue
+            for item in (value if isinstance(value, list) else [value]):
+                if isinstance(item, dict):
+                    merge_properties(field["properties"], item, numeric_strings)
+        elif field is None:
+            properties[key] = field_mapping(field_type)
+        elif "properties" in field:
+            log.warning("Field %r holds both objects and scalar values; "
+                        "ignoring scalar values" % key)
+        else:
+            properties[key] = field_mapping(widen_field_type(field["type"], field_type))
+
+
+def field_mapping(field_type):
+    """ Build the mapping definition for a field of a given type.
+
+    Text fields are also given a 'keyword' sub-field, as they would be
+    under dynamic mapping, so that they can still be sorted and
+    aggregated on.
+    """
+    if field_type == "text":
+        return {"type": "text", "fields": {"keyword": {"type": "keyword", "ignore_above": 256}}}
+    else:
+        return {"type": field_type}
+
+
+def field_types(mappings):
+    """ Flatten the properties of an index mapping into a dictionary of
+    dotted field names to field types. Object fields, which have no
+    explicit type, are given the type 'object'.
+    """
+    types = {}
+
+    def add_properties(properties, prefix):
+        for key, field in properties.items():
+            name = prefix + key
+            types[name] = field.get("type", "object")
+            if "properties" in field:
+                add_properties(field["properties"], name + ".")
+
+    add_properties(mappings.get("properties", {}), "")
+    return types
+
+
+def merge_field_types(all_types):
+    """ Merge the field types of several indexes. Fields mapped with
+    different types in different indexes are given no type.
+    """
+    merged = {}
+    for types in all_types:
+        for name, field_type in types.items():
+            if merged.setdefault(name, field_type) != field_type:
+                merged[name] = None
+    return {name: field_type for name, field_type in merged.items() if field_type is not None}
+
+
+def mapping_cache_directory():
+    cache_home = getenv("XDG_CACHE_HOME") or path.join(path.expanduser("~"), ".cache")
+    return path.join(cache_home, "escli", "mappings")
+
+
+class MappingCache:
+    """ On-disk cache of index mappings, in which each mapping is keyed
+    by the UUID of its index and its mapping version, so that a cached
+    mapping is never used once the index has been recreated or its
+    mapping has changed.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or mapping_cache_directory()
+
+    def filename(self, uuid, version):
+        return path.join(self.directory, "%s-%d.json" % (uuid, version))
+
+    def get(self, uuid, version):
+        try:
+            with open(self.filename(uuid, version)) as f:
+                return load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, uuid, version, mappings):
+        """ Store a mapping, replacing any earlier versions for the same
+        index. Failure to write to the cache is not an error.
+        """
+        try:
+            makedirs(self.directory, exist_ok=True)
+            filename = self.filename(uuid, version)
+            with open(filename + ".tmp", "w") as f:
+                dump(mappings, f)
+            replace(filename + ".tmp", filename)
+            prefix = uuid + "-"
+            for name in listdir(self.directory):
+                if name.startswith(prefix) and name != path.basename(filename):
+                    remove(path.join(self.directory, name))
+        except OSError as ex:
+            log.debug("Unable to cache mapping for index %s (%s)" % (uuid, ex))
+
+
+def get_field_types(client, target, cache=None):
+    """ Fetch the field types for a search target, which may cover
+    several indexes, using cached mappings where possible. Only the
+    mapping versions are fetched for indexes whose mappings are cached.
+
+    If the mappings cannot be fetched, for example due to insufficient
+    privileges, an empty dictionary is returned.
+    """
+    if cache is None:
+        cache = MappingCache()
+    try:
+        versions = client.get_mapping_versions(target)
+        mappings = {}
+        for index, (uuid, version) in versions.items():
+            cached = cache.get(uuid, version)
+            if cached is not None:
+                mappings[index] = cached
+        missing = [index for index in versions if index not in mappings]
+        if missing:
+            log.debug("Fetching mappings for %s" % ", ".join(missing))
+            fetched = client.get_mappings(",".join(missing))
+            for index in missing:
+                mappings[index] = fetched[index]
+                cache.put(*versions[index], mappings=fetched[index])
+    except Exception as ex:
+        # Field types only refine the formatting of results, so any
+        # failure here is reported but does not prevent output.
+        log.debug("Unable to fetch mappings for %r (%s)" % (target, ex))
+        return {}
+    return merge_field_types(field_types(mappings[index]) for index in versions)
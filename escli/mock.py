@@ -0,0 +1,1487 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Lightweight local stand-in for an Elasticsearch service.
+
+This module implements enough of the Elasticsearch REST API to allow
+escli to be exercised, benchmarked and stress-tested without access to
+a real cluster. Documents are held either in memory or in an SQLite
+database, and all queries are evaluated locally, in Python.
+
+Latency and rejections can both be injected, to simulate a remote or
+overloaded cluster. The server can be started from the command line:
+
+    $ python -m escli.mock --port 9200 --latency 0.05 --reject-rate 0.1
+    $ ESCLI_ADDR=http://localhost:9200 escli info
+
+"""
+
+
+from argparse import ArgumentParser
+from base64 import urlsafe_b64encode
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatchcase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from json import dumps, loads
+from logging import basicConfig, getLogger, DEBUG, INFO
+from operator import itemgetter
+from os import urandom
+from random import random
+from re import compile as re_compile
+from sqlite3 import connect
+from threading import Condition, Lock
+from time import monotonic, sleep
+from urllib.parse import parse_qsl, unquote, urlsplit
+from zlib import crc32
+
+
+log = getLogger(__name__)
+
+
+VERSION = "8.11.0"
+
+WORD = re_compile(r"\w+")
+
+NUMERIC_TYPES = {"long", "integer", "short", "byte", "unsigned_long",
+                 "double", "float", "half_float", "scaled_float"}
+
+# Endpoints that never change the stored documents or index metadata.
+# Requests for these are handled under a shared lock, so that searches
+# can run concurrently with one another.
+READ_ENDPOINTS = {"_search", "_msearch", "_count", "_pit", "_mapping", "_cluster",
+                  "_refresh", "_forcemerge", "_flush"}
+
+
+class MockError(Exception):
+    """ Error raised while handling a request, which will be reported to
+    the client in the usual Elasticsearch error format.
+    """
+
+    def __init__(self, status, error_type, reason):
+        super().__init__(reason)
+        self.status = status
+        self.error_type = error_type
+        self.reason = reason
+
+    def to_dict(self):
+        return {"error": {"root_cause": [{"type": self.error_type, "reason": self.reason}],
+                          "type": self.error_type, "reason": self.reason},
+                "status": self.status}
+
+
+class MemoryStorage:
+    """ Document storage held entirely in memory.
+    """
+
+    def __init__(self):
+        self._documents = {}
+
+    def indexes(self):
+        return []
+
+    def save_index(self, index, metadata):
+        pass
+
+    def commit(self):
+        pass
+
+    def create(self, index):
+        self._documents[index] = OrderedDict()
+
+    def drop(self, index):
+        del self._documents[index]
+
+    def put(self, index, doc_id, document):
+        documents = self._documents[index]
+        created = doc_id not in documents
+        documents[doc_id] = document
+        return created
+
+    def get(self, index, doc_id):
+        return self._documents[index].get(doc_id)
+
+    def count(self, index):
+        return len(self._documents[index])
+
+    def scan(self, index, query=None):
+        """ Iterate through the documents in an index, in the order in
+        which they were stored, as (sequence, id, source) tuples. The
+        query is ignored, as all documents are already in memory.
+        """
+        for seq, (doc_id, source) in enumerate(self._documents[index].items()):
+            yield seq, doc_id, source
+
+
+class SQLiteStorage:
+    """ Document storage backed by an SQLite database. Index metadata is
+    also stored, so that a database can be reopened by a later server.
+    Changes are committed once per request.
+
+    Searches read documents in chunks, and skip rows that cannot match
+    the query (see `sql_condition`) before decoding the remainder.
+    """
+
+    def __init__(self, path):
+        self._db = connect(path, check_same_thread=False)
+        self._lock = Lock()
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS indexes ("
+                             "idx TEXT PRIMARY KEY, metadata TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS documents ("
+                             "idx TEXT, id TEXT, source TEXT, PRIMARY KEY (idx, id))")
+
+    def indexes(self):
+        with self._lock:
+            return [(index, loads(metadata)) for index, metadata in
+                    self._db.execute("SELECT idx, metadata FROM indexes ORDER BY rowid")]
+
+    def save_index(self, index, metadata):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO indexes VALUES (?, ?)", (index, dumps(metadata)))
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def create(self, index):
+        self.drop(index)
+
+    def drop(self, index):
+        with self._lock:
+            self._db.execute("DELETE FROM indexes WHERE idx = ?", (index,))
+            self._db.execute("DELETE FROM documents WHERE idx = ?", (index,))
+
+    def put(self, index, doc_id, document):
+        with self._lock:
+            created = self._db.execute("SELECT 1 FROM documents WHERE idx = ? AND id = ?",
+                                       (index, doc_id)).fetchone() is None
+            self._db.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?)",
+                             (index, doc_id, dumps(document)))
+        return created
+
+    def get(self, index, doc_id):
+        with self._lock:
+            row = self._db.execute("SELECT source FROM documents WHERE idx = ? AND id = ?",
+                                   (index, doc_id)).fetchone()
+        return None if row is None else loads(row[0])
+
+    def count(self, index):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM documents WHERE idx = ?", (index,)).fetchone()[0]
+
+    def scan(self, index, query=None):
+        """ Iterate through the documents in an index, in the order in
+        which they were stored, as (sequence, id, source) tuples. Where
+        a query is given, documents that cannot match it may be left
+        out, but those that remain must still be checked.
+        """
+        condition, parameters = sql_condition(query) or ("1", [])
+        with self._lock:
+            cursor = self._db.execute("SELECT rowid, id, source FROM documents "
+                                      "WHERE idx = ? AND (%s) ORDER BY rowid" % condition,
+                                      [index] + parameters)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for rowid, doc_id, source in rows:
+                yield rowid, doc_id, loads(source)
+
+
+def plain_string(value):
+    """ Return True if a value is a string that cannot compare equal
+    to a number or a boolean (see `values_equal`).
+    """
+    if not isinstance(value, str) or value.lower() in ("true", "false"):
+        return False
+    try:
+        float(value)
+    except ValueError:
+        return True
+    return False
+
+
+def clause_list(spec, clause_type):
+    clauses = spec.get(clause_type) or []
+    return [clauses] if isinstance(clauses, dict) else clauses
+
+
+def sql_condition(query):
+    """ Translate a query into a condition on the stored JSON source
+    of a document, returning a (condition, parameters) tuple, or None if
+    the query cannot be translated. The condition selects a superset of
+    the matching documents, as it looks for values anywhere within the
+    source, and so is only used to skip documents before the query
+    itself is evaluated.
+
+    The source is stored with non-ASCII characters escaped, and so only
+    ASCII text is searched for where case is ignored.
+    """
+    if not query:
+        return None
+    (query_type, spec), = query.items()
+    if query_type == "match_none":
+        return "0", []
+    elif query_type == "ids":
+        values = [str(value) for value in spec.get("values", [])]
+        return "id IN (%s)" % ", ".join("?" * len(values)), values
+    elif query_type == "term":
+        _, value, _ = field_spec(spec)
+        if plain_string(value):
+            return "instr(source, ?)", [dumps(value)]
+    elif query_type in ("match", "match_phrase"):
+        _, value, _ = field_spec(spec, "query")
+        words = tokens(value) if plain_string(value) else []
+        if words and all(word.isascii() for word in words):
+            return " OR ".join(["instr(lower(source), ?)"] * len(words)), words
+    elif query_type == "prefix":
+        _, value, _ = field_spec(spec)
+        if isinstance(value, str) and value and not set(value) & set("*?[{'\\\""):
+            return "instr(lower(source), ?)", [dumps(value)[1:-1].lower()]
+    elif query_type == "bool":
+        conditions = [sql_condition(clause) for clause_type in ("must", "filter")
+                      for clause in clause_list(spec, clause_type)]
+        should = clause_list(spec, "should")
+        default = 0 if spec.get("must") or spec.get("filter") else 1
+        try:
+            minimum = int(spec.get("minimum_should_match", default))
+        except (TypeError, ValueError):
+            minimum = 0
+        if should and minimum > 0:
+            alternatives = [sql_condition(clause) for clause in should]
+            if all(alternatives):
+                conditions.append((" OR ".join("(%s)" % condition for condition, _ in alternatives),
+                                   [parameter for _, parameters in alternatives for parameter in parameters]))
+        conditions = [condition for condition in conditions if condition]
+        if conditions:
+            return (" AND ".join("(%s)" % condition for condition, _ in conditions),
+                    [parameter for _, parameters in conditions for parameter in parameters])
+    return None
+
+
+class MockIndex:
+    """ Metadata for a single index held by the stand-in service.
+    """
+
+    def __init__(self, name, mappings=None, settings=None):
+        self.name = name
+        self.uuid = urlsafe_b64encode(urandom(16)).decode("ascii").rstrip("=")
+        self.mappings = dict(mappings or {})
+        self.mappings.setdefault("properties", {})
+        self.settings = {
+            "index.creation_date": str(int(datetime.now(timezone.utc).timestamp() * 1000)),
+            "index.number_of_replicas": "1",
+            "index.number_of_shards": "1",
+            "index.provided_name": name,
+            "index.uuid": self.uuid,
+            "index.version.created": "8500003",
+        }
+        self.update_settings(settings or {})
+        self.mapping_version = 1
+        self.settings_version = 1
+
+    def update_settings(self, settings):
+        for key, value in flatten(settings).items():
+            if not key.startswith("index."):
+                key = "index." + key
+            if value is None:
+                self.settings.pop(key, None)
+            else:
+                self.settings[key] = str(value).lower() if isinstance(value, bool) else str(value)
+        self.settings_version = getattr(self, "settings_version", 0) + 1
+
+    def check_document(self, document):
+        """ Check that a document can be indexed under the current
+        mapping, adding any new fields dynamically. Returns True if the
+        mapping was changed.
+        """
+        changed = map_fields(self.mappings["properties"], document, "")
+        if changed:
+            self.mapping_version += 1
+        return changed
+
+    def to_dict(self):
+        return {"aliases": {}, "mappings": self.mappings, "settings": unflatten(self.settings)}
+
+    def metadata(self):
+        """ Return the metadata to be saved by persistent storage.
+        """
+        return {"mappings": self.mappings, "settings": self.settings, "uuid": self.uuid,
+                "mapping_version": self.mapping_version, "settings_version": self.settings_version}
+
+    @classmethod
+    def from_metadata(cls, name, metadata):
+        index = cls(name)
+        index.mappings = metadata["mappings"]
+        index.settings = metadata["settings"]
+        index.uuid = metadata["uuid"]
+        index.mapping_version = metadata["mapping_version"]
+        index.settings_version = metadata["settings_version"]
+        return index
+
+
+class ReadWriteLock:
+    """ Lock that can be held either by any number of readers at once
+    or by a single writer. Waiting writers take precedence over new
+    readers, so that a steady stream of searches cannot hold up writes
+    indefinitely.
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+        self._readers = 0
+        self._writers_waiting = 0
+        self._writing = False
+
+    @contextmanager
+    def reading(self):
+        with self._condition:
+            while self._writing or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        with self._condition:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+class ResultCache:
+    """ Small least-recently-used cache of search results, so that
+    paging through the results of a query, with from/size or with
+    search_after, does not match and sort every document for every
+    page.
+    """
+
+    def __init__(self, capacity=16):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, compute):
+        """ Return the value cached under a key, calling `compute` to
+        create it if it is not present.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = compute()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class MockElasticsearch:
+    """ In-process implementation of a subset of the Elasticsearch REST
+    API.
+
+    Each request is handled by a call to `handle`, which returns an
+    HTTP status code and a response payload. Latency is added to every
+    request, and searches and writes are rejected at random with a 429
+    status, at the configured rates.
+
+    Requests that only read data are handled concurrently, while those
+    that write data are handled one at a time. The sorted results of
+    recent searches are cached until the next write, and each point in
+    time holds its own cache.
+    """
+
+    def __init__(self, storage=None, latency=0.0, reject_rate=0.0):
+        self.storage = storage or MemoryStorage()
+        self.latency = latency
+        self.reject_rate = reject_rate
+        self.indexes = OrderedDict((name, MockIndex.from_metadata(name, metadata))
+                                   for name, metadata in self.storage.indexes())
+        self.contexts = {}
+        self.sequence = count(1)
+        self.lock = ReadWriteLock()
+        self.results = ResultCache()
+
+    def handle(self, method, path, params, data):
+        """ Handle a single request, returning a (status, payload) tuple.
+        """
+        if self.latency:
+            sleep(self.latency)
+        t0 = monotonic()
+        parts = [unquote(part) for part in path.split("/") if part]
+        try:
+            if method in ("GET", "HEAD") or READ_ENDPOINTS.intersection(parts[:2]):
+                with self.lock.reading():
+                    status, payload = self.route(method, parts, params, data)
+            else:
+                with self.lock.writing():
+                    try:
+                        status, payload = self.route(method, parts, params, data)
+                    finally:
+                        self.results.clear()
+                        self.storage.commit()
+        except MockError as error:
+            return error.status, error.to_dict()
+        except Exception as error:
+            log.exception("Failed to handle %s %s" % (method, path))
+            return 500, MockError(500, "exception", str(error)).to_dict()
+        if isinstance(payload, dict) and "took" in payload:
+            payload["took"] = int((monotonic() - t0) * 1000)
+        return status, payload
+
+    def route(self, method, parts, params, data):
+        if not parts:
+            return 200, self.info()
+        head = parts[0]
+        if head == "_bulk":
+            return self.bulk(None, data)
+        elif head == "_msearch":
+            return self.msearch(None, data)
+        elif head == "_search" and parts[1:] == ["scroll"]:
+            if method == "DELETE":
+                return self.clear_scroll(load_json(data))
+            return self.scroll(load_json(data), params)
+        elif head == "_search":
+            return self.search("_all", params, load_json(data))
+        elif head == "_pit" and method == "DELETE":
+            return self.close_pit(load_json(data))
+        elif head == "_cluster" and parts[1:3] == ["state", "metadata"]:
+            return self.cluster_state(parts[3] if len(parts) > 3 else "_all")
+        elif head.startswith("_"):
+            raise MockError(400, "illegal_argument_exception", "unsupported endpoint [%s]" % "/".join(parts))
+        elif len(parts) == 1:
+            if method == "PUT":
+                return self.create_index(head, load_json(data))
+            elif method == "DELETE":
+                return self.delete_index(head)
+            elif method == "HEAD":
+                return (200 if self.resolve(head, strict=False) else 404), None
+            return 200, {name: self.indexes[name].to_dict() for name in self.resolve(head)}
+        endpoint = parts[1]
+        if endpoint == "_doc" and method == "GET":
+            return self.get_document(head, parts[2])
+        elif endpoint == "_doc":
+            return self.index_document(head, parts[2] if len(parts) > 2 else None, load_json(data))
+        elif endpoint == "_bulk":
+            return self.bulk(head, data)
+        elif endpoint == "_search":
+            return self.search(head, params, load_json(data))
+        elif endpoint == "_msearch":
+            return self.msearch(head, data)
+        elif endpoint == "_count":
+            query = (load_json(data) or {}).get("query")
+            return 200, {"count": sum(1 for doc in self.documents(head, query) if matches(query, doc)),
+                         "_shards": shards()}
+        elif endpoint == "_pit":
+            return self.open_pit(head, params)
+        elif endpoint == "_settings" and method == "PUT":
+            for name, index in self.indexed(head):
+                index.update_settings(load_json(data) or {})
+                self.storage.save_index(name, index.metadata())
+            return 200, {"acknowledged": True}
+        elif endpoint == "_settings":
+            flat = params.get("flat_settings") == "true"
+            return 200, {name: {"settings": (index.settings if flat else unflatten(index.settings))}
+                         for name, index in self.indexed(head)}
+        elif endpoint == "_mapping":
+            return 200, {name: {"mappings": index.mappings} for name, index in self.indexed(head)}
+        elif endpoint in ("_refresh", "_forcemerge", "_flush"):
+            names = self.resolve(head)
+            return 200, {"_shards": shards(len(names))}
+        raise MockError(400, "illegal_argument_exception", "unsupported endpoint [%s]" % "/".join(parts))
+
+    def info(self):
+        return {
+            "name": "escli-mock",
+            "cluster_name": "escli-mock",
+            "cluster_uuid": "escli-mock",
+            "version": {
+                "number": VERSION,
+                "build_flavor": "default",
+                "build_type": "mock",
+                "lucene_version": "9.8.0",
+                "minimum_wire_compatibility_version": "7.17.0",
+                "minimum_index_compatibility_version": "7.0.0",
+            },
+            "tagline": "You Know, for Search",
+        }
+
+    def reject(self):
+        return self.reject_rate and random() < self.reject_rate
+
+    def rejection(self, what):
+        return MockError(429, "es_rejected_execution_exception",
+                         "rejected execution of %s (simulated by escli.mock)" % what)
+
+    def resolve(self, expression, strict=True):
+        """ Resolve an index expression, such as 'a,b*,-c', to a list of
+        index names.
+        """
+        names = []
+        for pattern in expression.split(","):
+            if pattern == "_all":
+                pattern = "*"
+            if pattern.startswith("-") and names:
+                names = [name for name in names if not fnmatchcase(name, pattern[1:])]
+            elif "*" in pattern:
+                names.extend(name for name in self.indexes if fnmatchcase(name, pattern) and name not in names)
+            elif pattern in self.indexes:
+                if pattern not in names:
+                    names.append(pattern)
+            elif strict:
+                raise MockError(404, "index_not_found_exception", "no such index [%s]" % pattern)
+        return names
+
+    def indexed(self, expression):
+        return [(name, self.indexes[name]) for name in self.resolve(expression)]
+
+    def documents(self, expression, query=None):
+        """ Iterate through the documents in the matching indexes. If a
+        query is given, the storage may leave out some documents that
+        cannot match it, but those that remain must still be checked.
+        """
+        for name in self.resolve(expression):
+            for seq, doc_id, source in self.storage.scan(name, query):
+                yield Document(name, doc_id, source, seq)
+
+    def create_index(self, name, body):
+        if name in self.indexes:
+            raise MockError(400, "resource_already_exists_exception",
+                            "index [%s/%s] already exists" % (name, self.indexes[name].uuid))
+        body = body or {}
+        index = self.indexes[name] = MockIndex(name, body.get("mappings"), body.get("settings"))
+        self.storage.create(name)
+        self.storage.save_index(name, index.metadata())
+        return 200, {"acknowledged": True, "shards_acknowledged": True, "index": name}
+
+    def delete_index(self, expression):
+        for name in self.resolve(expression):
+            del self.indexes[name]
+            self.storage.drop(name)
+        return 200, {"acknowledged": True}
+
+    def get_document(self, name, doc_id):
+        self.resolve(name)
+        document = self.storage.get(name, doc_id)
+        if document is None:
+            return 404, {"_index": name, "_id": doc_id, "found": False}
+        return 200, {"_index": name, "_id": doc_id, "_version": 1, "found": True, "_source": document}
+
+    def index_document(self, name, doc_id, document):
+        if self.reject():
+            raise self.rejection("index request")
+        status, result = self.put(name, doc_id, document)
+        if status >= 400:
+            raise MockError(status, result["type"], result["reason"])
+        return status, result
+
+    def put(self, name, doc_id, document):
+        """ Store a single document, creating the index if necessary,
+        and return a (status, result) tuple for the operation.
+        """
+        if not isinstance(document, dict):
+            return 400, {"type": "mapper_parsing_exception", "reason": "failed to parse"}
+        if name not in self.indexes:
+            self.create_index(name, None)
+        index = self.indexes[name]
+        try:
+            if index.check_document(document):
+                self.storage.save_index(name, index.metadata())
+        except MockError as error:
+            return error.status, {"type": error.error_type, "reason": error.reason}
+        if doc_id is None:
+            doc_id = urlsafe_b64encode(urandom(15)).decode("ascii")
+        created = self.storage.put(name, doc_id, document)
+        return (201 if created else 200), {
+            "_index": name, "_id": doc_id, "_version": 1,
+            "result": "created" if created else "updated",
+            "_shards": {"total": 1, "successful": 1, "failed": 0},
+            "_seq_no": next(self.sequence), "_primary_term": 1,
+        }
+
+    def bulk(self, default_index, data):
+        items = []
+        lines = iter(line for line in data.splitlines() if line.strip())
+        for line in lines:
+            action = loads(line)
+            (op, meta), = action.items()
+            name = meta.get("_index", default_index)
+            doc_id = meta.get("_id")
+            if op in ("index", "create"):
+                document = loads(next(lines))
+            elif op == "update":
+                update = loads(next(lines))
+                document = dict(self.storage.get(name, doc_id) or {}, **update.get("doc", {}))
+            elif op == "delete":
+                items.append({op: {"_index": name, "_id": doc_id, "status": 404, "result": "not_found"}})
+                continue
+            else:
+                raise MockError(400, "illegal_argument_exception", "Malformed action/metadata line")
+            if name is None:
+                status, result = 400, {"type": "action_request_validation_exception",
+                                       "reason": "Validation Failed: 1: index is missing;"}
+            elif self.reject():
+                status, result = 429, {"type": "es_rejected_execution_exception",
+                                       "reason": "rejected execution of bulk item (simulated by escli.mock)"}
+            elif op == "create" and doc_id is not None and self.storage.get(name, doc_id) is not None:
+                status, result = 409, {"type": "version_conflict_engine_exception",
+                                       "reason": "[%s]: version conflict, document already exists" % doc_id}
+            else:
+                status, result = self.put(name, doc_id, document)
+            if status >= 400:
+                result = {"_index": name, "_id": doc_id, "status": status, "error": result}
+            else:
+                result["status"] = status
+            items.append({op: result})
+        if not items:
+            raise MockError(400, "action_request_validation_exception",
+                            "Validation Failed: 1: no requests added;")
+        return 200, {"took": 0, "errors": any(item[op]["status"] >= 400
+                                              for item in items for op in item), "items": items}
+
+    def search(self, expression, params, body):
+        if self.reject():
+            raise self.rejection("search request")
+        body = dict(body or {})
+        for key in ("from", "size"):
+            if key in params:
+                body[key] = int(params[key])
+        pit = body.get("pit")
+        sort = normalize_sort(body.get("sort", params.get("sort")))
+        if pit and sort and "_shard_doc" not in [field for field, _ in sort]:
+            sort.append(("_shard_doc", "asc"))
+        query = body.get("query")
+        slicing = body.get("slice")
+        key = dumps([query, sort, slicing], sort_keys=True)
+        if pit:
+            context = self.contexts.get(pit["id"])
+            if not isinstance(context, PointInTime):
+                raise MockError(404, "search_context_missing_exception", "No search context found for id [%s]" % pit["id"])
+            hits, keys = context.results.get(key, lambda: select(context.documents, query, sort, slicing))
+        else:
+            hits, keys = self.results.get(dumps(self.resolve(expression)) + key,
+                                          lambda: select(self.documents(expression, query), query, sort, slicing))
+        total = len(hits)
+        start = body.get("from", 0)
+        size = body.get("size", 10)
+        if body.get("search_after") is not None:
+            if not sort:
+                raise MockError(400, "illegal_argument_exception", "Sort must contain at least one field.")
+            start += bisect_right(keys, SortKey(body["search_after"], sort))
+        result = {"took": 0, "timed_out": False, "_shards": shards(),
+                  "hits": {"total": {"value": total, "relation": "eq"},
+                           "max_score": None if sort else (1.0 if hits else None), "hits": []}}
+        if pit:
+            result["pit_id"] = pit["id"]
+        if "aggs" in body or "aggregations" in body:
+            result["aggregations"] = aggregate(body.get("aggs") or body.get("aggregations"), hits)
+        renderer = HitRenderer(body, params, sort)
+        if "scroll" in params:
+            scroll_id = new_context_id()
+            self.contexts[scroll_id] = (renderer, hits, start + size, size)
+            result["_scroll_id"] = scroll_id
+        result["hits"]["hits"] = [renderer.render(doc) for doc in hits[start:start + size]]
+        return 200, result
+
+    def scroll(self, body, params):
+        scroll_id = (body or {}).get("scroll_id") or params.get("scroll_id")
+        if scroll_id not in self.contexts:
+            raise MockError(404, "search_context_missing_exception", "No search context found for id [%s]" % scroll_id)
+        renderer, hits, start, size = self.contexts[scroll_id]
+        self.contexts[scroll_id] = (renderer, hits, start + size, size)
+        return 200, {"_scroll_id": scroll_id, "took": 0, "timed_out": False, "_shards": shards(),
+                     "hits": {"total": {"value": len(hits), "relation": "eq"}, "max_score": None,
+                              "hits": [renderer.render(doc) for doc in hits[start:start + size]]}}
+
+    def clear_scroll(self, body):
+        scroll_ids = (body or {}).get("scroll_id") or []
+        if isinstance(scroll_ids, str):
+            scroll_ids = [scroll_ids]
+        freed = sum(1 for scroll_id in scroll_ids if self.contexts.pop(scroll_id, None) is not None)
+        return 200, {"succeeded": True, "num_freed": freed}
+
+    def open_pit(self, expression, params):
+        pit_id = new_context_id()
+        self.contexts[pit_id] = PointInTime(list(self.documents(expression)))
+        return 200, {"id": pit_id}
+
+    def close_pit(self, body):
+        freed = 1 if self.contexts.pop((body or {}).get("id"), None) is not None else 0
+        return 200, {"succeeded": True, "num_freed": freed}
+
+    def msearch(self, default_index, data):
+        responses = []
+        lines = iter(line for line in data.splitlines() if line.strip())
+        for line in lines:
+            header = loads(line)
+            body = loads(next(lines))
+            index = header.get("index", default_index) or "_all"
+            if isinstance(index, list):
+                index = ",".join(index)
+            try:
+                status, result = self.search(index, {}, body)
+            except MockError as error:
+                status, result = error.status, error.to_dict()
+            result["status"] = status
+            responses.append(result)
+        return 200, {"took": 0, "responses": responses}
+
+    def cluster_state(self, expression):
+        return 200, {"cluster_name": "escli-mock", "metadata": {"indices": {
+            name: {"state": "open", "settings": unflatten(index.settings),
+                   "mappings": {"_doc": index.mappings},
+                   "mapping_version": index.mapping_version,
+                   "settings_version": index.settings_version}
+            for name, index in self.indexed(expression)}}}
+
+
+class Document:
+    """ A stored document, together with the name of its index and its
+    position within that index.
+    """
+
+    __slots__ = ("index", "id", "source", "seq")
+
+    def __init__(self, index, doc_id, source, seq):
+        self.index = index
+        self.id = doc_id
+        self.source = source
+        self.seq = seq
+
+
+class PointInTime:
+    """ Snapshot of the documents in a set of indexes, together with a
+    cache of the sorted results of searches made against it.
+    """
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.results = ResultCache()
+
+
+def select(documents, query, sort, slicing=None):
+    """ Select the documents that match a query, in sorted order,
+    returning a list of documents and a corresponding list of sort keys
+    (or None, if there is no sort).
+    """
+    hits = [doc for doc in documents if matches(query, doc)]
+    if slicing:
+        slice_id, slice_max = slicing["id"], slicing["max"]
+        hits = [doc for doc in hits if crc32(doc.id.encode("utf-8")) % slice_max == slice_id]
+    if not sort:
+        return hits, None
+    keyed = sorted(((SortKey(sort_values(doc, sort), sort), doc) for doc in hits), key=itemgetter(0))
+    return [doc for _, doc in keyed], [key for key, _ in keyed]
+
+
+class HitRenderer:
+    """ Renders documents as search hits, applying the source filtering
+    and field retrieval options of a search request.
+    """
+
+    def __init__(self, body, params, sort):
+        self.sort = sort
+        source = body.get("_source", params.get("_source", True))
+        self.includes = split_patterns(params.get("_source_includes"))
+        self.excludes = split_patterns(params.get("_source_excludes"))
+        if isinstance(source, dict):
+            self.includes += split_patterns(source.get("includes"))
+            self.excludes += split_patterns(source.get("excludes"))
+            source = True
+        elif isinstance(source, (str, list)) and source not in ("true", "false"):
+            self.includes += split_patterns(source)
+            source = True
+        stored_fields = split_patterns(body.get("stored_fields", params.get("stored_fields")))
+        self.stored_fields = [] if stored_fields == ["_none_"] else stored_fields
+        if stored_fields and "_source" not in body and "_source" not in params:
+            source = False
+        self.source = source not in (False, "false")
+        self.docvalue_fields = [field if isinstance(field, str) else field["field"]
+                                for field in split_patterns(body.get("docvalue_fields",
+                                                                     params.get("docvalue_fields")))]
+        self.fields = [field if isinstance(field, str) else field["field"]
+                       for field in body.get("fields") or ()]
+
+    def render(self, doc):
+        hit = {"_index": doc.index, "_id": doc.id, "_score": None if self.sort else 1.0}
+        if self.source:
+            hit["_source"] = filter_source(doc.source, self.includes, self.excludes)
+        fields = {}
+        for pattern in self.docvalue_fields + self.stored_fields + self.fields:
+            for path, values in flatten_values(doc.source).items():
+                if fnmatchcase(path, pattern) or fnmatchcase(path + ".keyword", pattern):
+                    fields[path if fnmatchcase(path, pattern) else path + ".keyword"] = values
+        if fields:
+            hit["fields"] = fields
+        if self.sort:
+            hit["sort"] = sort_values(doc, self.sort)
+        return hit
+
+
+class SortKey:
+    """ Comparable key for a list of sort values, honouring the sort
+    order of each field. Missing values always sort last.
+    """
+
+    __slots__ = ("values", "orders")
+
+    def __init__(self, values, sort):
+        self.values = values
+        self.orders = [order for _, order in sort]
+
+    def __compare(self, other):
+        for a, b, order in zip(self.values, other.values, self.orders):
+            if a == b:
+                continue
+            if a is None:
+                return 1
+            if b is None:
+                return -1
+            try:
+                result = -1 if a < b else 1
+            except TypeError:
+                result = -1 if str(a) < str(b) else 1
+            return -result if order == "desc" else result
+        return 0
+
+    def __lt__(self, other):
+        return self.__compare(other) < 0
+
+    def __gt__(self, other):
+        return self.__compare(other) > 0
+
+    def __eq__(self, other):
+        return self.__compare(other) == 0
+
+
+def load_json(data):
+    return loads(data) if data and data.strip() else None
+
+
+def shards(total=1):
+    return {"total": total, "successful": total, "skipped": 0, "failed": 0}
+
+
+def new_context_id():
+    return urlsafe_b64encode(urandom(24)).decode("ascii")
+
+
+def flatten(settings, prefix=""):
+    """ Flatten a nested settings dictionary into dotted keys.
+    """
+    flat = {}
+    for key, value in settings.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def unflatten(settings):
+    """ Expand a dictionary of dotted keys into nested dictionaries.
+    """
+    nested = {}
+    for key, value in settings.items():
+        *parents, leaf = key.split(".")
+        node = nested
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[leaf] = value
+    return nested
+
+
+def split_patterns(value):
+    if not value:
+        return []
+    elif isinstance(value, str):
+        return value.split(",")
+    else:
+        return list(value)
+
+
+def dynamic_field_type(value):
+    """ Return the field type that dynamic mapping would select for a
+    value, or None if the value does not determine a type.
+    """
+    if isinstance(value, bool):
+        return "boolean"
+    elif isinstance(value, int):
+        return "long"
+    elif isinstance(value, float):
+        return "float"
+    elif isinstance(value, str):
+        return "date" if parse_date(value) is not None else "text"
+    elif isinstance(value, dict):
+        return "object"
+    elif isinstance(value, list):
+        for item in value:
+            field_type = dynamic_field_type(item)
+            if field_type is not None:
+                return field_type
+    return None
+
+
+def map_fields(properties, document, prefix):
+    """ Check the fields of a document against a set of mapping
+    properties, adding dynamic mappings for any fields not already
+    mapped. Raises a MockError if a value cannot be indexed.
+    """
+    changed = False
+    for key, value in document.items():
+        path = prefix + key
+        field = properties.get(key)
+        if field is None:
+            field_type = dynamic_field_type(value)
+            if field_type is None:
+                continue
+            elif field_type == "object":
+                field = properties[key] = {"properties": {}}
+            elif field_type == "text":
+                field = properties[key] = {"type": "text",
+                                           "fields": {"keyword": {"type": "keyword", "ignore_above": 256}}}
+            else:
+                field = properties[key] = {"type": field_type}
+            changed = True
+        for item in (value if isinstance(value, list) else [value]):
+            if item is None:
+                continue
+            elif field.get("type", "object") in ("object", "nested"):
+                if not isinstance(item, dict):
+                    raise MockError(400, "document_parsing_exception",
+                                    "object mapping for [%s] tried to parse field [%s] as object, "
+                                    "but found a concrete value" % (path, key))
+                changed = map_fields(field.setdefault("properties", {}), item, path + ".") or changed
+            elif not check_value(field["type"], item):
+                raise MockError(400, "document_parsing_exception",
+                                "failed to parse field [%s] of type [%s]" % (path, field["type"]))
+    return changed
+
+
+def check_value(field_type, value):
+    """ Check whether a value can be indexed into a field of a given
+    type, allowing for the same coercions that Elasticsearch applies.
+    """
+    if isinstance(value, dict):
+        return False
+    elif value == "" and field_type in NUMERIC_TYPES:
+        # Empty strings are indexed as null values for numeric fields.
+        return True
+    elif field_type in ("long", "integer", "short", "byte", "unsigned_long"):
+        try:
+            return not isinstance(value, bool) and float(value) == int(float(value))
+        except (TypeError, ValueError):
+            return False
+    elif field_type in ("double", "float", "half_float", "scaled_float"):
+        try:
+            return not isinstance(value, bool) and float(value) == float(value)
+        except (TypeError, ValueError):
+            return False
+    elif field_type == "boolean":
+        return value in (True, False, "true", "false", "")
+    elif field_type == "date":
+        return parse_date(value) is not None
+    else:
+        return True
+
+
+def parse_date(value):
+    """ Parse a date value, given as epoch milliseconds or an ISO 8601
+    string, returning a timezone-aware datetime or None.
+    """
+    if isinstance(value, bool):
+        return None
+    elif isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1000, timezone.utc)
+    elif isinstance(value, str) and len(value) >= 10 and value[4:5] == "-":
+        try:
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    return None
+
+
+def field_values(source, path):
+    """ Return a list of all values held under a dotted field path,
+    flattening any arrays.
+    """
+    values = []
+    stack = [(source, path)]
+    while stack:
+        node, remaining = stack.pop()
+        if isinstance(node, list):
+            stack.extend((item, remaining) for item in reversed(node))
+        elif not remaining:
+            if node is not None:
+                values.append(node)
+        elif isinstance(node, dict):
+            if remaining in node:
+                stack.append((node[remaining], ""))
+            else:
+                key, _, rest = remaining.partition(".")
+                if key in node:
+                    stack.append((node[key], rest))
+    if not values and path.endswith(".keyword"):
+        return field_values(source, path[:-8])
+    return values
+
+
+def flatten_values(source, prefix=""):
+    """ Return a dictionary mapping each dotted leaf path in a document
+    to the list of values held under it.
+    """
+    flat = {}
+    for key, value in source.items():
+        path = prefix + key
+        for item in (value if isinstance(value, list) else [value]):
+            if isinstance(item, dict):
+                for sub_path, sub_values in flatten_values(item, path + ".").items():
+                    flat.setdefault(sub_path, []).extend(sub_values)
+            elif item is not None:
+                flat.setdefault(path, []).append(item)
+    return flat
+
+
+def filter_source(source, includes, excludes, prefix=""):
+    """ Apply _source includes and excludes patterns to a document.
+    """
+    if not includes and not excludes:
+        return source
+    result = {}
+    for key, value in source.items():
+        path = prefix + key
+        if any(fnmatchcase(path, pattern) for pattern in excludes):
+            continue
+        if not includes or any(fnmatchcase(path, pattern) for pattern in includes):
+            if isinstance(value, dict) and excludes:
+                value = filter_source(value, [], excludes, path + ".")
+            result[key] = value
+        elif isinstance(value, dict):
+            value = filter_source(value, includes, excludes, path + ".")
+            if value:
+                result[key] = value
+    return result
+
+
+def values_equal(a, b):
+    if a == b:
+        return True
+    elif isinstance(a, str) and isinstance(b, str):
+        return False
+    elif isinstance(a, bool) or isinstance(b, bool):
+        return str(a).lower() == str(b).lower()
+    try:
+        return float(a) == float(b)
+    except (TypeError, ValueError):
+        return False
+
+
+def compare(a, b):
+    """ Compare two values for a range query, coercing numeric strings
+    and dates where necessary.
+    """
+    if isinstance(a, (int, float)) or isinstance(b, (int, float)):
+        try:
+            a, b = float(a), float(b)
+        except (TypeError, ValueError):
+            a, b = str(a), str(b)
+    elif parse_date(a) is not None and parse_date(b) is not None:
+        a, b = parse_date(a), parse_date(b)
+    return (a > b) - (a < b)
+
+
+def tokens(value):
+    return WORD.findall(str(value).lower())
+
+
+def field_spec(spec, key="value"):
+    """ Unpack a leaf query of the form {field: value} or
+    {field: {key: value, ...}}, returning (field, value, options).
+    """
+    options = {name: value for name, value in spec.items() if name not in ("boost", "_name")}
+    (field, value), = options.items()
+    if isinstance(value, dict):
+        return field, value.get(key), value
+    return field, value, {}
+
+
+def matches(query, doc):
+    """ Evaluate a query against a stored document.
+    """
+    if not query:
+        return True
+    (query_type, spec), = query.items()
+    source = doc.source
+    if query_type == "match_all":
+        return True
+    elif query_type == "match_none":
+        return False
+    elif query_type == "bool":
+        for clause_type in ("must", "filter"):
+            clauses = spec.get(clause_type) or []
+            if isinstance(clauses, dict):
+                clauses = [clauses]
+            if not all(matches(clause, doc) for clause in clauses):
+                return False
+        must_not = spec.get("must_not") or []
+        if isinstance(must_not, dict):
+            must_not = [must_not]
+        if any(matches(clause, doc) for clause in must_not):
+            return False
+        should = spec.get("should") or []
+        if isinstance(should, dict):
+            should = [should]
+        default = 0 if spec.get("must") or spec.get("filter") else 1
+        minimum = int(spec.get("minimum_should_match", default if should else 0))
+        return sum(1 for clause in should if matches(clause, doc)) >= minimum
+    elif query_type == "ids":
+        return doc.id in spec.get("values", [])
+    elif query_type == "exists":
+        return bool(field_values(source, spec["field"]))
+    elif query_type in ("match", "match_phrase"):
+        field, value, options = field_spec(spec, "query")
+        values = field_values(source, field)
+        if not all(isinstance(v, str) for v in values):
+            return any(values_equal(v, value) for v in values)
+        if query_type == "match_phrase":
+            phrase = " ".join(tokens(value))
+            return any(phrase in " ".join(tokens(v)) for v in values)
+        wanted = set(tokens(value))
+        found = set(token for v in values for token in tokens(v))
+        if options.get("operator", "or").lower() == "and":
+            return wanted <= found
+        return bool(wanted & found)
+    elif query_type == "term":
+        field, value, _ = field_spec(spec)
+        return any(values_equal(v, value) for v in field_values(source, field))
+    elif query_type == "terms":
+        field, values, _ = field_spec(spec)
+        return any(values_equal(v, value) for v in field_values(source, field) for value in values)
+    elif query_type == "range":
+        field, _, bounds = field_spec(spec)
+        tests = {"gt": lambda c: c > 0, "gte": lambda c: c >= 0, "lt": lambda c: c < 0, "lte": lambda c: c <= 0}
+        return any(all(test(compare(v, bounds[op])) for op, test in tests.items() if op in bounds)
+                   for v in field_values(source, field))
+    elif query_type in ("prefix", "wildcard"):
+        field, value, options = field_spec(spec)
+        pattern = value + "*" if query_type == "prefix" else value
+        if options.get("case_insensitive"):
+            return any(fnmatchcase(str(v).lower(), pattern.lower()) for v in field_values(source, field))
+        return any(fnmatchcase(str(v), pattern) for v in field_values(source, field))
+    raise MockError(400, "parsing_exception", "unknown query [%s]" % query_type)
+
+
+def normalize_sort(sort):
+    """ Normalize a sort specification into a list of (field, order)
+    tuples.
+    """
+    if not sort:
+        return []
+    if isinstance(sort, (str, dict)):
+        sort = sort.split(",") if isinstance(sort, str) else [sort]
+    normalized = []
+    for item in sort:
+        if isinstance(item, str):
+            field, _, order = item.partition(":")
+            normalized.append((field, order or ("desc" if field == "_score" else "asc")))
+        else:
+            for field, order in item.items():
+                if isinstance(order, dict):
+                    order = order.get("order", "asc")
+                normalized.append((field, order))
+    return normalized
+
+
+def sort_values(doc, sort):
+    values = []
+    for field, order in sort:
+        if field in ("_doc", "_shard_doc"):
+            values.append(doc.seq)
+        elif field == "_score":
+            values.append(1.0)
+        else:
+            found = field_values(doc.source, field)
+            try:
+                found = sorted(found)
+            except TypeError:
+                found = sorted(found, key=str)
+            values.append((found[-1] if order == "desc" else found[0]) if found else None)
+    return values
+
+
+INTERVALS = {
+    "ms": 1, "s": 1000, "m": 60000, "h": 3600000, "d": 86400000,
+    "second": 1000, "minute": 60000, "hour": 3600000, "day": 86400000,
+}
+
+CALENDAR_UNITS = {"w": "week", "M": "month", "q": "quarter", "y": "year",
+                  "week": "week", "month": "month", "quarter": "quarter", "year": "year"}
+
+
+def date_bucket(value, interval):
+    """ Return the key, in epoch milliseconds, of the date histogram
+    bucket into which a value falls.
+    """
+    moment = parse_date(value)
+    if moment is None:
+        return None
+    moment = moment.astimezone(timezone.utc)
+    match = re_compile(r"^(\d*)(\w+)$").match(interval)
+    multiple, unit = int(match.group(1) or 1), match.group(2)
+    if unit in CALENDAR_UNITS:
+        unit = CALENDAR_UNITS[unit]
+        day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+        if unit == "week":
+            floor = day - timedelta(days=day.weekday())
+        elif unit == "month":
+            floor = day.replace(day=1)
+        elif unit == "quarter":
+            floor = day.replace(month=(day.month - 1) // 3 * 3 + 1, day=1)
+        else:
+            floor = day.replace(month=1, day=1)
+        return int(floor.timestamp() * 1000)
+    if unit not in INTERVALS:
+        raise MockError(400, "illegal_argument_exception", "Unsupported interval [%s]" % interval)
+    size = multiple * INTERVALS[unit]
+    return int(moment.timestamp() * 1000) // size * size
+
+
+def format_date(millis):
+    moment = datetime.fromtimestamp(millis / 1000, timezone.utc)
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (millis % 1000)
+
+
+def metric(metric_type, spec, docs):
+    values = [v for doc in docs for v in field_values(doc.source, spec["field"])]
+    if metric_type == "value_count":
+        return {"value": len(values)}
+    elif metric_type == "cardinality":
+        return {"value": len(set(dumps(v) for v in values))}
+    numbers = []
+    for value in values:
+        try:
+            numbers.append(float(value))
+        except (TypeError, ValueError):
+            moment = parse_date(value)
+            if moment is not None:
+                numbers.append(moment.timestamp() * 1000)
+    stats = {
+        "count": len(numbers),
+        "min": min(numbers) if numbers else None,
+        "max": max(numbers) if numbers else None,
+        "avg": sum(numbers) / len(numbers) if numbers else None,
+        "sum": sum(numbers),
+    }
+    if metric_type == "stats":
+        return stats
+    return {"value": stats[metric_type]}
+
+
+def aggregate(aggs, docs):
+    """ Evaluate a dictionary of aggregations over a list of documents.
+    """
+    results = {}
+    for name, spec in aggs.items():
+        sub_aggs = spec.get("aggs") or spec.get("aggregations")
+        (agg_type, options), = ((key, value) for key, value in spec.items()
+                                if key not in ("aggs", "aggregations", "meta"))
+        if agg_type in ("stats", "avg", "sum", "min", "max", "value_count", "cardinality"):
+            results[name] = metric(agg_type, options, docs)
+        elif agg_type == "filter":
+            selected = [doc for doc in docs if matches(options, doc)]
+            results[name] = dict(aggregate(sub_aggs or {}, selected), doc_count=len(selected))
+        elif agg_type == "composite":
+            results[name] = composite(options, sub_aggs, docs)
+        elif agg_type in ("terms", "date_histogram", "histogram"):
+            groups = OrderedDict()
+            for doc in docs:
+                for key in set(dumps(key) for key in source_keys(agg_type, options, doc)):
+                    groups.setdefault(loads(key), []).append(doc)
+            buckets = [dict(aggregate(sub_aggs or {}, group), key=key, doc_count=len(group))
+                       for key, group in groups.items()]
+            if agg_type == "terms":
+                buckets.sort(key=lambda bucket: (-bucket["doc_count"], str(bucket["key"])))
+                size = options.get("size", 10)
+                results[name] = {"doc_count_error_upper_bound": 0,
+                                 "sum_other_doc_count": sum(bucket["doc_count"] for bucket in buckets[size:]),
+                                 "buckets": buckets[:size]}
+            else:
+                buckets.sort(key=lambda bucket: bucket["key"])
+                if agg_type == "date_histogram":
+                    for bucket in buckets:
+                        bucket["key_as_string"] = format_date(bucket["key"])
+                results[name] = {"buckets": buckets}
+        else:
+            raise MockError(400, "parsing_exception", "Unknown aggregation type [%s]" % agg_type)
+    return results
+
+
+def source_keys(agg_type, options, doc):
+    """ Return the bucket keys under which a document falls for a
+    bucket aggregation or composite source.
+    """
+    values = field_values(doc.source, options["field"])
+    if agg_type == "date_histogram":
+        interval = (options.get("calendar_interval") or options.get("fixed_interval")
+                    or options.get("interval"))
+        keys = [key for key in (date_bucket(value, interval) for value in values) if key is not None]
+        return [format_date(key) for key in keys] if options.get("format") else keys
+    elif agg_type == "histogram":
+        interval = options["interval"]
+        return [float(value) // interval * interval for value in values]
+    return values
+
+
+def composite(options, sub_aggs, docs):
+    sources = [(name, agg_type, spec) for source in options["sources"]
+               for name, definition in source.items() for agg_type, spec in definition.items()]
+    groups = {}
+    for doc in docs:
+        keys = []
+        for _, agg_type, spec in sources:
+            found = source_keys(agg_type, spec, doc)
+            keys.append([None] if not found and spec.get("missing_bucket") else found)
+        for combination in product(keys):
+            groups.setdefault(dumps(combination), []).append(doc)
+    orders = [(name, spec.get("order", "asc")) for name, _, spec in sources]
+    ordered = sorted(((loads(key), group) for key, group in groups.items()),
+                     key=lambda item: SortKey(item[0], orders))
+    if options.get("after"):
+        after = SortKey([options["after"].get(name) for name, _, _ in sources], orders)
+        ordered = [item for item in ordered if SortKey(item[0], orders) > after]
+    page = ordered[:options.get("size", 10)]
+    buckets = [dict(aggregate(sub_aggs or {}, group), doc_count=len(group),
+                    key={name: value for (name, _, _), value in zip(sources, key)})
+               for key, group in page]
+    result = {"buckets": buckets}
+    if buckets:
+        result["after_key"] = buckets[-1]["key"]
+    return result
+
+
+def product(lists):
+    combinations = [[]]
+    for values in lists:
+        combinations = [combination + [value] for combination in combinations for value in set_of(values)]
+    return combinations
+
+
+def set_of(values):
+    unique = []
+    for value in values:
+        if value not in unique:
+            unique.append(value)
+    return unique
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    """ HTTP request handler, passing each request through to the
+    MockElasticsearch service attached to the server.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_request(self):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query, keep_blank_values=True))
+        length = int(self.headers.get("Content-Length") or 0)
+        data = self.rfile.read(length).decode("utf-8") if length else ""
+        status, payload = self.server.service.handle(self.command, url.path, params, data)
+        body = b"" if payload is None else dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = do_request
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def serve(host="localhost", port=9200, storage=None, latency=0.0, reject_rate=0.0):
+    """ Create and return an HTTP server for a new stand-in service.
+    The server is returned without being started; call
+    `serve_forever` on it to start handling requests.
+    """
+    server = ThreadingHTTPServer((host, port), MockRequestHandler)
+    server.daemon_threads = True
+    server.service = MockElasticsearch(storage=storage, latency=latency, reject_rate=reject_rate)
+    return server
+
+
+def main():
+    parser = ArgumentParser(description="Run a local stand-in for an Elasticsearch service.")
+    parser.add_argument("-H", "--host", default="localhost",
+                        help="Host name or address on which to listen (default=localhost)")
+    parser.add_argument("-p", "--port", type=int, default=9200,
+                        help="Port on which to listen (default=9200)")
+    parser.add_argument("-d", "--database", metavar="FILE",
+                        help="SQLite database in which to store documents. If omitted, "
+                             "documents are held in memory.")
+    parser.add_argument("-l", "--latency", type=float, default=0.0,
+                        help="Latency to add to every request, in seconds (default=0)")
+    parser.add_argument("-r", "--reject-rate", type=float, default=0.0,
+                        help="Proportion of searches and writes to reject with a 429 "
+                             "status (default=0)")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Log every request")
+    args = parser.parse_args()
+    basicConfig(format="%(levelname)s: [%(name)s] %(message)s", level=DEBUG if args.verbose else INFO)
+    storage = SQLiteStorage(args.database) if args.database else MemoryStorage()
+    server = serve(args.host, args.port, storage=storage, latency=args.latency, reject_rate=args.reject_rate)
+    log.info("Listening on http://%s:%d" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
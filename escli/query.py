@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Compiler for compact query expressions.
+
+A query expression consists of one or more comparisons, combined with
+AND, OR and NOT, and grouped with parentheses where necessary. For
+example:
+
+    country=France AND price>=100 AND NOT (status==closed OR name~"tmp*")
+
+The following comparison operators are available:
+
+    FIELD=VALUE     full text match (scoring)
+    FIELD==VALUE    exact term match
+    FIELD!=VALUE    exact term non-match
+    FIELD>VALUE     range (also >=, < and <=)
+    FIELD~PATTERN   prefix or wildcard match, using '*' and '?'
+
+Only full text matches contribute to relevance scoring. All other
+comparisons are compiled into filter context, which allows them to be
+cached by the cluster.
+
+Values are compared as strings, except for the bounds of ranges, which
+are converted to numbers where they are written as plain decimals. An
+expression consisting of a single 'FIELD=VALUE' comparison that cannot
+otherwise be parsed, such as 'url=http://x/?a=b', is taken to be a full
+text match on everything after the first '='.
+"""
+
+
+from functools import lru_cache
+from math import isfinite
+from re import compile as re_compile, DOTALL
+
+
+TOKEN = re_compile(r"""\s*(?:(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|(?P<paren>[()])|"""
+                   r"""(?P<op>==|!=|>=|<=|=|>|<|~)|(?P<word>[^\s()=!<>~"']+))""")
+
+ESCAPE = re_compile(r"\\(.)")
+
+KEYWORDS = {"AND", "OR", "NOT"}
+
+KEYWORD = re_compile(r"(?:^|[\s()])(?:AND|OR|NOT)(?:[\s()]|$)")
+
+SIMPLE_MATCH = re_compile(r"^\s*([^\s()=!<>~\"']+)=(?!=)(.*)$", DOTALL)
+
+INTEGER = re_compile(r"^-?(?:0|[1-9]\d*)$")
+
+DECIMAL = re_compile(r"^-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?$")
+
+RANGE_OPERATORS = {">": "gt", ">=": "gte", "<": "lt", "<=": "lte"}
+
+
+@lru_cache(maxsize=256)
+def compile_query(expression):
+    """ Compile a query expression into an Elasticsearch query, or a
+    'match_all' query if no expression is given.
+
+    Compiled queries are memoized by expression string, and must
+    therefore not be modified by the caller.
+    """
+    if expression is None or not expression.strip():
+        return {"match_all": {}}
+    try:
+        node = Parser(tokenize(expression)).parse()
+    except ValueError:
+        # Fall back to the original 'FIELD=VALUE' form, in which the
+        # value is everything after the first '='.
+        match = SIMPLE_MATCH.match(expression)
+        if match and not KEYWORD.search(match.group(2)):
+            return {"match": {match.group(1): match.group(2)}}
+        raise
+    query = node.compile()
+    if node.scoring or ("bool" in query and "should" not in query["bool"]):
+        # Either scoring is required, or the query is already a bool
+        # consisting only of filter and must_not clauses.
+        return query
+    else:
+        return {"bool": {"filter": [query]}}
+
+
+def tokenize(expression):
+    """ Split a query expression into a list of (kind, text) tokens.
+    """
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if not match:
+            raise ValueError("Invalid query %r at position %d" % (expression, position))
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "string":
+            kind, text = "quoted", ESCAPE.sub(r"\1", text[1:-1])
+        elif kind == "word" and text in KEYWORDS:
+            kind = "keyword"
+        tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+class Parser:
+    """ Recursive descent parser for query expressions.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self, offset=0):
+        try:
+            return self.tokens[self.position + offset]
+        except IndexError:
+            return None, None
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def expect(self, kind, text=None):
+        token_kind, token_text = self.next()
+        if token_kind != kind or (text is not None and token_text != text):
+            raise ValueError("Invalid query: expected %s, found %r" % (text or kind, token_text))
+        return token_text
+
+    def parse(self):
+        node = self.parse_or()
+        kind, text = self.peek()
+        if kind is not None:
+            raise ValueError("Invalid query: unexpected %r" % text)
+        return node
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.peek() == ("keyword", "OR"):
+            self.next()
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else Or(nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while self.peek() == ("keyword", "AND"):
+            self.next()
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else And(nodes)
+
+    def parse_not(self):
+        if self.peek() == ("keyword", "NOT"):
+            self.next()
+            return Not(self.parse_not())
+        elif self.peek() == ("paren", "("):
+            self.next()
+            node = self.parse_or()
+            self.expect("paren", ")")
+            return node
+        else:
+            return self.parse_comparison()
+
+    def parse_comparison(self):
+        field = self.expect("word")
+        operator = self.expect("op")
+        kind, value = self.next()
+        if kind == "word":
+            if operator == "=":
+                # Unquoted full text values may contain spaces, for
+                # compatibility with the original 'FIELD=VALUE' form.
+                words = [value]
+                while self.peek()[0] == "word" and self.peek(1)[0] != "op":
+                    words.append(self.next()[1])
+                value = " ".join(words)
+            elif operator in RANGE_OPERATORS:
+                value = range_value(value)
+        elif kind != "quoted":
+            raise ValueError("Invalid query: expected value for field %r" % field)
+        return Comparison(field, operator, value)
+
+
+def range_value(text):
+    """ Convert an unquoted range bound to a number if it is written as
+    a plain decimal. Other values, such as dates, are passed through as
+    strings for the server to interpret.
+    """
+    if INTEGER.match(text):
+        return int(text)
+    elif DECIMAL.match(text) and isfinite(float(text)):
+        return float(text)
+    else:
+        return text
+
+
+class Comparison:
+
+    def __init__(self, field, operator, value):
+        self.field = field
+        self.operator = operator
+        self.value = value
+        self.scoring = operator == "="
+
+    def compile(self):
+        if self.operator == "=":
+            return {"match": {self.field: self.value}}
+        elif self.operator == "==":
+            return {"term": {self.field: self.value}}
+        elif self.operator == "!=":
+            return {"bool": {"must_not": [{"term": {self.field: self.value}}]}}
+        elif self.operator in RANGE_OPERATORS:
+            return {"range": {self.field: {RANGE_OPERATORS[self.operator]: self.value}}}
+        else:
+            pattern = str(self.value)
+            if pattern.endswith("*") and not any(ch in pattern[:-1] for ch in "*?"):
+                return {"prefix": {self.field: pattern[:-1]}}
+            else:
+                return {"wildcard": {self.field: {"value": pattern}}}
+
+
+class And:
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.scoring = any(node.scoring for node in nodes)
+
+    def compile(self):
+        clauses = {}
+        for node in self.nodes:
+            if isinstance(node, Not):
+                clauses.setdefault("must_not", []).append(node.node.compile())
+            elif node.scoring:
+                clauses.setdefault("must", []).append(node.compile())
+            else:
+                clauses.setdefault("filter", []).append(node.compile())
+        return {"bool": clauses}
+
+
+class Or:
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.scoring = any(node.scoring for node in nodes)
+
+    def compile(self):
+        return {"bool": {"should": [node.compile() for node in self.nodes], "minimum_should_match": 1}}
+
+
+class Not:
+
+    def __init__(self, node):
+        self.node = node
+        self.scoring = False
+
+    def compile(self):
+        return {"bool": {"must_not": [self.node.compile()]}}
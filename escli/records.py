@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Compact in-memory representation of search results.
+
+A `RecordBatch` holds a sequence of `Record` objects, each consisting
+of a tuple of keys and a tuple of values. Key tuples are shared between
+all records in a batch with the same set of fields, so that only the
+values are stored per record. This uses considerably less memory than
+one dictionary per record, for large result sets.
+"""
+
+
+from collections.abc import Mapping
+
+
+class Record(Mapping):
+    """ Immutable, read-only mapping of keys to values, backed by a pair
+    of tuples.
+    """
+
+    __slots__ = ("_keys", "_values")
+
+    def __init__(self, keys, values):
+        self._keys = keys
+        self._values = values
+
+    def __repr__(self):
+        return "Record(%r)" % self.to_dict()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._keys.index(key)]
+        except ValueError:
+            raise KeyError(key)
+
+    def keys(self):
+        return self._keys
+
+    def values(self):
+        return self._values
+
+    def items(self):
+        return zip(self._keys, self._values)
+
+    def to_dict(self):
+        return dict(zip(self._keys, self._values))
+
+
+class RecordBatch:
+    """ Sequence of records, sharing key tuples between records with
+    identical fields.
+    """
+
+    __slots__ = ("_key_tuples", "_records")
+
+    def __init__(self, records=()):
+        self._key_tuples = {}
+        self._records = []
+        for record in records:
+            self.append(record)
+
+    def __repr__(self):
+        return "RecordBatch(%r)" % self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __getitem__(self, index):
+        return self._records[index]
+
+    def append(self, data):
+        """ Append a record to the batch, copying the keys and values
+        from any mapping supplied.
+        """
+        self.add(tuple(data.keys()), tuple(data.values()))
+
+    def add(self, keys, values):
+        """ Append a record to the batch, given a tuple of keys and a
+        tuple of values.
+        """
+        keys = self._key_tuples.setdefault(keys, keys)
+        self._records.append(Record(keys, values))
+
+    def columns(self):
+        """ Return the union of the keys of all records in the batch,
+        in order of first appearance.
+        """
+        columns = {}
+        for keys in self._key_tuples:
+            columns.update(dict.fromkeys(keys))
+        return tuple(columns)
+
+    def rows(self, columns=None):
+        """ Iterate through the records, yielding a tuple of values for
+        each, aligned to the given columns (or to all columns, by
+        default). Missing values are returned as None.
+        """
+        columns = self.columns() if columns is None else tuple(columns)
+        positions = {}  # keyed by identity, as key tuples are shared
+        for record in self._records:
+            keys = record.keys()
+            if keys == columns:
+                yield record.values()
+                continue
+            try:
+                indexes = positions[id(keys)]
+            except KeyError:
+                lookup = {key: i for i, key in enumerate(keys)}
+                indexes = positions[id(keys)] = [lookup.get(column) for column in columns]
+            values = record.values()
+            yield tuple(None if i is None else values[i] for i in indexes)
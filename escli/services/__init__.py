@@ -73,20 +73,27 @@ class SPI:
     def init_client(self):
         self.__client = Client.create()
 
+    def create_client(self, env_prefix):
+        """ Create and return an additional client, configured from
+        environment variables with the given prefix, such as
+        'ESCLI_REMOTE' for ESCLI_REMOTE_ADDR, ESCLI_REMOTE_API_KEY, etc.
+        """
+        return Client.create(env_prefix)
+
 
 class Client(ABC):
     """ Base client abstraction.
     """
 
     @classmethod
-    def get_settings_from_env(cls, default_user="elastic"):
+    def get_settings_from_env(cls, default_user="elastic", prefix="ESCLI"):
         """ Build and return a dictionary of client keyword settings
         based on available environment variables.
         """
-        addr = getenv("ESCLI_ADDR")
-        user = getenv("ESCLI_USER", default_user)
-        password = getenv("ESCLI_PASSWORD")
-        api_key = getenv("ESCLI_API_KEY")
+        addr = getenv(prefix + "_ADDR")
+        user = getenv(prefix + "_USER", default_user)
+        password = getenv(prefix + "_PASSWORD")
+        api_key = getenv(prefix + "_API_KEY")
         settings = {}
         if addr:
             settings["hosts"] = addr.split(",")
@@ -97,17 +104,58 @@ class Client(ABC):
         return settings
 
     @classmethod
-    def create(cls):
+    def create(cls, env_prefix="ESCLI"):
         from escli.services.elasticsearch import ElasticsearchClient
-        return ElasticsearchClient()
+        return ElasticsearchClient(env_prefix)
 
     def info(self):
         """ Return backend system information.
         """
         raise NotImplementedError
 
-    def search(self, target, query, fields=None, sort=None, page_size=10, page_number=1):
-        """ Carry out a search.
+    def search(self, target, query, fields=None, sort=None, page_size=10, page_number=1,
+               exclude_fields=None, docvalue_fields=None, stored_fields=None, raw=False):
+        """ Carry out a search, returning the matching documents as a
+        `RecordBatch`, or as a list of JSON-encoded bytes if `raw` is
+        true.
+
+        The `fields` and `exclude_fields` arguments control which parts
+        of each source document are returned. Doc values and stored
+        fields can also be requested, and are merged into the results,
+        unless raw results are requested.
+        """
+        raise NotImplementedError
+
+    def search_pages(self, target, query, fields=None, sort=None, page_size=10, page_number=1,
+                     page_count=None, exclude_fields=None, docvalue_fields=None, stored_fields=None,
+                     prefetch=2, raw=False):
+        """ Carry out a search over a number of consecutive pages,
+        starting at `page_number`, and yielding the results for each
+        page, as returned by `search`. If no page count is given, all remaining pages are
+        returned.
+
+        Up to `prefetch` pages are requested ahead of the page currently
+        being consumed, so that fetching pages overlaps with processing
+        them. A value of zero disables prefetching.
+        """
+        raise NotImplementedError
+
+    def multi_search(self, searches):
+        """ Carry out several searches in a single request. Each search is
+        described by a dictionary of keyword arguments, as accepted by the
+        `search` method. Return a list holding either the results or an
+        exception for each search, in order.
+        """
+        raise NotImplementedError
+
+    def aggregate(self, target, query, group_by=None, metrics=None, page_size=1000):
+        """ Carry out an aggregation, yielding one dictionary per group.
+
+        Groups are defined by a sequence of (field, interval) tuples, in
+        which the interval is None for grouping by distinct values, or a
+        date histogram interval such as '1d' or 'month'. Metrics are
+        defined by a sequence of (function, field) tuples. Groups are
+        retrieved from the backend in pages of `page_size`.
         """
         raise NotImplementedError
 
@@ -116,13 +164,38 @@ class Client(ABC):
         """
         raise NotImplementedError
 
+    def bulk(self, target, documents, ids=None):
+        """ Ingest a batch of documents in a single request, optionally
+        with explicit document IDs. Return a `BulkResult`.
+        """
+        raise NotImplementedError
+
+    def open_point_in_time(self, target, keep_alive="5m"):
+        """ Open a point in time against a target, returning its ID.
+        """
+        raise NotImplementedError
+
+    def close_point_in_time(self, pit_id):
+        """ Close a point in time.
+        """
+        raise NotImplementedError
+
+    def scan(self, pit_id, query=None, page_size=1000, slice_id=None, slice_count=None, keep_alive="5m"):
+        """ Iterate through all documents matching a query within a point
+        in time, yielding an (id, document) tuple for each. The scan can
+        be split into several independent slices, identified by
+        `slice_id` and `slice_count`.
+        """
+        raise NotImplementedError
+
     def get_indexes(self, include_all=False):
         """ Return a dict containing an entry for every available index.
         """
         raise NotImplementedError
 
-    def create_index(self, name):
-        """ Create a new index.
+    def create_index(self, name, mappings=None, settings=None):
+        """ Create a new index, optionally with explicit mappings and
+        settings.
         """
         raise NotImplementedError
 
@@ -131,6 +204,61 @@ class Client(ABC):
         """
         raise NotImplementedError
 
+    def get_mapping_versions(self, target):
+        """ Return a dictionary mapping the name of each index covered by
+        a target to a (uuid, mapping_version) tuple.
+        """
+        raise NotImplementedError
+
+    def get_mappings(self, target):
+        """ Return a dictionary mapping the name of each index covered by
+        a target to its mapping.
+        """
+        raise NotImplementedError
+
+    def get_index_settings(self, name):
+        """ Return a flat dictionary of the settings for an index.
+        """
+        raise NotImplementedError
+
+    def update_index_settings(self, name, settings):
+        """ Update the dynamic settings of an index. Settings with a
+        value of None are reset to their defaults.
+        """
+        raise NotImplementedError
+
+    def refresh_index(self, name):
+        """ Refresh an index, making all recent changes visible to search.
+        """
+        raise NotImplementedError
+
+    def force_merge_index(self, name):
+        """ Force a merge of the segments within an index.
+        """
+        raise NotImplementedError
+
+
+class BulkResult:
+    """ Outcome of a bulk request.
+
+    The `errors` attribute holds a list of (position, reason) tuples,
+    one for each document that could not be ingested. The remaining
+    attributes describe the cost of the request, summed over any
+    retries: the server-side processing time in milliseconds (`took`),
+    the round trip time in seconds (`latency`), the size of the request
+    bodies in bytes (`size`), and the number of items rejected by the
+    server as overloaded (`rejected`).
+    """
+
+    __slots__ = ("errors", "took", "latency", "size", "rejected")
+
+    def __init__(self, errors=(), took=0, latency=0.0, size=0, rejected=0):
+        self.errors = list(errors)
+        self.took = took
+        self.latency = latency
+        self.size = size
+        self.rejected = rejected
+
 
 class ClientConnectionError(Exception):
 
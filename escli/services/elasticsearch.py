@@ -16,11 +16,21 @@
 # limitations under the License.
 
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps, loads
 from logging import getLogger
+from queue import Full, Queue
+from threading import Event, Thread, local
+from time import monotonic, sleep
 
-from elasticsearch import Elasticsearch, ConnectionError, AuthenticationException, TransportError
+from elasticsearch import Elasticsearch, ApiError, ConnectionError, AuthenticationException, TransportError
+from elasticsearch.serializer import CompatibilityModeJsonSerializer, JsonSerializer
 
-from escli.services import Client, ClientConnectionError, ClientAuthError, ClientAPIError
+from escli.query import compile_query
+from escli.records import RecordBatch
+from escli.services import BulkResult, Client, ClientConnectionError, ClientAuthError, ClientAPIError
+from escli.services.hits import SearchResponse
 
 
 log = getLogger(__name__)
@@ -30,9 +40,31 @@ class ElasticsearchClient(Client):
     """ Client for use with Elasticsearch.
     """
 
-    def __init__(self):
+    def __init__(self, env_prefix="ESCLI"):
+        self._raw = local()
         with ElasticsearchExceptionWrapper():
-            self._client = Elasticsearch(**self.get_settings_from_env())
+            self._client = Elasticsearch(serializers={
+                RawJsonSerializer.mimetype: RawJsonSerializer(self._raw),
+                RawCompatibilityModeJsonSerializer.mimetype: RawCompatibilityModeJsonSerializer(self._raw),
+            }, **self.get_settings_from_env(prefix=env_prefix))
+
+    def _search_raw(self, body, target=None):
+        """ Carry out a search, returning a `SearchResponse` over the
+        undecoded response body. The client's JSON serializers are
+        switched to raw mode for the current thread only, so that the
+        request goes through the same transport and connection pool as
+        every other.
+        """
+        self._raw.enabled = True
+        try:
+            with ElasticsearchExceptionWrapper():
+                try:
+                    res = self._client.search(index=target, body=body)
+                except ApiError as ex:
+                    raise decode_api_error(ex) from None
+        finally:
+            self._raw.enabled = False
+        return SearchResponse(res.body)
 
     def info(self):
         with ElasticsearchExceptionWrapper():
@@ -42,35 +74,426 @@ class ElasticsearchClient(Client):
         pattern = "*" if include_all else "*,-.*"
         return self._client.indices.get(index=pattern)
 
-    def create_index(self, name):
-        self._client.indices.create(index=name)
+    def create_index(self, name, mappings=None, settings=None):
+        self._client.indices.create(index=name, mappings=mappings, settings=settings)
 
     def delete_index(self, name):
         self._client.indices.delete(index=name)
 
-    def search(self, target, query, fields=None, sort=None, page_size=10, page_number=1):
+    def get_mapping_versions(self, target):
         with ElasticsearchExceptionWrapper():
-            if query is None:
-                query = {"match_all": {}}
-            else:
-                field, _, value = query.partition("=")
-                query = {"match": {field: value}}
-            if sort:
-                if sort.startswith("~"):
-                    sort = {sort[1:]: "desc"}
+            res = self._client.cluster.state(metric="metadata", index=target, filter_path=[
+                "metadata.indices.*.mapping_version", "metadata.indices.*.settings.index.uuid"])
+        return {name: (index["settings"]["index"]["uuid"], int(index["mapping_version"]))
+                for name, index in res.get("metadata", {}).get("indices", {}).items()}
+
+    def get_mappings(self, target):
+        with ElasticsearchExceptionWrapper():
+            res = self._client.indices.get_mapping(index=target)
+        return {name: index["mappings"] for name, index in res.items()}
+
+    def get_index_settings(self, name):
+        with ElasticsearchExceptionWrapper():
+            res = self._client.indices.get_settings(index=name, flat_settings=True)
+        return dict(res[name]["settings"])
+
+    def update_index_settings(self, name, settings):
+        with ElasticsearchExceptionWrapper():
+            self._client.indices.put_settings(index=name, settings=settings)
+
+    def refresh_index(self, name):
+        with ElasticsearchExceptionWrapper():
+            self._client.indices.refresh(index=name)
+
+    def force_merge_index(self, name):
+        with ElasticsearchExceptionWrapper():
+            self._client.indices.forcemerge(index=name)
+
+    def search(self, target, query, fields=None, sort=None, page_size=10, page_number=1,
+               exclude_fields=None, docvalue_fields=None, stored_fields=None, raw=False):
+        body = build_search(query, fields=fields, sort=sort, page_size=page_size, page_number=page_number,
+                            exclude_fields=exclude_fields, docvalue_fields=docvalue_fields,
+                            stored_fields=stored_fields)
+        if raw:
+            # Hits are decoded one at a time, as they are output.
+            return (hit.get("_source", {}) for hit in self._search_raw(body, target).hits())
+        with ElasticsearchExceptionWrapper():
+            res = self._client.search(index=target, body=body)
+        return search_results(res)
+
+    def search_pages(self, target, query, fields=None, sort=None, page_size=10, page_number=1,
+                     page_count=None, exclude_fields=None, docvalue_fields=None, stored_fields=None,
+                     prefetch=2, raw=False):
+        search = dict(query=query, fields=fields, sort=sort, page_size=page_size, exclude_fields=exclude_fields,
+                      docvalue_fields=docvalue_fields, stored_fields=stored_fields, raw=raw)
+        last_page = None if page_count is None else page_number + page_count - 1
+        if last_page is not None and last_page * page_size <= MAX_RESULT_WINDOW:
+            # Pages within the result window are independent of one
+            # another, so can be requested concurrently.
+            return self._offset_pages(target, search, page_number, last_page, prefetch)
+        else:
+            # Beyond the result window, each page must be requested
+            # using a cursor taken from the previous page, so pages are
+            # read ahead in sequence by a background thread instead.
+            pages = self._cursor_pages(target, search, page_number, last_page)
+            return read_ahead(pages, prefetch) if prefetch else pages
+
+    def _search_page(self, target, page_number, search):
+        """ Request a single page by offset, returning a sized batch of
+        results rather than an iterator.
+        """
+        results = self.search(target, page_number=page_number, **search)
+        return results if isinstance(results, RecordBatch) else list(results)
+
+    def _offset_pages(self, target, search, first_page, last_page, prefetch):
+        """ Request pages by offset, keeping up to `prefetch` requests
+        in flight while each page is consumed.
+        """
+        if not prefetch:
+            for page_number in range(first_page, last_page + 1):
+                batch = self._search_page(target, page_number, search)
+                if not batch:
+                    break
+                yield batch
+            return
+        with ThreadPoolExecutor(max_workers=prefetch + 1) as executor:
+            pending = deque()
+            next_page = first_page
+            try:
+                while True:
+                    while len(pending) <= prefetch and next_page <= last_page:
+                        pending.append(executor.submit(self._search_page, target, next_page, search))
+                        next_page += 1
+                    if not pending:
+                        break
+                    batch = pending.popleft().result()
+                    if not batch:
+                        break
+                    yield batch
+                    if len(batch) < search["page_size"]:
+                        break
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _cursor_pages(self, target, search, first_page, last_page):
+        """ Request pages in sequence within a point in time, using the
+        sort values of the last hit on each page as a cursor for the
+        next. Pages before the first page requested are skipped.
+        """
+        search = dict(search)
+        raw = search.pop("raw")
+        body = build_search(**search)
+        del body["from"]
+        body["sort"] = [body["sort"], "_shard_doc"] if "sort" in body else ["_shard_doc"]
+        pit_id = self.open_point_in_time(target)
+        try:
+            page_number = 1
+            search_after = None
+            while last_page is None or page_number <= last_page:
+                body["pit"] = {"id": pit_id, "keep_alive": "5m"}
+                if search_after is not None:
+                    body["search_after"] = search_after
+                if raw:
+                    response = self._search_raw(body)
+                    hits = list(response.hits())
+                    results = [hit.get("_source", {}) for hit in hits]
+                    pit_id = response.get("pit_id", pit_id)
                 else:
-                    sort = {sort: "asc"}
+                    with ElasticsearchExceptionWrapper():
+                        res = self._client.search(body=body)
+                    hits = res["hits"]["hits"]
+                    results = search_results(res)
+                    pit_id = res.get("pit_id", pit_id)
+                search_after = hits[-1].get("sort") if hits else None
+                if results and page_number >= first_page:
+                    yield results
+                if len(results) < search["page_size"]:
+                    break
+                page_number += 1
+        finally:
+            self.close_point_in_time(pit_id)
+
+    def multi_search(self, searches):
+        operations = []
+        for search in searches:
+            search = dict(search)
+            operations.append({"index": search.pop("target")})
+            operations.append(build_search(**search))
+        with ElasticsearchExceptionWrapper():
+            res = self._client.msearch(searches=operations)
+        results = []
+        for response in res["responses"]:
+            if "error" in response:
+                error = response["error"]
+                results.append(ClientAPIError("API error: %s (%s)" % (error.get("type"), error.get("reason"))))
             else:
-                sort = None
-            res = self._client.search(index=target, query=query, _source_includes=fields or "*",
-                                      sort=sort, from_=(page_size * (page_number - 1)), size=page_size)
-        return [hit["_source"] for hit in res["hits"]["hits"]]
+                results.append(search_results(response))
+        return results
+
+    def aggregate(self, target, query, group_by=None, metrics=None, page_size=1000):
+        query = compile_query(query)
+        metric_aggs = {"m%d" % i: {function: {"field": field}}
+                       for i, (function, field) in enumerate(metrics or ())}
+        if not group_by:
+            with ElasticsearchExceptionWrapper():
+                res = self._client.search(index=target, query=query, size=0, track_total_hits=True,
+                                          aggs=metric_aggs or None)
+            row = {"count": res["hits"]["total"]["value"]}
+            row.update(metric_values(metrics, res.get("aggregations", {})))
+            yield row
+            return
+        sources = []
+        for field, interval in group_by:
+            if interval is None:
+                sources.append({field: {"terms": {"field": field, "missing_bucket": True}}})
+            else:
+                interval_key = "calendar_interval" if interval in CALENDAR_INTERVALS else "fixed_interval"
+                sources.append({field: {"date_histogram": {"field": field, interval_key: interval,
+                                                           "format": "strict_date_optional_time"}}})
+        composite = {"sources": sources, "size": page_size}
+        while True:
+            with ElasticsearchExceptionWrapper():
+                res = self._client.search(index=target, query=query, size=0, aggs={
+                    "groups": {"composite": composite, "aggs": metric_aggs},
+                })
+            groups = res["aggregations"]["groups"]
+            for bucket in groups["buckets"]:
+                row = dict(bucket["key"])
+                row["count"] = bucket["doc_count"]
+                row.update(metric_values(metrics, bucket))
+                yield row
+            if len(groups["buckets"]) < page_size or "after_key" not in groups:
+                break
+            composite["after"] = groups["after_key"]
 
     def ingest(self, target, document):
         with ElasticsearchExceptionWrapper():
             res = self._client.index(index=target, document=document)
         return res  # TODO: something more intelligent
 
+    def bulk(self, target, documents, ids=None, max_retries=3):
+        if ids is None:
+            ids = [None] * len(documents)
+        result = BulkResult()
+        positions = list(range(len(documents)))
+        for attempt in range(max_retries + 1):
+            body = []
+            for position in positions:
+                doc_id = ids[position]
+                if doc_id is None:
+                    body.append('{"index":{}}')
+                else:
+                    body.append(dumps({"index": {"_id": doc_id}}))
+                body.append(dumps(documents[position]))
+            payload = ("\n".join(body) + "\n").encode("utf-8")
+            t0 = monotonic()
+            with ElasticsearchExceptionWrapper():
+                res = self._client.bulk(index=target, operations=payload)
+            result.latency += monotonic() - t0
+            result.took += res.get("took", 0)
+            result.size += len(payload)
+            if not res["errors"]:
+                break
+            rejected = []
+            for position, item in zip(positions, res["items"]):
+                item_result = item["index"]
+                if item_result["status"] == 429:
+                    result.rejected += 1
+                if item_result["status"] == 429 and attempt < max_retries:
+                    rejected.append(position)
+                elif item_result["status"] >= 300:
+                    error = item_result.get("error", {})
+                    result.errors.append((position, "%s: %s" % (error.get("type"), error.get("reason"))))
+            if not rejected:
+                break
+            log.debug("Retrying %d rejected documents" % len(rejected))
+            sleep(0.5 * 2 ** attempt)
+            positions = rejected
+        result.errors.sort()
+        return result
+
+    def open_point_in_time(self, target, keep_alive="5m"):
+        with ElasticsearchExceptionWrapper():
+            return self._client.open_point_in_time(index=target, keep_alive=keep_alive)["id"]
+
+    def close_point_in_time(self, pit_id):
+        with ElasticsearchExceptionWrapper():
+            self._client.close_point_in_time(id=pit_id)
+
+    def scan(self, pit_id, query=None, page_size=1000, slice_id=None, slice_count=None, keep_alive="5m"):
+        query = compile_query(query)
+        search_after = None
+        while True:
+            pit = {"id": pit_id, "keep_alive": keep_alive}
+            with ElasticsearchExceptionWrapper():
+                res = self._client.search(pit=pit, query=query, size=page_size, sort=["_shard_doc"],
+                                          search_after=search_after,
+                                          slice=(None if slice_count is None else
+                                                 {"id": slice_id, "max": slice_count}))
+            pit_id = res.get("pit_id", pit_id)
+            hits = res["hits"]["hits"]
+            for hit in hits:
+                yield hit["_id"], hit["_source"]
+            if len(hits) < page_size:
+                break
+            search_after = hits[-1]["sort"]
+
+
+# Maximum number of hits that can be paged through by offset, matching
+# the default 'index.max_result_window' setting.
+MAX_RESULT_WINDOW = 10000
+
+CALENDAR_INTERVALS = {"minute", "1m", "hour", "1h", "day", "1d", "week", "1w",
+                      "month", "1M", "quarter", "1q", "year", "1y"}
+
+
+def build_search(query, fields=None, sort=None, page_size=10, page_number=1,
+                 exclude_fields=None, docvalue_fields=None, stored_fields=None):
+    """ Build the body of a search request.
+    """
+    body = {"query": compile_query(query), "from": page_size * (page_number - 1), "size": page_size}
+    source = {}
+    if fields:
+        source["includes"] = fields.split(",") if isinstance(fields, str) else list(fields)
+    if exclude_fields:
+        source["excludes"] = (exclude_fields.split(",") if isinstance(exclude_fields, str)
+                              else list(exclude_fields))
+    if source:
+        body["_source"] = source
+    if sort:
+        if sort.startswith("~"):
+            body["sort"] = {sort[1:]: "desc"}
+        else:
+            body["sort"] = {sort: "asc"}
+    if docvalue_fields:
+        body["docvalue_fields"] = docvalue_fields
+    if stored_fields:
+        body["stored_fields"] = stored_fields
+    return body
+
+
+def search_results(res):
+    """ Extract a batch of records from a search response.
+    """
+    batch = RecordBatch()
+    for hit in res["hits"]["hits"]:
+        data = hit_data(hit) if "fields" in hit else hit.get("_source", {})
+        batch.add(tuple(data), tuple(data.values()))
+    return batch
+
+
+def hit_data(hit):
+    """ Combine the _source of a search hit with any separately
+    retrieved fields, unwrapping single-valued fields.
+    """
+    data = dict(hit.get("_source", {}))
+    for field, values in hit.get("fields", {}).items():
+        data[field] = values[0] if len(values) == 1 else values
+    return data
+
+
+def read_ahead(iterator, size):
+    """ Consume an iterator in a background thread, yielding its items
+    in order while keeping up to `size` further items ready. Exceptions
+    raised by the iterator are re-raised to the caller. If the caller
+    stops early, the iterator is closed.
+    """
+    queue = Queue(maxsize=size)
+    stopped = Event()
+    end = object()
+
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+            except Full:
+                continue
+            else:
+                return True
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+        except Exception as ex:
+            put((end, ex))
+        else:
+            put((end, None))
+        finally:
+            iterator.close()
+
+    thread = Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def metric_values(metrics, aggregations):
+    """ Extract the values of metric aggregations into a dictionary,
+    keyed by 'function(field)'. Stats aggregations are expanded into
+    one entry per statistic.
+    """
+    values = {}
+    for i, (function, field) in enumerate(metrics or ()):
+        result = aggregations["m%d" % i]
+        if function == "stats":
+            for stat in ("count", "min", "max", "avg", "sum"):
+                values["%s(%s)" % (stat, field)] = result[stat]
+        else:
+            values["%s(%s)" % (function, field)] = result["value"]
+    return values
+
+
+def decode_api_error(error):
+    """ Return a copy of an API error raised in raw mode, with the error
+    body decoded, so that it is reported as it would be otherwise.
+    """
+    try:
+        body = loads(error.body)
+    except (TypeError, ValueError):
+        return error
+    message = str(body)
+    if isinstance(body, dict) and isinstance(body.get("error"), dict):
+        message = body["error"].get("type", message)
+    return type(error)(message=message, meta=error.meta, body=body)
+
+
+class RawModeSerializer:
+    """ Mixin for JSON serializers that leave responses undecoded, so
+    that they can be scanned incrementally, while raw mode is enabled
+    for the current thread.
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+
+    def loads(self, data):
+        if getattr(self.mode, "enabled", False):
+            return data
+        return super().loads(data)
+
+
+class RawJsonSerializer(RawModeSerializer, JsonSerializer):
+    """ JSON serializer with a raw mode.
+    """
+
+
+class RawCompatibilityModeJsonSerializer(RawModeSerializer, CompatibilityModeJsonSerializer):
+    """ Compatibility mode variant of `RawJsonSerializer`.
+    """
+
 
 class ElasticsearchExceptionWrapper:
     """ Wrapper to catch and promote exceptions to the appropriate level
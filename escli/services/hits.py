@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Incremental decoding of raw search responses.
+
+When search results are output as NDJSON, with no other fields merged
+into the source documents, the response need not be decoded in full
+before any output is written.
+
+A `SearchResponse` makes a single forward pass over the response text,
+using `JSONDecoder.raw_decode` to read one hit at a time, so that hits
+can be output as they are read. Members of the response other than the
+hits are decoded as they are passed. Responses for other output formats
+are decoded in full by the standard client instead.
+"""
+
+
+from json import JSONDecoder
+from re import compile as re_compile
+
+
+DECODER = JSONDecoder()
+
+WHITESPACE = re_compile(r"[ \t\n\r]*")
+
+
+class SearchResponse:
+    """ Raw search response, read in a single forward pass.
+    """
+
+    def __init__(self, data):
+        self.text = data.decode("utf-8") if isinstance(data, bytes) else data
+        self._position = 0
+        self._members = None
+
+    def get(self, key, default=None):
+        """ Return a top-level member of the response, other than the
+        hits. If the hits have not yet been read, they are read first.
+        """
+        if self._members is None:
+            for _ in self.hits():
+                pass
+        return self._members.get(key, default)
+
+    def hits(self):
+        """ Decode and yield each hit in turn. The hits can only be read
+        once.
+        """
+        if self._members is not None:
+            raise ValueError("Search response has already been read")
+        self._members = {}
+        for key in self._object_members():
+            if key != "hits":
+                self._members[key] = self._decode()
+                continue
+            for hits_key in self._object_members():
+                if hits_key != "hits":
+                    self._decode()
+                    continue
+                for _ in self._array_items():
+                    yield self._decode()
+
+    def _skip_whitespace(self):
+        self._position = WHITESPACE.match(self.text, self._position).end()
+
+    def _decode(self):
+        """ Decode the JSON value at the current position, moving the
+        position past it.
+        """
+        self._skip_whitespace()
+        value, self._position = DECODER.raw_decode(self.text, self._position)
+        return value
+
+    def _expect(self, *chars):
+        self._skip_whitespace()
+        ch = self.text[self._position:self._position + 1]
+        if ch not in chars:
+            raise ValueError("Invalid JSON at offset %d" % self._position)
+        self._position += 1
+        return ch
+
+    def _items(self, opening, closing, keyed):
+        self._expect(opening)
+        self._skip_whitespace()
+        if self.text[self._position:self._position + 1] == closing:
+            self._position += 1
+            return
+        while True:
+            if keyed:
+                key = self._decode()
+                self._expect(":")
+                yield key
+            else:
+                yield None
+            if self._expect(",", closing) == closing:
+                return
+
+    def _object_members(self):
+        """ Iterate through the keys of the JSON object at the current
+        position. After each key is yielded, the position is at the
+        start of its value, and the caller must read past the value
+        before the next key is requested.
+        """
+        return self._items("{", "}", True)
+
+    def _array_items(self):
+        """ Iterate through the items of the JSON array at the current
+        position, in the same way as `_object_members`.
+        """
+        return self._items("[", "]", False)
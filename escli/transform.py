@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Declarative document transforms.
+
+A `Transform` describes a set of changes to be made to each document,
+such as selecting, renaming and casting fields. The transform is
+compiled once into a Python function specialised for that set of
+changes, so that no per-field interpretation of the description is
+required as each document is processed.
+
+Changes are applied in a fixed order:
+
+    1. fields are selected by inclusion or removed by exclusion
+    2. fields are renamed
+    3. field values are cast to other types
+    4. timestamp fields are parsed and converted to ISO 8601 strings
+    5. constant fields are set
+
+All fields are top-level fields. Casts and timestamp conversions are
+applied only to fields that are present and not null. Constant values
+are set exactly as given unless a cast is also given for the same
+field, in which case the cast is applied to the constant.
+"""
+
+
+from datetime import datetime, timezone
+
+from escli.io import simplify_type
+
+
+def cast_bool(value):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ("true", "yes", "1"):
+        return True
+    elif text in ("false", "no", "0"):
+        return False
+    else:
+        raise ValueError("Cannot interpret %r as a boolean" % value)
+
+
+def cast_auto(value):
+    return simplify_type(value) if isinstance(value, str) else value
+
+
+CASTS = {
+    "auto": cast_auto,
+    "bool": cast_bool,
+    "float": float,
+    "int": int,
+    "str": str,
+}
+
+
+def parse_epoch_second(value):
+    return datetime.fromtimestamp(float(value), timezone.utc).isoformat()
+
+
+def parse_epoch_millis(value):
+    return datetime.fromtimestamp(float(value) / 1000, timezone.utc).isoformat()
+
+
+def parse_iso(value):
+    text = str(value)
+    if text.endswith("Z"):
+        text = text[:-1] + "+00:00"
+    return datetime.fromisoformat(text).isoformat()
+
+
+def timestamp_parser(fmt):
+    """ Return a function to parse timestamps in the given format,
+    which can be 'iso', 'epoch_second', 'epoch_millis' or a format
+    string as accepted by `datetime.strptime`.
+    """
+    if fmt == "iso":
+        return parse_iso
+    elif fmt == "epoch_second":
+        return parse_epoch_second
+    elif fmt == "epoch_millis":
+        return parse_epoch_millis
+    else:
+
+        def parse(value):
+            return datetime.strptime(str(value), fmt).isoformat()
+
+        return parse
+
+
+class Transform:
+    """ Description of the changes to make to each document.
+
+    The `include` and `exclude` arguments are sequences of field names,
+    of which at most one may be given. The `rename`, `cast` and
+    `timestamps` arguments are sequences of pairs, mapping field names
+    to new names, cast types (see `CASTS`) and timestamp formats (see
+    `timestamp_parser`) respectively. Constant fields are given as a
+    sequence of (name, value) pairs.
+    """
+
+    @classmethod
+    def parse(cls, include=None, exclude=None, rename=(), cast=(), constants=(), timestamps=()):
+        """ Create a transform from command line style arguments, in
+        which field lists are comma-separated, and renames, casts,
+        constants and timestamps are given as 'OLD:NEW', 'FIELD:TYPE',
+        'FIELD=VALUE' and 'FIELD[:FORMAT]' strings respectively.
+        """
+
+        def split_pair(spec, separator, description, default=None):
+            key, found, value = spec.partition(separator)
+            if not key or (not found and default is None):
+                raise ValueError("Invalid %s %r" % (description, spec))
+            return key, (value if found else default)
+
+        return cls(include=(include.split(",") if include else None),
+                   exclude=(exclude.split(",") if exclude else None),
+                   rename=[split_pair(spec, ":", "rename") for spec in rename],
+                   cast=[split_pair(spec, ":", "cast") for spec in cast],
+                   constants=[split_pair(spec, "=", "constant field") for spec in constants],
+                   timestamps=[split_pair(spec, ":", "timestamp", "iso") for spec in timestamps])
+
+    def __init__(self, include=None, exclude=None, rename=(), cast=(), constants=(), timestamps=()):
+        if include is not None and exclude is not None:
+            raise ValueError("Fields cannot be both included and excluded")
+        for field, cast_type in cast:
+            if cast_type not in CASTS:
+                raise ValueError("Unknown cast type %r for field %r (expected one of %s)" % (
+                    cast_type, field, ", ".join(sorted(CASTS))))
+        self.include = None if include is None else list(include)
+        self.exclude = None if exclude is None else list(exclude)
+        self.rename = list(rename)
+        self.cast = list(cast)
+        self.constants = list(constants)
+        self.timestamps = list(timestamps)
+
+    def __bool__(self):
+        return bool(self.include is not None or self.exclude or self.rename or
+                    self.cast or self.constants or self.timestamps)
+
+    def source(self):
+        """ Generate the source code for the transform function.
+        """
+        lines = ["def transform(document):"]
+        if self.include is not None:
+            lines.append("    result = {}")
+            for field in self.include:
+                lines.append("    if %r in document:" % field)
+                lines.append("        result[%r] = document[%r]" % (field, field))
+        else:
+            lines.append("    result = document")
+            for field in self.exclude or ():
+                lines.append("    result.pop(%r, None)" % field)
+        for old, new in self.rename:
+            lines.append("    if %r in result:" % old)
+            lines.append("        result[%r] = result.pop(%r)" % (new, old))
+        for i, (field, _) in enumerate(self.cast):
+            lines.append("    value = result.get(%r)" % field)
+            lines.append("    if value is not None:")
+            lines.append("        result[%r] = cast_%d(value)" % (field, i))
+        for i, (field, _) in enumerate(self.timestamps):
+            lines.append("    value = result.get(%r)" % field)
+            lines.append("    if value is not None:")
+            lines.append("        result[%r] = timestamp_%d(value)" % (field, i))
+        for i, (field, _) in enumerate(self.constants):
+            lines.append("    result[%r] = constant_%d" % (field, i))
+        lines.append("    return result")
+        return "\n".join(lines) + "\n"
+
+    def compile(self):
+        """ Compile the transform into a function that accepts a single
+        document and returns the transformed document. The document
+        passed in may be modified in place.
+        """
+        namespace = {}
+        for i, (_, cast_type) in enumerate(self.cast):
+            namespace["cast_%d" % i] = CASTS[cast_type]
+        for i, (_, fmt) in enumerate(self.timestamps):
+            namespace["timestamp_%d" % i] = timestamp_parser(fmt)
+        casts = dict(self.cast)
+        for i, (field, value) in enumerate(self.constants):
+            if field in casts:
+                try:
+                    value = CASTS[casts[field]](value)
+                except (TypeError, ValueError) as ex:
+                    raise ValueError("Cannot cast constant value %r for field %r (%s)" % (value, field, ex))
+            namespace["constant_%d" % i] = value
+        exec(compile(self.source(), "<transform>", "exec"), namespace)
+        return namespace["transform"]
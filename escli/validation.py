@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Local validation of documents prior to ingestion.
+
+A `Validator` checks documents against either an Elasticsearch index
+mapping or a JSON Schema. In the same way as a `Transform`, the
+description is compiled once into a tree of checking functions, one per
+mapped field, so that each document is checked in a single pass over
+its fields.
+
+Checks against a mapping follow the behaviour of Elasticsearch with
+default settings: numbers and booleans may be supplied as strings, any
+field may hold an array of values, null values are ignored, and unknown
+fields are accepted unless the mapping is 'strict'. As for null, an
+empty string is accepted for a numeric or boolean field. Field types
+that cannot be checked locally are accepted as they are.
+
+Dates are checked against the default format for date fields,
+'strict_date_optional_time||epoch_millis', in which every part of a
+date after the year may be omitted. Numeric strings must be plain
+decimal numbers, optionally signed and with an exponent, and must be
+finite. A few values that Elasticsearch accepts are reported as
+invalid here: years outside the range 1 to 9999, numbers with
+surrounding whitespace, and numbers with a Java type suffix (such as
+'1d').
+
+Only a subset of JSON Schema is supported: the 'type', 'properties',
+'required', 'additionalProperties', 'items', 'enum' and 'format'
+keywords. Other keywords are ignored.
+"""
+
+
+from datetime import datetime
+from ipaddress import ip_address
+from json import dumps, load
+from math import isfinite
+from re import compile as re_compile
+
+from escli.mapping import DATE_PATTERN
+
+
+INTEGER_RANGES = {
+    "byte": (-2 ** 7, 2 ** 7 - 1),
+    "short": (-2 ** 15, 2 ** 15 - 1),
+    "integer": (-2 ** 31, 2 ** 31 - 1),
+    "long": (-2 ** 63, 2 ** 63 - 1),
+    "unsigned_long": (0, 2 ** 64 - 1),
+}
+
+FLOAT_TYPES = {"double", "float", "half_float", "scaled_float"}
+
+STRING_TYPES = {"keyword", "constant_keyword", "wildcard", "text", "match_only_text",
+                "search_as_you_type"}
+
+NUMBER_PATTERN = re_compile(r"[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?")
+
+# The 'strict_date_optional_time' format, as yyyy[-MM[-dd[THH[:mm[:ss[.S]]][zone]]]].
+DATE_FORMAT = re_compile(r"(\d{4})(?:-(\d{2})(?:-(\d{2})(?:T(\d{2})(?::(\d{2})(?::(\d{2})(?:[.,]\d{1,9})?)?)?"
+                         r"(?:Z|[+-]\d{2}(?::?\d{2})?)?)?)?)?")
+
+EPOCH_MILLIS_PATTERN = re_compile(r"-?\d+(?:\.\d+)?")
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_finite_number(value):
+    return is_number(value) and (isinstance(value, int) or isfinite(value))
+
+
+SCHEMA_TYPES = {
+    "array": lambda value: isinstance(value, list),
+    "boolean": lambda value: isinstance(value, bool),
+    "integer": lambda value: is_number(value) and float(value).is_integer(),
+    "null": lambda value: value is None,
+    "number": is_number,
+    "object": lambda value: isinstance(value, dict),
+    "string": lambda value: isinstance(value, str),
+}
+
+
+def describe(value):
+    """ Describe a value for use in a validation message.
+    """
+    if isinstance(value, dict):
+        return "an object"
+    elif isinstance(value, list):
+        return "an array"
+    text = dumps(value)
+    return text if len(text) <= 40 else text[:37] + "..."
+
+
+def to_number(value):
+    """ Convert a value to a number as Elasticsearch would, by default,
+    when indexing a numeric field, raising ValueError if this is not
+    possible. An empty string is treated as null, and so gives None.
+    """
+    if value == "":
+        return None
+    elif isinstance(value, str):
+        if not NUMBER_PATTERN.fullmatch(value):
+            raise ValueError
+        value = float(value)
+    if not is_finite_number(value):
+        raise ValueError
+    return value
+
+
+def number_check(field_type):
+    minimum, maximum = INTEGER_RANGES.get(field_type, (None, None))
+
+    def check(value):
+        try:
+            number = to_number(value)
+        except ValueError:
+            return "expected %s, found %s" % (field_type, describe(value))
+        if number is not None and minimum is not None and not minimum <= number <= maximum:
+            return "value %s is out of range for %s" % (describe(value), field_type)
+        return None
+
+    return check
+
+
+def boolean_check(value):
+    if isinstance(value, bool) or value in ("true", "false", ""):
+        return None
+    return "expected boolean, found %s" % describe(value)
+
+
+def is_default_date(text):
+    """ Return True if a string is a date in the default format for
+    date fields, either as an ISO 8601 date or as epoch milliseconds.
+    """
+    if EPOCH_MILLIS_PATTERN.fullmatch(text):
+        return True
+    match = DATE_FORMAT.fullmatch(text)
+    if not match:
+        return False
+    year, month, day, hour, minute, second = (int(part or 0) for part in match.groups())
+    try:
+        datetime(year, month or 1, day or 1, hour, minute, second)
+    except ValueError:
+        return False
+    return True
+
+
+def date_check(value):
+    if isinstance(value, str) and is_default_date(value):
+        return None
+    elif is_finite_number(value):
+        return None
+    return "expected date, found %s" % describe(value)
+
+
+def ip_check(value):
+    try:
+        ip_address(value)
+    except ValueError:
+        return "expected ip, found %s" % describe(value)
+    return None
+
+
+def string_check(value):
+    if isinstance(value, dict):
+        return "expected a concrete value, found an object"
+    return None
+
+
+def scalar_check(field):
+    """ Return a function to check a single value of a mapped field, or
+    None if values of the field's type are not checked.
+    """
+    field_type = field.get("type")
+    if field_type in INTEGER_RANGES or field_type in FLOAT_TYPES:
+        return number_check(field_type)
+    elif field_type == "boolean":
+        return boolean_check
+    elif field_type in ("date", "date_nanos"):
+        # Custom date formats cannot be checked locally, and so only
+        # fields using the default format are checked.
+        return date_check if "format" not in field else string_check
+    elif field_type == "ip":
+        return ip_check
+    elif field_type in STRING_TYPES:
+        return string_check
+    else:
+        return None
+
+
+def mapping_rule(field, path, strict):
+    """ Compile a rule for a mapped field. Each rule is a function that
+    takes a value and a list, and appends a message to the list for
+    each problem found with the value.
+    """
+    if field.get("type", "object") in ("object", "nested"):
+        if field.get("enabled") is False:
+            return None
+        if "dynamic" in field:
+            strict = field["dynamic"] == "strict"
+        return object_rule({key: mapping_rule(subfield, path + key + ".", strict)
+                            for key, subfield in field.get("properties", {}).items()},
+                           path, strict=strict, mapped=True)
+    check = scalar_check(field)
+    if check is None:
+        return None
+    name = path[:-1]
+
+    def rule(value, problems):
+        if isinstance(value, list):
+            for item in flatten(value):
+                if item is not None:
+                    reason = check(item)
+                    if reason:
+                        problems.append("field %r: %s" % (name, reason))
+        else:
+            reason = check(value)
+            if reason:
+                problems.append("field %r: %s" % (name, reason))
+
+    return rule
+
+
+def flatten(values):
+    for value in values:
+        if isinstance(value, list):
+            yield from flatten(value)
+        else:
+            yield value
+
+
+def object_rule(rules, path, strict=False, required=(), mapped=False):
+    """ Compile a rule for an object, given the rules for its known
+    fields (which may be None for fields that are not checked). For a
+    mapped object field, as opposed to one described by a JSON Schema,
+    an array of objects may be given in place of a single object, and
+    dotted keys address fields of subobjects.
+    """
+    name = path[:-1] or "document"
+    arrays = mapped and bool(path)
+
+    def rule(value, problems):
+        if isinstance(value, list) and arrays:
+            for item in flatten(value):
+                if item is not None:
+                    rule(item, problems)
+            return
+        if not isinstance(value, dict):
+            problems.append("field %r: expected an object, found %s" % (name, describe(value)))
+            return
+        for key, item in value.items():
+            try:
+                field_rule = rules[key]
+            except KeyError:
+                head, dot, tail = key.partition(".")
+                if mapped and dot and head in rules:
+                    if rules[head] is not None:
+                        rules[head]({tail: item}, problems)
+                    continue
+                if strict:
+                    problems.append("field %r: not allowed by the mapping" % (path + key))
+            else:
+                if field_rule is not None and item is not None:
+                    field_rule(item, problems)
+        for key in required:
+            if key not in value:
+                problems.append("field %r: required but missing" % (path + key))
+
+    return rule
+
+
+def schema_rule(schema, path):
+    """ Compile a rule for a value described by a JSON Schema.
+    """
+    name = path[:-1] or "document"
+    types = schema.get("type")
+    if isinstance(types, str):
+        types = [types]
+    for schema_type in types or ():
+        if schema_type not in SCHEMA_TYPES:
+            raise ValueError("Unsupported JSON Schema type %r for field %r" % (schema_type, name))
+    type_checks = [SCHEMA_TYPES[schema_type] for schema_type in types or ()]
+    enum = schema.get("enum")
+    date_format = schema.get("format") in ("date", "date-time")
+    properties = None
+    if "properties" in schema or "required" in schema or schema.get("additionalProperties") is False:
+        properties = object_rule({key: schema_rule(subschema, path + key + ".")
+                                  for key, subschema in schema.get("properties", {}).items()},
+                                 path, strict=schema.get("additionalProperties") is False,
+                                 required=schema.get("required", ()))
+    items = schema_rule(schema["items"], path) if isinstance(schema.get("items"), dict) else None
+
+    def rule(value, problems):
+        if type_checks and not any(type_check(value) for type_check in type_checks):
+            problems.append("field %r: expected %s, found %s" % (name, " or ".join(types), describe(value)))
+            return
+        if enum is not None and value not in enum:
+            problems.append("field %r: %s is not one of the allowed values" % (name, describe(value)))
+        if date_format and isinstance(value, str) and not DATE_PATTERN.match(value):
+            problems.append("field %r: expected date, found %s" % (name, describe(value)))
+        if properties is not None and isinstance(value, dict):
+            properties(value, problems)
+        if items is not None and isinstance(value, list):
+            for item in value:
+                items(item, problems)
+
+    return rule
+
+
+class Validator:
+    """ Description of the checks to make on each document, given as
+    either an index mapping or a JSON Schema (but not both).
+    """
+
+    @classmethod
+    def load(cls, filename):
+        """ Load a validator from a JSON file, which can hold either an
+        index mapping (with or without an enclosing 'mappings' key) or
+        a JSON Schema. JSON Schemas are recognised by a '$schema' key
+        or a top-level 'type' of 'object'.
+        """
+        with open(filename) as f:
+            try:
+                data = load(f)
+            except ValueError as ex:
+                raise ValueError("Failed to parse schema file %r (%s)" % (filename, ex))
+        if not isinstance(data, dict):
+            raise ValueError("Schema file %r must contain a JSON object" % filename)
+        if "$schema" in data or data.get("type") == "object":
+            return cls(schema=data)
+        else:
+            return cls(mapping=data.get("mappings", data))
+
+    def __init__(self, mapping=None, schema=None):
+        if (mapping is None) == (schema is None):
+            raise ValueError("Exactly one of a mapping or a schema must be given")
+        self.mapping = mapping
+        self.schema = schema
+
+    def compile(self):
+        """ Compile the checks into a function, which takes a document
+        and returns a list of messages describing any problems found.
+        Valid documents produce an empty list.
+        """
+        if self.schema is not None:
+            rule = schema_rule(self.schema, "")
+        else:
+            rule = mapping_rule(dict(self.mapping, type="object"), "", strict=False)
+
+        def validate(document):
+            problems = []
+            rule(document, problems)
+            return problems
+
+        return validate
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from collections import namedtuple
+from json import dumps
+from threading import Thread
+
+from pytest import fixture
+
+from escli.commands import CLI
+from escli.mock import serve
+from escli.services import SPI
+
+
+Result = namedtuple("Result", ["status", "out"])
+
+
+@fixture
+def service(monkeypatch, tmp_path):
+    """ A stand-in Elasticsearch service, running in a background
+    thread for the duration of a test. The client is pointed at it
+    through the environment, and the mapping cache is kept within the
+    temporary directory of the test.
+    """
+    server = serve("localhost", 0)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("ESCLI_ADDR", "http://localhost:%d" % server.server_address[1])
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    try:
+        yield server.service
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@fixture
+def requests(service, monkeypatch):
+    """ Record the path of each request handled by the service.
+    """
+    paths = []
+    handle = service.handle
+
+    def record(method, path, params, data):
+        paths.append(path)
+        return handle(method, path, params, data)
+
+    monkeypatch.setattr(service, "handle", record)
+    return paths
+
+
+@fixture
+def escli(service, capsys):
+    """ Run escli with a list of arguments against the stand-in service,
+    returning the exit status and the text written to stdout.
+    """
+
+    def run(*args):
+        spi = SPI()
+        cli = CLI(spi, list(args))
+        spi.init_client()
+        status = cli.process()
+        return Result(status, capsys.readouterr().out)
+
+    return run
+
+
+@fixture
+def index_documents(service):
+    """ Create an index holding the given documents, with ids "1", "2",
+    and so on, and with an optional explicit mapping.
+    """
+
+    def load(name, documents, mappings=None):
+        status, _ = service.handle("PUT", "/" + name, {}, dumps({"mappings": mappings or {}}))
+        assert status == 200
+        lines = []
+        for i, document in enumerate(documents, start=1):
+            lines.append(dumps({"index": {"_id": str(i)}}))
+            lines.append(dumps(document))
+        status, payload = service.handle("POST", "/%s/_bulk" % name, {}, "\n".join(lines) + "\n")
+        assert status == 200 and not payload["errors"], payload
+
+    return load
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from json import loads
+
+from pytest import fixture
+
+
+@fixture
+def sales(index_documents):
+    index_documents("sales", [
+        {"region": "north", "amount": 10, "at": "2021-01-01T10:00:00Z"},
+        {"region": "north", "amount": 30, "at": "2021-01-02T10:00:00Z"},
+        {"region": "south", "amount": 5, "at": "2021-01-01T11:00:00Z"},
+    ])
+
+
+def rows(out):
+    return [loads(line) for line in out.splitlines()]
+
+
+def test_group_by_value_across_pages(escli, sales):
+    result = escli("agg", "sales", "-g", "region", "-m", "sum:amount", "-f", "ndjson", "-n", "1")
+    assert result.status == 0
+    assert rows(result.out) == [
+        {"region": "north", "count": 2, "sum(amount)": 40.0},
+        {"region": "south", "count": 1, "sum(amount)": 5.0},
+    ]
+
+
+def test_stats_metric_is_expanded(escli, sales):
+    result = escli("agg", "sales", "-g", "region", "-m", "stats:amount", "-f", "ndjson")
+    assert rows(result.out)[0] == {"region": "north", "count": 2, "count(amount)": 2, "min(amount)": 10.0,
+                                   "max(amount)": 30.0, "avg(amount)": 20.0, "sum(amount)": 40.0}
+
+
+def test_group_by_date_histogram(escli, sales):
+    result = escli("agg", "sales", "-g", "at:day", "-m", "avg:amount", "-f", "ndjson")
+    assert rows(result.out) == [
+        {"at": "2021-01-01T00:00:00.000Z", "count": 2, "avg(amount)": 7.5},
+        {"at": "2021-01-02T00:00:00.000Z", "count": 1, "avg(amount)": 30.0},
+    ]
+
+
+def test_metrics_without_groups(escli, sales):
+    assert rows(escli("agg", "sales", "-m", "max:amount", "-f", "ndjson").out) == [
+        {"count": 3, "max(amount)": 30.0},
+    ]
+
+
+def test_query_selects_documents(escli, sales):
+    assert rows(escli("agg", "sales", "region=north", "-g", "region", "-f", "ndjson").out) == [
+        {"region": "north", "count": 2},
+    ]
+
+
+def test_unknown_metric_is_an_error(escli, sales):
+    assert escli("agg", "sales", "-m", "median:amount").status == 1
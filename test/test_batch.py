@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from json import loads
+
+from pytest import fixture
+
+
+@fixture
+def people(index_documents):
+    index_documents("people", [{"name": "Alice", "age": 30}, {"name": "Bob", "age": 40},
+                               {"name": "Carol", "age": 50}])
+
+
+def write_batch(tmp_path, lines):
+    filename = tmp_path / "batch.txt"
+    filename.write_text("\n".join(lines) + "\n")
+    return str(filename)
+
+
+def test_consecutive_searches_are_combined(escli, people, requests, tmp_path):
+    filename = write_batch(tmp_path, [
+        "# comment",
+        "search people name==Alice -f ndjson -i name",
+        '["search", "people", "name==Bob", "-f", "ndjson", "-i", "name"]',
+        "agg people -m max:age -f ndjson",
+        "search people name==Carol -f ndjson -i name",
+    ])
+    result = escli("batch", filename)
+    assert result.status == 0
+    assert [loads(line) for line in result.out.splitlines()] == [
+        {"name": "Alice"}, {"name": "Bob"}, {"count": 3, "max(age)": 50.0}, {"name": "Carol"},
+    ]
+    # The first two searches are combined, but the last is sent alone
+    assert requests == ["/_msearch", "/people/_search", "/people/_search"]
+
+
+def test_grouping_can_be_disabled(escli, people, requests, tmp_path):
+    filename = write_batch(tmp_path, ["search people name==Alice -f ndjson"] * 3)
+    assert escli("batch", filename, "-g", "1").status == 0
+    assert not any(path.endswith("/_msearch") for path in requests)
+
+
+def test_concurrent_output_is_in_batch_order(escli, people, tmp_path):
+    filename = write_batch(tmp_path, ["search people name==%s -f ndjson -i name" % name
+                                      for name in ["Carol", "Alice", "Bob"] * 5])
+    result = escli("batch", filename, "-j", "4", "-g", "2")
+    assert result.status == 0
+    assert [loads(line)["name"] for line in result.out.splitlines()] == ["Carol", "Alice", "Bob"] * 5
+
+
+def test_failures_are_reported_by_line(escli, people, tmp_path, caplog):
+    filename = write_batch(tmp_path, [
+        "search people name==Alice -f ndjson -i name",
+        "search missing name==Alice -f ndjson",
+        "frobnicate",
+        "search people name==Bob -f ndjson -i name",
+    ])
+    result = escli("batch", filename)
+    assert result.status == 1
+    assert [loads(line)["name"] for line in result.out.splitlines()] == ["Alice", "Bob"]
+    assert "Search at line 2 failed" in caplog.text
+    assert "Invalid command at line 3" in caplog.text
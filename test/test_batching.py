@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from json import loads
+
+from pytest import raises
+
+from escli.batching import BatchSizeController
+from escli.services import BulkResult
+
+
+def observe(controller, count=None, latency=0.1, rejected=0, size=1000, errors=()):
+    result = BulkResult(errors=errors, latency=latency, size=size, rejected=rejected)
+    return controller.observe(controller.size if count is None else count, result)
+
+
+def test_batch_size_must_be_positive():
+    with raises(ValueError):
+        BatchSizeController(0)
+
+
+def test_size_is_fixed_without_target_latency():
+    controller = BatchSizeController(100)
+    metrics = observe(controller, latency=10.0, rejected=5)
+    assert controller.size == 100
+    assert metrics["decision"] == "fixed" and metrics["reason"] is None
+
+
+def test_size_increases_additively_while_fast():
+    controller = BatchSizeController(100, target_latency=1.0)
+    sizes = []
+    for _ in range(3):
+        metrics = observe(controller, latency=0.5)
+        sizes.append(controller.size)
+    assert sizes == [110, 120, 130]
+    assert metrics["decision"] == "increase" and metrics["reason"] == "fast"
+
+
+def test_size_decreases_in_proportion_when_slow():
+    controller = BatchSizeController(100, target_latency=1.0)
+    metrics = observe(controller, latency=1.25)
+    assert controller.size == 80
+    assert metrics["decision"] == "decrease" and metrics["reason"] == "slow"
+
+
+def test_size_decreases_by_at_most_half_when_slow():
+    controller = BatchSizeController(100, target_latency=1.0)
+    observe(controller, latency=10.0)
+    assert controller.size == 50
+
+
+def test_size_is_halved_on_rejection():
+    controller = BatchSizeController(100, target_latency=1.0)
+    metrics = observe(controller, latency=0.1, rejected=1)
+    assert controller.size == 50
+    assert metrics["reason"] == "rejected" and metrics["rejected"] == 1
+
+
+def test_size_holds_after_partial_batch():
+    controller = BatchSizeController(100, target_latency=1.0)
+    metrics = observe(controller, count=20, latency=0.1)
+    assert controller.size == 100
+    assert metrics["decision"] == "hold" and metrics["reason"] == "partial"
+
+
+def test_size_stays_within_bounds():
+    controller = BatchSizeController(100, target_latency=1.0, min_size=40, max_size=105)
+    observe(controller, latency=0.1)
+    assert controller.size == 105
+    for _ in range(4):
+        observe(controller, rejected=1)
+    assert controller.size == 40
+
+
+def test_size_is_limited_by_bytes():
+    controller = BatchSizeController(100, target_latency=1.0, max_bytes=5000)
+    metrics = observe(controller, latency=0.1, size=10000)
+    assert controller.size == 50
+    assert metrics["reason"] == "bytes"
+
+
+def test_metrics_describe_request():
+    controller = BatchSizeController(100, target_latency=1.0)
+    metrics = observe(controller, latency=0.123456, size=2048, errors=[(3, "bad")])
+    assert metrics == {"batch": 1, "documents": 100, "failed": 1, "rejected": 0, "bytes": 2048,
+                       "took": 0, "latency": 0.1235, "decision": "increase", "reason": "fast",
+                       "batch_size": 110}
+
+
+def test_ingest_writes_metrics(escli, tmp_path):
+    filename = tmp_path / "data.ndjson"
+    filename.write_text("".join('{"n": %d}\n' % i for i in range(25)))
+    metrics = tmp_path / "metrics.ndjson"
+    assert escli("ingest", "data", str(filename), "-f", "ndjson", "-b", "10",
+                 "--target-latency", "60", "--metrics", str(metrics)).status == 0
+    batches = [loads(line) for line in metrics.read_text().splitlines()]
+    assert [batch["documents"] for batch in batches] == [10, 11, 4]
+    assert [batch["decision"] for batch in batches] == ["increase", "increase", "hold"]
+    assert all(batch["failed"] == 0 for batch in batches)
+
+
+def test_ingest_metrics_without_target_latency(escli, tmp_path):
+    filename = tmp_path / "data.ndjson"
+    filename.write_text("".join('{"n": %d}\n' % i for i in range(25)))
+    metrics = tmp_path / "metrics.ndjson"
+    assert escli("ingest", "data", str(filename), "-f", "ndjson", "-b", "10",
+                 "--metrics", str(metrics)).status == 0
+    batches = [loads(line) for line in metrics.read_text().splitlines()]
+    assert [(batch["documents"], batch["batch_size"]) for batch in batches] == [(10, 10), (10, 10), (5, 10)]
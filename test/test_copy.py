@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from json import loads
+from os import environ
+from random import seed
+
+from pytest import fixture
+
+from escli.services import Client
+
+
+@fixture
+def source(index_documents):
+    index_documents("src", [{"n": i, "parity": "odd" if i % 2 else "even"} for i in range(1, 101)])
+
+
+def numbers(escli, index):
+    out = escli("search", index, "--all", "-n", "1000", "-s", "n", "-f", "ndjson").out
+    return [loads(line)["n"] for line in out.splitlines()]
+
+
+def test_copy_all_documents_across_slices(escli, source):
+    assert escli("copy", "src", "dst", "-s", "3", "-w", "2", "-b", "7").status == 0
+    assert numbers(escli, "dst") == list(range(1, 101))
+
+
+def test_copy_selected_documents(escli, source):
+    assert escli("copy", "src", "dst", "parity==even", "-s", "1").status == 0
+    assert numbers(escli, "dst") == list(range(2, 101, 2))
+
+
+def test_copy_with_transform(escli, source, tmp_path, monkeypatch):
+    (tmp_path / "copy_transform.py").write_text(
+        "def run(document):\n"
+        "    if document['n'] > 10:\n"
+        "        return None\n"
+        "    return dict(document, n=document['n'] * 10)\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    assert escli("copy", "src", "dst", "-t", "copy_transform:run").status == 0
+    assert numbers(escli, "dst") == list(range(10, 101, 10))
+
+
+def test_copy_skips_batches_filtered_out_by_transform(escli, source, requests, tmp_path, monkeypatch):
+    (tmp_path / "copy_drop.py").write_text(
+        "def run(document):\n"
+        "    return document if document['n'] <= 5 else None\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    assert escli("copy", "src", "dst", "-t", "copy_drop:run", "-s", "2", "-b", "10").status == 0
+    assert numbers(escli, "dst") == list(range(1, 6))
+    assert sum(1 for path in requests if path.endswith("/_bulk")) <= 2
+
+
+def test_copy_with_source_environment(escli, source, monkeypatch):
+    monkeypatch.setenv("ESCLI_SRC_ADDR", environ["ESCLI_ADDR"])
+    monkeypatch.setenv("ESCLI_ADDR", "http://localhost:1")
+    assert escli("copy", "src", "dst", "--source-env", "ESCLI_SRC", "--target-env", "ESCLI_SRC").status == 0
+    monkeypatch.setenv("ESCLI_ADDR", environ["ESCLI_SRC_ADDR"])
+    assert len(numbers(escli, "dst")) == 100
+
+
+def test_copy_reports_failed_documents(escli, service, source):
+    service.handle("PUT", "/dst", {}, '{"mappings": {"properties": {"parity": {"type": "long"}}}}')
+    result = escli("copy", "src", "dst", "-s", "2")
+    assert result.status == 1
+    assert numbers(escli, "dst") == []
+
+
+def test_rejected_documents_are_retried(escli, service, monkeypatch):
+    monkeypatch.setattr("escli.services.elasticsearch.sleep", lambda seconds: None)
+    seed(1)
+    service.reject_rate = 0.5
+    result = Client.create().bulk("dst", [{"n": i} for i in range(20)], ids=[str(i) for i in range(20)],
+                                  max_retries=20)
+    assert result.rejected > 0
+    assert result.errors == []
+    service.reject_rate = 0.0
+    assert numbers(escli, "dst") == list(range(20))
+
+
+def test_documents_still_rejected_are_reported_at_their_positions(escli, service, monkeypatch):
+    monkeypatch.setattr("escli.services.elasticsearch.sleep", lambda seconds: None)
+    seed(2)
+    service.reject_rate = 0.5
+    result = Client.create().bulk("dst", [{"n": i} for i in range(20)], ids=[str(i) for i in range(20)],
+                                  max_retries=1)
+    service.reject_rate = 0.0
+    ingested = numbers(escli, "dst")
+    assert result.errors
+    assert [position for position, _ in result.errors] == sorted(set(range(20)) - set(ingested))
+    assert all(reason.startswith("es_rejected_execution_exception") for _, reason in result.errors)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from csv import reader
+from io import StringIO
+
+from pytest import fixture
+
+from escli.formatting import TableFormatter, column_formatter, flatten_record, flatten_records
+from escli.mapping import MappingCache, get_field_types
+from escli.records import RecordBatch
+
+
+def test_nested_objects_are_flattened():
+    record = {"name": "Alice", "address": {"city": "Paris", "geo": {"lat": 1.5}}, "empty": {}}
+    assert flatten_record(record) == {"name": "Alice", "address.city": "Paris", "address.geo.lat": 1.5,
+                                      "empty": {}}
+
+
+def test_objects_in_non_object_fields_are_kept_whole():
+    record = {"labels": {"a": 1}, "address": {"city": "Paris"}}
+    assert flatten_record(record, {"labels": "flattened", "address": "object"}) == {
+        "labels": {"a": 1}, "address.city": "Paris"}
+
+
+def test_flattened_records_share_columns():
+    batch = flatten_records([{"a": 1, "b": {"c": 2}}, {"a": 3, "d": 4}])
+    assert batch.columns() == ("a", "b.c", "d")
+    assert list(batch.rows(batch.columns())) == [(1, 2, None), (3, None, 4)]
+
+
+def test_dates_are_formatted_from_epoch_millis():
+    format_value = column_formatter("date")
+    assert format_value(1609459200123) == "2021-01-01T00:00:00.123Z"
+    assert format_value("2021-01-01") == "2021-01-01"
+
+
+def test_booleans_are_formatted_in_lower_case():
+    assert column_formatter("boolean")(True) == "true"
+    assert column_formatter(None)(False) == "false"
+
+
+def test_keywords_are_not_treated_as_numbers():
+    assert column_formatter("keyword")("007") == "007"
+
+
+def test_arrays_of_scalars_are_joined():
+    assert column_formatter("long")([1, None, 3]) == "1, 3"
+    assert column_formatter("boolean")([True, False]) == "true, false"
+
+
+def test_other_values_are_written_as_json():
+    assert column_formatter("keyword")([{"a": 1}]) == '[{"a": 1}]'
+    assert column_formatter(None)({"a": True}) == '{"a": true}'
+    assert column_formatter("long")(None) == ""
+
+
+def test_numeric_columns_are_right_aligned():
+    batch = RecordBatch([{"code": "007", "n": 1, "x": 2.5, "s": "a"}, {"code": "008", "n": 2, "x": None, "s": 1}])
+    formatter = TableFormatter(batch.columns(), {"code": "keyword", "n": "long"}, batch)
+    assert formatter.aligns == ["left", "right", "right", "left"]
+    assert list(formatter.rows(batch)) == [["007", "1", "2.5", "a"], ["008", "2", "", "1"]]
+
+
+class FakeClient:
+
+    def __init__(self, versions, mappings):
+        self.versions = versions
+        self.mappings = mappings
+        self.fetched = []
+
+    def get_mapping_versions(self, target):
+        return self.versions
+
+    def get_mappings(self, target):
+        self.fetched.append(target)
+        return {name: self.mappings[name] for name in target.split(",")}
+
+
+def test_field_types_are_cached_by_uuid_and_version(tmp_path):
+    cache = MappingCache(str(tmp_path))
+    client = FakeClient({"a": ("u1", 1), "b": ("u2", 3)}, {
+        "a": {"properties": {"n": {"type": "long"}, "o": {"properties": {"d": {"type": "date"}}}}},
+        "b": {"properties": {"n": {"type": "keyword"}, "t": {"type": "text"}}},
+    })
+    types = get_field_types(client, "a,b", cache)
+    assert types == {"o": "object", "o.d": "date", "t": "text"}
+    assert client.fetched == ["a,b"]
+    assert get_field_types(client, "a,b", cache) == types
+    assert client.fetched == ["a,b"]
+    client.versions = {"a": ("u1", 2), "b": ("u2", 3)}
+    get_field_types(client, "a,b", cache)
+    assert client.fetched == ["a,b", "a"]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["u1-2.json", "u2-3.json"]
+
+
+def test_field_types_are_empty_if_mappings_are_unavailable(tmp_path):
+
+    class FailingClient:
+
+        def get_mapping_versions(self, target):
+            raise PermissionError("no")
+
+    assert get_field_types(FailingClient(), "a", MappingCache(str(tmp_path))) == {}
+
+
+@fixture
+def events(index_documents):
+    index_documents("events", [
+        {"code": "007", "at": 1609459200000, "ok": True, "tags": ["a", "b"], "where": {"city": "Paris"}},
+        {"code": "010", "at": "2021-06-01T12:00:00Z", "ok": False, "tags": [], "where": {"city": "Oslo"}},
+    ], mappings={"properties": {"code": {"type": "keyword"}, "at": {"type": "date"},
+                                "ok": {"type": "boolean"}, "tags": {"type": "keyword"}}})
+
+
+def test_csv_output_uses_mapping_types(escli, events):
+    out = escli("search", "events", "-f", "csv", "-s", "code").out
+    assert list(reader(StringIO(out))) == [
+        ["code", "at", "ok", "tags", "where.city"],
+        ["007", "2021-01-01T00:00:00.000Z", "true", "a, b", "Paris"],
+        ["010", "2021-06-01T12:00:00Z", "false", "", "Oslo"],
+    ]
+
+
+def test_table_output_keeps_keywords_as_stored(escli, events):
+    lines = escli("search", "events", "-f", "plain", "-s", "code", "-i", "code,ok").out.splitlines()
+    assert [line.split() for line in lines] == [["code", "ok"], ["007", "true"], ["010", "false"]]
+
+
+def test_mappings_are_fetched_once_per_version(escli, events, requests):
+    escli("search", "events", "-f", "csv")
+    escli("search", "events", "-f", "csv")
+    assert sum(1 for path in requests if path.endswith("/_mapping")) == 1
+    escli("search", "events", "-f", "ndjson")
+    assert sum(1 for path in requests if path.endswith("/_mapping")) == 1
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from json import dumps, loads
+
+import elasticsearch
+from elasticsearch import NotFoundError
+from pytest import raises
+
+from escli.services import Client
+from escli.services.hits import SearchResponse
+
+
+HITS = [
+    {"_index": "people", "_id": "1", "_score": None, "_source": {"name": "Alice", "tags": ["a", "b"]},
+     "sort": [1, 0]},
+    {"_index": "people", "_id": "2", "_score": None, "_source": {"name": "Zoë \"Z\"", "n": {"x": []}},
+     "sort": [2, 1]},
+    {"_index": "people", "_id": "3", "_score": None, "sort": [3, 2]},
+]
+
+
+def response(pit_first=False, indent=None):
+    body = {"took": 1, "timed_out": False, "_shards": {"total": 1},
+            "hits": {"total": {"value": 3, "relation": "eq"}, "max_score": None, "hits": HITS}}
+    if pit_first:
+        body = dict({"pit_id": "abc"}, **body)
+    else:
+        body["pit_id"] = "abc"
+    return dumps(body, indent=indent, ensure_ascii=False).encode("utf-8")
+
+
+def test_hits_are_decoded_in_order():
+    assert list(SearchResponse(response()).hits()) == HITS
+
+
+def test_pretty_printed_response():
+    assert list(SearchResponse(response(indent=2)).hits()) == HITS
+
+
+def test_members_after_hits_are_available_once_read():
+    res = SearchResponse(response())
+    assert res.get("pit_id") == "abc"
+    assert res.get("took") == 1
+    assert res.get("missing", 0) == 0
+
+
+def test_members_before_hits():
+    res = SearchResponse(response(pit_first=True))
+    assert list(res.hits()) == HITS
+    assert res.get("pit_id") == "abc"
+
+
+def test_hits_are_read_lazily():
+    data = response()
+    truncated = data[:data.index(b'"_id": "2"')]
+    hits = SearchResponse(truncated).hits()
+    assert next(hits) == HITS[0]
+    with raises(ValueError):
+        next(hits)
+
+
+def test_empty_hits():
+    data = b'{"took": 0, "hits": {"total": {"value": 0}, "hits": [ ]}, "pit_id": "x"}'
+    res = SearchResponse(data)
+    assert list(res.hits()) == []
+    assert res.get("pit_id") == "x"
+
+
+def test_response_without_hits():
+    res = SearchResponse(b'{"took": 0}')
+    assert list(res.hits()) == []
+    assert res.get("took") == 0
+
+
+def test_hits_can_only_be_read_once():
+    res = SearchResponse(response())
+    list(res.hits())
+    with raises(ValueError):
+        list(res.hits())
+
+
+def test_invalid_response():
+    with raises(ValueError):
+        list(SearchResponse(b'{"hits": {"hits": [{}, }}').hits())
+
+
+def test_raw_and_decoded_output_match(escli, index_documents):
+    index_documents("people", [hit.get("_source", {}) for hit in HITS])
+    out = escli("search", "people", "-f", "ndjson", "-s", "_doc").out
+    assert [loads(line) for line in out.splitlines()] == [hit.get("_source", {}) for hit in HITS]
+    out = escli("search", "people", "-f", "ndjson", "-s", "_doc", "--all", "-n", "2").out
+    assert [loads(line) for line in out.splitlines()] == [hit.get("_source", {}) for hit in HITS]
+
+
+def test_raw_search_uses_the_same_client(service, index_documents, monkeypatch):
+    created = []
+
+    class Elasticsearch(elasticsearch.Elasticsearch):
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            created.append(self)
+
+    monkeypatch.setattr("escli.services.elasticsearch.Elasticsearch", Elasticsearch)
+    index_documents("people", [hit.get("_source", {}) for hit in HITS])
+    client = Client.create()
+    assert list(client.search("people", None, sort="_doc", raw=True)) == [hit.get("_source", {}) for hit in HITS]
+    assert client.info()["name"] == "escli-mock"
+    with raises(NotFoundError) as raw_error:
+        client.search("missing", None, raw=True)
+    with raises(NotFoundError) as error:
+        client.search("missing", None)
+    assert str(raw_error.value) == str(error.value)
+    assert len(created) == 1
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from json import loads
+
+from pytest import raises
+
+from escli.commands.ingest import plan_tasks, read_task
+from escli.io import ndjson_shard
+
+
+def write_lines(filename, count, width=10):
+    with open(filename, "w") as f:
+        for i in range(1, count + 1):
+            f.write('{"n": %d, "pad": "%s"}\n' % (i, "x" * width))
+    return str(filename)
+
+
+def test_files_are_loaded_whole_if_there_are_enough(tmp_path):
+    files = [write_lines(tmp_path / ("%d.ndjson" % i), 100) for i in range(3)]
+    assert plan_tasks(files, "ndjson", 3, min_shard_bytes=1) == [(f, None) for f in files]
+
+
+def test_files_are_split_in_proportion_to_size(tmp_path):
+    big = write_lines(tmp_path / "big.ndjson", 300)
+    small = write_lines(tmp_path / "small.ndjson", 100)
+    assert plan_tasks([big, small], "ndjson", 4, min_shard_bytes=1) == [
+        (big, (0, 3)), (big, (1, 3)), (big, (2, 3)), (small, None)]
+
+
+def test_small_files_are_not_split(tmp_path):
+    filename = write_lines(tmp_path / "small.ndjson", 100)
+    assert plan_tasks([filename], "ndjson", 4) == [(filename, None)]
+
+
+def test_only_ndjson_files_are_split(tmp_path):
+    filename = str(tmp_path / "data.csv")
+    with open(filename, "w") as f:
+        f.write("n\n" + "1\n" * 1000)
+    assert plan_tasks([filename], "csv", 4, min_shard_bytes=1) == [(filename, None)]
+
+
+def test_standard_input_cannot_be_planned():
+    with raises(ValueError):
+        plan_tasks(["-"], "ndjson", 2)
+
+
+def test_shards_cover_every_line_once(tmp_path):
+    filename = write_lines(tmp_path / "data.ndjson", 101)
+    line_numbers = []
+    for index in range(4):
+        for document, _, line_no in read_task(filename, "ndjson", (index, 4)):
+            assert document["n"] == line_no
+            line_numbers.append(line_no)
+    assert line_numbers == list(range(1, 102))
+    assert not (tmp_path / ".data.ndjson.idx").exists()
+
+
+def test_shards_start_at_line_boundaries(tmp_path):
+    filename = tmp_path / "data.ndjson"
+    lines = [b'{"n": %d, "pad": "%s"}' % (i, b"x" * (i * 7 % 50)) for i in range(1, 41)]
+    filename.write_bytes(b"\n".join(lines[:20]) + b"\n\n" + b"\n".join(lines[20:]))
+    data = filename.read_bytes()
+    shards = [ndjson_shard(str(filename), index, 6, chunk_size=16) for index in range(6)]
+    assert shards[0][:1] == (0,) and shards[-1][1] == len(data)
+    for (start, stop, line_no), (next_start, _, _) in zip(shards, shards[1:] + [(len(data), None, None)]):
+        assert stop == next_start
+        assert start == 0 or data[start - 1:start] == b"\n"
+        assert line_no == data.count(b"\n", 0, start) + 1
+
+
+def test_empty_file_has_empty_shards(tmp_path):
+    filename = tmp_path / "empty.ndjson"
+    filename.write_bytes(b"")
+    assert ndjson_shard(str(filename), 1, 2) == (0, 0, 1)
+
+
+def test_parallel_load_of_single_large_file(escli, service, tmp_path):
+    filename = write_lines(tmp_path / "big.ndjson", 3000, width=1000)
+    assert escli("ingest", "big", filename, "-f", "ndjson", "-j", "3", "--save-index").status == 0
+    assert sorted(document["n"] for _, _, document in service.storage.scan("big")) == list(range(1, 3001))
+    # Shards are located by byte offset, so no line index is built.
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["big.ndjson"]
+
+
+def test_resume_from_line(escli, tmp_path):
+    filename = write_lines(tmp_path / "data.ndjson", 10)
+    assert escli("ingest", "data", filename, "-f", "ndjson", "--start-line", "8").status == 0
+    out = escli("search", "data", "-f", "ndjson", "-s", "n", "-i", "n").out
+    assert [loads(line) for line in out.splitlines()] == [{"n": 8}, {"n": 9}, {"n": 10}]
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from json import loads
+
+from pytest import fixture
+
+from escli.io import expand_files, input_extensions, iter_csv, iter_json, iter_ndjson, LineIndexedFile
+
+
+@fixture
+def data(tmp_path):
+    directory = tmp_path / "data"
+    (directory / "sub").mkdir(parents=True)
+    (directory / "a.ndjson").write_text('{"n": 1}\n')
+    (directory / "a.ndjson.idx").write_bytes(b"ESCLIIDX\xff\xff")
+    (directory / ".hidden.ndjson").write_text('{"n": 0}\n')
+    (directory / "notes.txt").write_text("hello\n")
+    (directory / "sub" / "b.jsonl").write_text('{"n": 2}\n')
+    return directory
+
+
+def test_expand_directory(data):
+    assert expand_files([str(data)]) == [str(data / "a.ndjson"), str(data / "notes.txt"),
+                                         str(data / "sub" / "b.jsonl")]
+
+
+def test_expand_directory_by_format(data):
+    assert expand_files([str(data)], input_extensions["ndjson"]) == [str(data / "a.ndjson"),
+                                                                     str(data / "sub" / "b.jsonl")]
+    assert expand_files([str(data)], input_extensions["csv"]) == [str(data / "notes.txt")]
+
+
+def test_expand_glob_skips_index_files(data):
+    assert expand_files([str(data / "a.*")]) == [str(data / "a.ndjson")]
+
+
+def test_expand_keeps_unmatched_names(data):
+    assert expand_files(["-", str(data / "*.csv")]) == ["-", str(data / "*.csv")]
+
+
+def test_ndjson_decode_error_is_reported_by_line(tmp_path):
+    filename = str(tmp_path / "bad.ndjson")
+    with open(filename, "wb") as f:
+        f.write(b'{"n": 1}\n{"s": "\xff"}\n\n{"n": 2}\n')
+    errors = []
+    documents = list(iter_ndjson([filename], errors))
+    assert documents == [({"n": 1}, filename, 1), ({"n": 2}, filename, 4)]
+    [(error_filename, line_no, reason)] = errors
+    assert (error_filename, line_no) == (filename, 2)
+    assert reason.startswith("invalid UTF-8")
+
+
+def test_ndjson_lines_are_only_decoded_as_utf8(tmp_path):
+    filename = str(tmp_path / "utf16.ndjson")
+    with open(filename, "wb") as f:
+        f.write('{"n": 1}\n'.encode("utf-8") + '{"n": 2}'.encode("utf-16"))
+    errors = []
+    assert list(iter_ndjson([filename], errors)) == [({"n": 1}, filename, 1)]
+    assert [(line_no, reason.split(":")[0]) for _, line_no, reason in errors] == [(2, "invalid UTF-8")]
+
+
+def test_json_decode_error_is_reported_by_line(tmp_path):
+    good, bad = str(tmp_path / "good.json"), str(tmp_path / "bad.json")
+    with open(good, "w") as f:
+        f.write('{"n": 1}')
+    with open(bad, "wb") as f:
+        f.write(b'{\n  "s": "\xff"\n}\n')
+    errors = []
+    assert list(iter_json([bad, good], errors)) == [({"n": 1}, good)]
+    assert [error[:2] for error in errors] == [(bad, 2)]
+
+
+def test_csv_decode_error_is_reported_by_line(tmp_path):
+    filename = str(tmp_path / "bad.csv")
+    with open(filename, "wb") as f:
+        f.write(b"a,b\n1,2\n\xff,3\n4,\n")
+    errors = []
+    documents = list(iter_csv([filename], "excel", errors))
+    assert documents == [({"a": "1", "b": "2"}, filename, 2), ({"a": "4", "b": ""}, filename, 4)]
+    assert [error[:2] for error in errors] == [(filename, 3)]
+
+
+def test_reingest_directory_with_saved_indexes(escli, service, tmp_path):
+    directory = tmp_path / "data"
+    directory.mkdir()
+    (directory / "a.ndjson").write_text("".join('{"n": %d}\n' % i for i in range(50)))
+    (directory / "b.ndjson").write_text("".join('{"n": %d}\n' % i for i in range(50, 60)))
+    (directory / "README.txt").write_text("not data\n")
+    for _ in range(2):
+        result = escli("ingest", "numbers", str(directory), "-f", "ndjson", "-j", "2", "--save-index")
+        assert result.status == 0
+    assert len(list(service.storage.scan("numbers"))) == 120
+
+
+def test_ingest_continues_past_undecodable_line(escli, service, tmp_path, caplog):
+    filename = tmp_path / "bad.ndjson"
+    filename.write_bytes(b'{"n": 1}\n{"s": "\xff"}\n{"n": 2}\n')
+    assert escli("ingest", "numbers", str(filename), "-f", "ndjson").status == 0
+    assert "line 2" in caplog.text
+    out = escli("search", "numbers", "-f", "ndjson", "-s", "n").out
+    assert [loads(line) for line in out.splitlines()] == [{"n": 1}, {"n": 2}]
+
+
+def test_line_indexed_file(tmp_path):
+    filename = str(tmp_path / "lines.ndjson")
+    with open(filename, "w") as f:
+        f.write('{"n": 1}\n{"n": 2}\n\n{"n": 4}')
+    with LineIndexedFile(filename) as indexed_file:
+        assert len(indexed_file) == 4
+        assert bytes(indexed_file.line(3)) == b'{"n": 4}'
+        assert indexed_file.byte_range(1, 3) == (9, 19)
+        assert [line_no for _, _, line_no in indexed_file.iter_documents()] == [1, 2, 4]
+
+
+def test_saved_line_index_is_hidden_and_reused(tmp_path):
+    filename = tmp_path / "lines.ndjson"
+    filename.write_text('{"n": 1}\n{"n": 2}\n')
+    with LineIndexedFile(str(filename), save_index=True) as indexed_file:
+        assert indexed_file.index_filename == str(tmp_path / ".lines.ndjson.idx")
+    assert sorted(p.name for p in tmp_path.iterdir()) == [".lines.ndjson.idx", "lines.ndjson"]
+    with LineIndexedFile(str(filename)) as indexed_file:
+        assert indexed_file._load_index() is not None
+    filename.write_text('{"n": 1}\n{"n": 2}\n{"n": 3}\n')
+    with LineIndexedFile(str(filename)) as indexed_file:
+        assert len(indexed_file) == 3
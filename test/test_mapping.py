@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from json import loads
+
+from pytest import raises
+
+from escli.commands.ingest import bulk_load_settings
+from escli.mapping import infer_field_type, infer_mapping
+from escli.services import Client
+
+
+def test_json_types_are_inferred():
+    mapping = infer_mapping([{"n": 1, "x": 1.5, "b": True, "d": "2021-01-01", "k": "abc", "t": "a b"}])
+    assert mapping == {"properties": {
+        "n": {"type": "long"},
+        "x": {"type": "double"},
+        "b": {"type": "boolean"},
+        "d": {"type": "date"},
+        "k": {"type": "keyword"},
+        "t": {"type": "text", "fields": {"keyword": {"type": "keyword", "ignore_above": 256}}},
+    }}
+
+
+def test_numbers_widen_to_double():
+    mapping = infer_mapping([{"n": 1}, {"n": 2.5}])
+    assert mapping["properties"]["n"] == {"type": "double"}
+
+
+def test_json_strings_are_not_typed_as_numbers():
+    assert infer_field_type("42") == "keyword"
+    assert infer_field_type("4.2") == "keyword"
+
+
+def test_csv_strings_are_typed_as_numbers():
+    assert infer_field_type("42", numeric_strings=True) == "long"
+    assert infer_field_type("-4.2e3", numeric_strings=True) == "double"
+    assert infer_field_type("0.5", numeric_strings=True) == "double"
+    assert infer_field_type("0", numeric_strings=True) == "long"
+
+
+def test_csv_strings_that_are_not_plain_numbers_are_kept_as_strings():
+    for value in ["02134", "1_000", "NaN", "nan", "inf", "-Infinity", "+5", "1e", ".5"]:
+        assert infer_field_type(value, numeric_strings=True) == "keyword", value
+
+
+def test_integers_out_of_long_range_are_kept_as_strings():
+    assert infer_field_type("9" * 20, numeric_strings=True) == "keyword"
+
+
+def test_empty_strings_and_non_finite_numbers_are_ignored():
+    assert infer_field_type("") is None
+    assert infer_field_type(float("nan")) is None
+    mapping = infer_mapping([{"n": "1"}, {"n": ""}, {"n": "3"}], numeric_strings=True)
+    assert mapping["properties"]["n"] == {"type": "long"}
+
+
+def test_objects_in_arrays_with_nulls():
+    mapping = infer_mapping([{"a": [None, {"x": 1}]}, {"a": [{"y": "z"}, None]}])
+    assert mapping == {"properties": {"a": {"properties": {"x": {"type": "long"},
+                                                           "y": {"type": "keyword"}}}}}
+
+
+def test_ingest_create_infers_csv_mapping(escli, service, tmp_path):
+    data = tmp_path / "people.csv"
+    data.write_text("name,zip,age,born\n"
+                    "Alice,02134,30,1991-04-01\n"
+                    "Bob,10001,,\n"
+                    "Carol,90210,41,1980-12-25\n")
+    assert escli("ingest", "people", str(data), "-f", "csv", "--create").status == 0
+    properties = service.indexes["people"].mappings["properties"]
+    assert properties["zip"] == {"type": "keyword"}
+    assert properties["age"] == {"type": "long"}
+    assert properties["born"] == {"type": "date"}
+    out = escli("search", "people", "-f", "ndjson", "-s", "name").out
+    assert [loads(line) for line in out.splitlines()] == [
+        {"name": "Alice", "zip": "02134", "age": "30", "born": "1991-04-01"},
+        {"name": "Bob", "zip": "10001"},
+        {"name": "Carol", "zip": "90210", "age": "41", "born": "1980-12-25"},
+    ]
+
+
+def test_ingest_create_skips_empty_csv_cells_in_parallel(escli, service, tmp_path):
+    for name, rows in [("a.csv", "Alice,1991-04-01\nBob,\n"), ("b.csv", "Carol,\nDave,1980-12-25\n")]:
+        (tmp_path / name).write_text("name,born\n" + rows)
+    assert escli("ingest", "people", str(tmp_path / "a.csv"), str(tmp_path / "b.csv"),
+                 "-f", "csv", "--create", "--sample-size", "2", "-j", "2").status == 0
+    assert service.indexes["people"].mappings["properties"]["born"] == {"type": "date"}
+    out = escli("search", "people", "-f", "ndjson", "-s", "name").out
+    assert [loads(line) for line in out.splitlines()] == [
+        {"name": "Alice", "born": "1991-04-01"},
+        {"name": "Bob"},
+        {"name": "Carol"},
+        {"name": "Dave", "born": "1980-12-25"},
+    ]
+
+
+def test_ingest_keeps_empty_csv_cells_without_create(escli, service, tmp_path):
+    data = tmp_path / "people.csv"
+    data.write_text("name,age\nAlice,30\nBob,\n")
+    assert escli("ingest", "people", str(data), "-f", "csv").status == 0
+    out = escli("search", "people", "-f", "ndjson", "-s", "name").out
+    assert [loads(line) for line in out.splitlines()] == [
+        {"name": "Alice", "age": "30"},
+        {"name": "Bob", "age": ""},
+    ]
+
+
+def test_ingest_create_keeps_json_strings_as_strings(escli, service, tmp_path):
+    data = tmp_path / "codes.ndjson"
+    data.write_text('{"code": "007"}\n{"code": "42"}\n')
+    assert escli("ingest", "codes", str(data), "-f", "ndjson", "--create").status == 0
+    assert service.indexes["codes"].mappings["properties"]["code"] == {"type": "keyword"}
+
+
+def index_settings(service, name):
+    status, payload = service.handle("GET", "/%s/_settings" % name, {"flat_settings": "true"}, None)
+    assert status == 200
+    return payload[name]["settings"]
+
+
+def test_ingest_create_applies_bulk_load_settings(escli, service, requests, tmp_path, monkeypatch):
+    during = []
+    bulk = service.bulk
+
+    def record(default_index, data):
+        during.append(dict(service.indexes["people"].settings))
+        return bulk(default_index, data)
+
+    monkeypatch.setattr(service, "bulk", record)
+    data = tmp_path / "people.ndjson"
+    data.write_text('{"name": "Alice"}\n{"name": "Bob"}\n')
+    assert escli("ingest", "people", str(data), "-f", "ndjson", "--create").status == 0
+    assert during
+    assert requests[-3:] == ["/people/_settings", "/people/_forcemerge", "/people/_refresh"]
+    for settings in during:
+        assert settings["index.refresh_interval"] == "-1"
+        assert settings["index.number_of_replicas"] == "0"
+    settings = index_settings(service, "people")
+    assert "index.refresh_interval" not in settings
+    assert settings["index.number_of_replicas"] == "1"
+
+
+def test_bulk_load_settings_are_restored_on_error(service, requests):
+    service.handle("PUT", "/people", {}, None)
+    with raises(RuntimeError):
+        with bulk_load_settings(Client.create(), "people"):
+            assert index_settings(service, "people")["index.refresh_interval"] == "-1"
+            raise RuntimeError("load failed")
+    assert requests[-3:] == ["/people/_settings", "/people/_forcemerge", "/people/_refresh"]
+    settings = index_settings(service, "people")
+    assert "index.refresh_interval" not in settings
+    assert settings["index.number_of_replicas"] == "1"
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from contextlib import contextmanager
+from json import dumps, loads
+from threading import Event, Thread
+from time import monotonic
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from pytest import fixture, mark
+
+from escli.mock import MemoryStorage, MockElasticsearch, ReadWriteLock, SQLiteStorage, \
+    check_value, serve, sql_condition, values_equal
+
+
+DOCUMENTS = [
+    {"name": "Alice Smith", "code": "007", "n": 7, "tag": "red"},
+    {"name": "Bob Jones", "code": "7", "n": 3, "tag": "blue"},
+    {"name": "Carol Smith", "code": "x-1", "n": 5, "tag": "red", "active": True},
+    {"name": "Dave", "code": "true", "n": 1, "tag": ["green", "red"]},
+    {"name": "Élodie", "code": "O'Hara", "n": 9, "tag": "blue"},
+]
+
+
+def load(service, name="people", documents=DOCUMENTS):
+    lines = []
+    for i, document in enumerate(documents, start=1):
+        lines.append(dumps({"index": {"_id": str(i)}}))
+        lines.append(dumps(document))
+    status, payload = service.handle("POST", "/%s/_bulk" % name, {}, "\n".join(lines) + "\n")
+    assert status == 200 and not payload["errors"]
+
+
+def search(service, body, name="people"):
+    status, payload = service.handle("POST", "/%s/_search" % name, {}, dumps(body))
+    assert status == 200, payload
+    return payload
+
+
+def ids(payload):
+    return [hit["_id"] for hit in payload["hits"]["hits"]]
+
+
+@contextmanager
+def running(**settings):
+    """ Run a stand-in service over HTTP for the duration of the block,
+    yielding a function that sends a request and returns its status and
+    decoded payload.
+    """
+    server = serve("localhost", 0, **settings)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def send(method, path, data=None):
+        request = Request("http://localhost:%d%s" % (server.server_address[1], path), method=method,
+                          data=data and data.encode("utf-8"), headers={"Content-Type": "application/json"})
+        try:
+            with urlopen(request) as response:
+                return response.status, loads(response.read())
+        except HTTPError as error:
+            return error.code, loads(error.read())
+
+    try:
+        yield send
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@fixture(params=["memory", "sqlite"])
+def service(request, tmp_path):
+    if request.param == "memory":
+        storage = MemoryStorage()
+    else:
+        storage = SQLiteStorage(str(tmp_path / "mock.db"))
+    service = MockElasticsearch(storage=storage)
+    load(service)
+    return service
+
+
+@mark.parametrize("query, expected", [
+    ({"term": {"code": "7"}}, ["2"]),
+    ({"term": {"code": "007"}}, ["1"]),
+    ({"term": {"n": "7"}}, ["1"]),
+    ({"term": {"active": "true"}}, ["3"]),
+    ({"term": {"tag": "red"}}, ["1", "3", "4"]),
+    ({"match": {"name": "smith"}}, ["1", "3"]),
+    ({"match": {"name": "élodie"}}, ["5"]),
+    ({"match": {"code": "7"}}, ["2"]),
+    ({"prefix": {"code": "O'H"}}, ["5"]),
+    ({"prefix": {"name": "car"}}, []),
+    ({"prefix": {"name": "Car"}}, ["3"]),
+    ({"ids": {"values": ["2", "4", "9"]}}, ["2", "4"]),
+    ({"bool": {"filter": [{"term": {"tag": "red"}}], "must_not": [{"match": {"name": "smith"}}]}}, ["4"]),
+    ({"bool": {"should": [{"term": {"tag": "blue"}}, {"range": {"n": {"gt": 6}}}]}}, ["1", "2", "5"]),
+    ({"bool": {"must": [{"match": {"name": "smith"}}],
+               "should": [{"term": {"tag": "blue"}}]}}, ["1", "3"]),
+])
+def test_search_results_are_the_same_for_each_storage(service, query, expected):
+    assert ids(search(service, {"query": query})) == expected
+
+
+@mark.parametrize("query", [
+    {"term": {"n": "7"}},
+    {"term": {"active": "True"}},
+    {"match": {"name": "élodie"}},
+    {"prefix": {"name": "C*"}},
+    {"range": {"n": {"gt": 1}}},
+])
+def test_queries_that_cannot_be_translated_to_sql(query):
+    assert sql_condition(query) is None
+
+
+def test_optional_should_clauses_are_not_translated_to_sql():
+    query = {"bool": {"filter": [{"term": {"tag": "red"}}], "should": [{"term": {"tag": "blue"}}]}}
+    assert sql_condition(query) == ("(instr(source, ?))", ['"red"'])
+
+
+def test_sql_condition_for_bool_query():
+    query = {"bool": {"filter": [{"term": {"tag": "red"}}, {"range": {"n": {"gt": 1}}}],
+                      "should": [{"ids": {"values": ["1"]}}, {"term": {"tag": "blue"}}],
+                      "minimum_should_match": 1}}
+    assert sql_condition(query) == ('(instr(source, ?)) AND ((id IN (?)) OR (instr(source, ?)))',
+                                    ['"red"', "1", '"blue"'])
+
+
+def test_empty_bulk_request_is_rejected(service):
+    status, payload = service.handle("POST", "/people/_bulk", {}, "\n")
+    assert status == 400
+    assert payload["error"]["type"] == "action_request_validation_exception"
+
+
+def test_bulk_items_are_rejected_at_full_reject_rate():
+    with running(reject_rate=1.0) as send:
+        assert send("PUT", "/people")[0] == 200
+        status, payload = send("POST", "/people/_bulk", '{"index": {}}\n{"n": 1}\n{"create": {}}\n{"n": 2}\n')
+        assert status == 200 and payload["errors"]
+        assert [item[op]["status"] for item in payload["items"] for op in item] == [429, 429]
+        assert send("GET", "/people/_count")[1]["count"] == 0
+
+
+def test_search_is_rejected_at_full_reject_rate():
+    with running(reject_rate=1.0) as send:
+        assert send("PUT", "/people")[0] == 200
+        status, payload = send("POST", "/people/_search", "{}")
+        assert status == 429
+        assert payload["error"]["type"] == "es_rejected_execution_exception"
+
+
+def test_latency_is_added_to_each_request():
+    with running(latency=0.2) as send:
+        t0 = monotonic()
+        assert send("GET", "/")[0] == 200
+        assert send("GET", "/")[0] == 200
+        assert monotonic() - t0 >= 0.4
+
+
+def test_search_after_pages_through_sorted_results(service):
+    body = {"sort": [{"n": "desc"}], "size": 2}
+    pages = []
+    payload = search(service, body)
+    while payload["hits"]["hits"]:
+        pages.append(ids(payload))
+        assert payload["hits"]["total"]["value"] == 5
+        payload = search(service, dict(body, search_after=payload["hits"]["hits"][-1]["sort"]))
+    assert pages == [["5", "1"], ["3", "2"], ["4"]]
+
+
+def test_search_after_requires_a_sort(service):
+    status, payload = service.handle("POST", "/people/_search", {}, dumps({"search_after": [1]}))
+    assert status == 400
+
+
+def test_cached_results_are_discarded_after_a_write(service):
+    body = {"query": {"term": {"tag": "red"}}, "sort": ["n"]}
+    assert ids(search(service, body)) == ["4", "3", "1"]
+    service.handle("PUT", "/people/_doc/6", {}, dumps({"name": "Eve", "n": 0, "tag": "red"}))
+    assert ids(search(service, body)) == ["6", "4", "3", "1"]
+
+
+def test_point_in_time_does_not_see_later_writes(service):
+    _, pit = service.handle("POST", "/people/_pit", {"keep_alive": "1m"}, "")
+    service.handle("PUT", "/people/_doc/6", {}, dumps({"name": "Eve", "n": 0, "tag": "red"}))
+    payload = search(service, {"pit": {"id": pit["id"]}, "sort": ["n"], "size": 10}, name="")
+    assert ids(payload) == ["4", "2", "3", "1", "5"]
+    assert ids(search(service, {"sort": ["n"], "size": 10})) == ["6", "4", "2", "3", "1", "5"]
+
+
+def test_count_uses_query(service):
+    status, payload = service.handle("POST", "/people/_count", {}, dumps({"query": {"match": {"name": "smith"}}}))
+    assert status == 200 and payload["count"] == 2
+
+
+def test_scroll_pages_through_results(service):
+    status, payload = service.handle("POST", "/people/_search", {"scroll": "1m"}, dumps({"sort": ["n"], "size": 2}))
+    pages = [ids(payload)]
+    while payload["hits"]["hits"]:
+        _, payload = service.handle("POST", "/_search/scroll", {}, dumps({"scroll_id": payload["_scroll_id"]}))
+        pages.append(ids(payload))
+    assert pages == [["4", "2"], ["3", "1"], ["5"], []]
+
+
+def test_strings_are_compared_exactly():
+    assert not values_equal("007", "7")
+    assert values_equal("7", 7)
+    assert values_equal(7.0, "7")
+    assert values_equal("true", True)
+
+
+def test_empty_string_is_accepted_for_numeric_fields():
+    assert check_value("long", "")
+    assert check_value("double", "")
+    assert not check_value("long", "x")
+    assert not check_value("date", "")
+
+
+def test_readers_share_the_lock():
+    lock = ReadWriteLock()
+    entered = Event()
+
+    def read():
+        with lock.reading():
+            entered.set()
+
+    with lock.reading():
+        thread = Thread(target=read)
+        thread.start()
+        assert entered.wait(5)
+    thread.join()
+
+
+def test_writer_excludes_readers():
+    lock = ReadWriteLock()
+    entered = Event()
+
+    def read():
+        with lock.reading():
+            entered.set()
+
+    with lock.writing():
+        thread = Thread(target=read)
+        thread.start()
+        assert not entered.wait(0.1)
+    assert entered.wait(5)
+    thread.join()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from json import loads
+
+from pytest import mark, raises
+
+from escli.query import compile_query
+
+
+def test_empty_query_matches_all():
+    assert compile_query(None) == {"match_all": {}}
+    assert compile_query("  ") == {"match_all": {}}
+
+
+def test_full_text_match_is_scoring():
+    assert compile_query("name=hello world") == {"match": {"name": "hello world"}}
+
+
+def test_filters_are_not_scoring():
+    assert compile_query("status==closed") == {"bool": {"filter": [{"term": {"status": "closed"}}]}}
+    assert compile_query("status!=closed") == {"bool": {"must_not": [{"term": {"status": "closed"}}]}}
+
+
+@mark.parametrize("expression, query", [
+    ("code==007", {"term": {"code": "007"}}),
+    ("code!=1_000", {"bool": {"must_not": [{"term": {"code": "1_000"}}]}}),
+    ("name~Nan*", {"prefix": {"name": "Nan"}}),
+])
+def test_values_are_kept_as_strings(expression, query):
+    assert compile_query(expression) in (query, {"bool": {"filter": [query]}})
+
+
+@mark.parametrize("expression", ["name=Nan", "name=infinity", "code=007"])
+def test_match_values_are_kept_as_strings(expression):
+    field, _, value = expression.partition("=")
+    assert compile_query(expression) == {"match": {field: value}}
+
+
+@mark.parametrize("expression, bound", [
+    ("price>=10", 10),
+    ("price<2.5", 2.5),
+    ("price>-1e3", -1000.0),
+    ("price>007", "007"),
+    ("price<nan", "nan"),
+    ("price<inf", "inf"),
+    ("price<1e999", "1e999"),
+    ("at>2021-01-01", "2021-01-01"),
+])
+def test_range_bounds(expression, bound):
+    (query,) = compile_query(expression)["bool"]["filter"]
+    (bounds,) = query["range"].values()
+    (value,) = bounds.values()
+    assert value == bound and type(value) is type(bound)
+
+
+@mark.parametrize("expression, field, value", [
+    ("actor=O'Brien", "actor", "O'Brien"),
+    ("url=http://x/?a=b", "url", "http://x/?a=b"),
+    ("title=Smith (Jr)", "title", "Smith (Jr)"),
+    ("formula=a<b", "formula", "a<b"),
+])
+def test_single_match_takes_everything_after_first_equals(expression, field, value):
+    assert compile_query(expression) == {"match": {field: value}}
+
+
+def test_compound_query():
+    assert compile_query('country=France AND price>=100 AND NOT (status==closed OR name~"t?p*")') == {
+        "bool": {
+            "must": [{"match": {"country": "France"}}],
+            "filter": [{"range": {"price": {"gte": 100}}}],
+            "must_not": [{"bool": {"should": [{"term": {"status": "closed"}},
+                                              {"wildcard": {"name": {"value": "t?p*"}}}],
+                                   "minimum_should_match": 1}}],
+        }
+    }
+
+
+def test_invalid_compound_query_is_an_error():
+    with raises(ValueError):
+        compile_query("a=1 AND (b==2")
+
+
+def test_search_with_expressions(escli, index_documents):
+    index_documents("people", [
+        {"name": "Alice O'Brien", "code": "007", "age": 30},
+        {"name": "Bob", "code": "8", "age": 40},
+    ])
+
+    def names(expression):
+        out = escli("search", "people", expression, "-f", "ndjson", "-s", "name").out
+        return [loads(line)["name"] for line in out.splitlines()]
+
+    assert names("code==007") == ["Alice O'Brien"]
+    assert names("name=O'Brien") == ["Alice O'Brien"]
+    assert names("age>35") == ["Bob"]
+    assert names("age<35 OR code==8") == ["Alice O'Brien", "Bob"]
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from pytest import raises
+
+from escli.records import Record, RecordBatch
+
+
+def test_record_is_a_read_only_mapping():
+    record = Record(("a", "b"), (1, 2))
+    assert record["b"] == 2
+    assert dict(record) == {"a": 1, "b": 2}
+    assert record.to_dict() == {"a": 1, "b": 2}
+    assert len(record) == 2
+    with raises(KeyError):
+        _ = record["c"]
+
+
+def test_key_tuples_are_shared():
+    batch = RecordBatch([{"a": 1, "b": 2}, {"a": 3, "b": 4}, {"a": 5}])
+    assert len(batch) == 3
+    assert batch[0].keys() is batch[1].keys()
+    assert batch[2].keys() == ("a",)
+
+
+def test_columns_are_in_order_of_first_appearance():
+    batch = RecordBatch([{"b": 1}, {"a": 2, "b": 3}, {"c": 4}])
+    assert batch.columns() == ("b", "a", "c")
+
+
+def test_rows_are_aligned_to_columns():
+    batch = RecordBatch([{"b": 1}, {"a": 2, "b": 3}, {"c": 4}])
+    assert list(batch.rows()) == [(1, None, None), (3, 2, None), (None, None, 4)]
+    assert list(batch.rows(["c", "b"])) == [(None, 1), (None, 3), (4, None)]
+
+
+def test_search_table_aligns_differing_fields(escli, index_documents):
+    index_documents("people", [{"name": "Alice", "age": 30}, {"name": "Bob", "email": "bob@example.com"}])
+    result = escli("search", "people", "-s", "name", "-f", "csv")
+    assert result.out.splitlines() == ["name,age,email", "Alice,30,", "Bob,,bob@example.com"]
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from json import loads
+
+from pytest import fixture, mark
+
+
+@fixture
+def numbers(index_documents):
+    index_documents("numbers", [{"n": i} for i in range(1, 51)])
+
+
+def values(out, field="n"):
+    return [loads(line)[field] for line in out.splitlines()]
+
+
+@mark.parametrize("prefetch", ["0", "2"])
+@mark.parametrize("fmt", ["ndjson", "csv"])
+def test_consecutive_pages_by_offset(escli, numbers, requests, prefetch, fmt):
+    result = escli("search", "numbers", "-s", "n", "-n", "7", "-p", "2", "--pages", "3",
+                   "--prefetch", prefetch, "-f", fmt)
+    assert result.status == 0
+    expected = list(range(8, 29))
+    if fmt == "ndjson":
+        assert values(result.out) == expected
+    else:
+        assert result.out.split() == ["n"] + [str(n) for n in expected]
+    assert "/_pit" not in " ".join(requests)
+
+
+@mark.parametrize("prefetch", ["0", "3"])
+def test_all_pages_by_cursor(escli, numbers, requests, prefetch):
+    result = escli("search", "numbers", "-s", "~n", "-n", "7", "--all", "--prefetch", prefetch, "-f", "ndjson")
+    assert result.status == 0
+    assert values(result.out) == list(range(50, 0, -1))
+    assert requests.count("/numbers/_pit") == 1
+    assert requests.count("/_pit") == 1
+
+
+def test_all_pages_from_page_number(escli, numbers):
+    result = escli("search", "numbers", "-s", "n", "-n", "10", "-p", "4", "--all", "-f", "ndjson")
+    assert values(result.out) == list(range(31, 51))
+
+
+def test_pages_stop_at_end_of_results(escli, numbers):
+    result = escli("search", "numbers", "-s", "n", "-n", "20", "--pages", "5", "-f", "ndjson")
+    assert values(result.out) == list(range(1, 51))
+
+
+def test_all_pages_as_table(escli, numbers):
+    result = escli("search", "numbers", "n<4", "-s", "n", "-n", "2", "--all", "-f", "plain")
+    assert result.out.split() == ["n", "1", "2", "3"]
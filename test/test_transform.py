@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from json import loads
+from math import isnan
+
+from pytest import raises
+
+from escli.transform import Transform
+
+
+def apply(document, **kwargs):
+    return Transform.parse(**kwargs).compile()(document)
+
+
+def test_empty_transform_is_false():
+    assert not Transform.parse()
+    assert Transform.parse(include="a")
+
+
+def test_include_and_exclude():
+    assert apply({"a": 1, "b": 2, "c": 3}, include="a,c,d") == {"a": 1, "c": 3}
+    assert apply({"a": 1, "b": 2, "c": 3}, exclude="b") == {"a": 1, "c": 3}
+    with raises(ValueError):
+        Transform.parse(include="a", exclude="b")
+
+
+def test_rename_then_cast():
+    assert apply({"a": "12", "b": None}, rename=["a:x"], cast=["x:int", "b:int"]) == {"x": 12, "b": None}
+
+
+def test_casts():
+    document = {"i": "7", "f": "1.5", "b": "yes", "s": 7, "a1": "007", "a2": "2.5", "a3": "x"}
+    assert apply(document, cast=["i:int", "f:float", "b:bool", "s:str", "a1:auto", "a2:auto", "a3:auto"]) == {
+        "i": 7, "f": 1.5, "b": True, "s": "7", "a1": 7, "a2": 2.5, "a3": "x"}
+    with raises(ValueError):
+        Transform.parse(cast=["x:decimal"])
+
+
+def test_constants_are_strings():
+    assert apply({}, constants=["code=007", "v=nan", "e=", "url=http://x/?a=b"]) == {
+        "code": "007", "v": "nan", "e": "", "url": "http://x/?a=b"}
+
+
+def test_constants_are_cast_if_requested():
+    document = apply({"code": "1"}, constants=["code=007", "v=nan"], cast=["code:int", "v:float"])
+    assert document["code"] == 7 and isnan(document["v"])
+    with raises(ValueError):
+        Transform.parse(constants=["n=abc"], cast=["n:int"]).compile()
+
+
+def test_timestamps():
+    document = {"iso": "2021-01-02T03:04:05Z", "s": 0, "ms": "1500", "custom": "02/01/2021"}
+    assert apply(document, timestamps=["iso", "s:epoch_second", "ms:epoch_millis", "custom:%d/%m/%Y"]) == {
+        "iso": "2021-01-02T03:04:05+00:00",
+        "s": "1970-01-01T00:00:00+00:00",
+        "ms": "1970-01-01T00:00:01.500000+00:00",
+        "custom": "2021-01-02T00:00:00",
+    }
+
+
+def test_ingest_with_transform(escli, tmp_path, caplog):
+    filename = tmp_path / "data.ndjson"
+    filename.write_text('{"id": "1", "code": "A", "debug": true}\n{"id": "x", "code": "B"}\n')
+    result = escli("ingest", "data", str(filename), "-f", "ndjson", "-x", "debug", "--cast", "id:int",
+                   "--set", "zip=02134", "--rename", "code:kind")
+    assert result.status == 0
+    assert "line 2" in caplog.text
+    out = escli("search", "data", "-f", "ndjson").out
+    assert [loads(line) for line in out.splitlines()] == [{"id": 1, "kind": "A", "zip": "02134"}]
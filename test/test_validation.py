@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2021 Nigel Small
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from json import dumps
+from logging import INFO
+
+from pytest import mark, raises
+
+from escli.commands.ingest import ErrorCounter, validate_documents
+from escli.validation import Validator, date_check, to_number
+
+
+MAPPING = {"properties": {
+    "n": {"type": "long"},
+    "b": {"type": "byte"},
+    "x": {"type": "double"},
+    "ok": {"type": "boolean"},
+    "at": {"type": "date"},
+    "day": {"type": "date", "format": "dd/MM/yyyy"},
+    "ip": {"type": "ip"},
+    "name": {"type": "keyword"},
+    "address": {"properties": {"city": {"type": "keyword"}, "zip": {"type": "integer"}}},
+    "strict": {"dynamic": "strict", "properties": {"a": {"type": "long"}}},
+}}
+
+
+def problems(document, mapping=MAPPING):
+    return Validator(mapping=mapping).compile()(document)
+
+
+@mark.parametrize("value", ["2021", "2021-01", "2021-01-01", "2021-01-01T10", "2021-01-01T10:30",
+                            "2021-01-01T10:30:15", "2021-01-01T10:30:15.123456789Z",
+                            "2021-01-01T10:30+01:00", "2021-01-01T10:30:15-0500", "1609459200000",
+                            "-1", "1609459200000.5", 1609459200000, 1.5])
+def test_dates_in_default_format_are_accepted(value):
+    assert date_check(value) is None
+
+
+@mark.parametrize("value", ["2021-1-1", "2021-13-01", "2021-02-30", "2021-01-01 10:00", "2021-01-01T25",
+                            "01/01/2021", "21-01-01", "2021-01-01T", "", "now", True, float("nan")])
+def test_dates_not_in_default_format_are_rejected(value):
+    assert date_check(value) is not None
+
+
+@mark.parametrize("value, number", [("42", 42.0), ("-4.2e3", -4200.0), ("+5", 5.0), ("007", 7.0),
+                                    (".5", 0.5), ("1.", 1.0), ("", None), (3, 3), (10 ** 30, 10 ** 30)])
+def test_numbers_are_coerced_from_strings(value, number):
+    assert to_number(value) == number
+
+
+@mark.parametrize("value", ["1_000", "nan", "NaN", "inf", "-Infinity", " 5", "1d", "0x10", "1e", True,
+                            float("inf"), [1], {}])
+def test_values_that_are_not_numbers_are_rejected(value):
+    with raises(ValueError):
+        to_number(value)
+
+
+def test_valid_document():
+    assert problems({"n": "42", "b": -128, "x": "", "ok": "true", "at": "2021-01", "day": "anything",
+                     "ip": "::1", "name": 7, "address": {"city": "Paris"}, "other": {"a": 1}}) == []
+
+
+def test_invalid_values_are_reported():
+    assert problems({"n": "1_000", "b": 128, "ok": "yes", "at": "yesterday", "ip": "1.2.3",
+                     "name": {"a": 1}}) == [
+        "field 'n': expected long, found \"1_000\"",
+        "field 'b': value 128 is out of range for byte",
+        "field 'ok': expected boolean, found \"yes\"",
+        "field 'at': expected date, found \"yesterday\"",
+        "field 'ip': expected ip, found \"1.2.3\"",
+        "field 'name': expected a concrete value, found an object",
+    ]
+
+
+def test_arrays_and_nulls():
+    assert problems({"n": [1, None, [2, "x"]], "at": None}) == ["field 'n': expected long, found \"x\""]
+
+
+def test_objects_arrays_and_dotted_keys():
+    assert problems({"address": [{"zip": "1"}, {"zip": "z"}], "address.zip": "y"}) == [
+        "field 'address.zip': expected integer, found \"z\"",
+        "field 'address.zip': expected integer, found \"y\"",
+    ]
+    assert problems({"address": "Paris"}) == ["field 'address': expected an object, found \"Paris\""]
+
+
+def test_strict_objects_reject_unknown_fields():
+    assert problems({"strict": {"a": 1, "b": 2}}) == ["field 'strict.b': not allowed by the mapping"]
+
+
+def test_json_schema():
+    schema = {"type": "object", "required": ["id"], "additionalProperties": False,
+              "properties": {"id": {"type": "integer"}, "tags": {"type": "array", "items": {"type": "string"}},
+                             "level": {"enum": ["low", "high"]}, "at": {"type": "string", "format": "date"}}}
+    validate = Validator(schema=schema).compile()
+    assert validate({"id": 1, "tags": ["a"], "level": "low", "at": "2021-01-01"}) == []
+    assert validate({"tags": ["a", 2], "level": "mid", "at": "soon", "x": 1}) == [
+        "field 'tags': expected string, found 2",
+        "field 'level': \"mid\" is not one of the allowed values",
+        "field 'at': expected date, found \"soon\"",
+        "field 'x': not allowed by the mapping",
+        "field 'id': required but missing",
+    ]
+
+
+def test_unsupported_schema_type():
+    with raises(ValueError):
+        Validator(schema={"type": "object", "properties": {"a": {"type": "date"}}}).compile()
+
+
+def test_exactly_one_of_mapping_or_schema():
+    with raises(ValueError):
+        Validator()
+    with raises(ValueError):
+        Validator(mapping={}, schema={})
+
+
+def test_validator_is_loaded_from_file(tmp_path):
+    filename = tmp_path / "mapping.json"
+    filename.write_text(dumps({"mappings": {"properties": {"n": {"type": "long"}}}}))
+    assert Validator.load(str(filename)).mapping == {"properties": {"n": {"type": "long"}}}
+    filename.write_text(dumps({"type": "object"}))
+    assert Validator.load(str(filename)).schema == {"type": "object"}
+    filename.write_text("[]")
+    with raises(ValueError):
+        Validator.load(str(filename))
+
+
+def test_invalid_documents_are_logged_as_they_are_found():
+    logged = []
+    errors = ErrorCounter(lambda *error: logged.append(error))
+    validate = Validator(mapping=MAPPING).compile()
+
+    def documents():
+        yield {"n": "x"}, "a.ndjson", 1
+        assert logged == [("a.ndjson", 1, "field 'n': expected long, found \"x\"")]
+        yield {"n": 1}, "a.ndjson", 2
+        yield {"n": "y"}, "a.ndjson", 3
+
+    assert validate_documents(documents(), validate, errors) == 1
+    assert len(errors) == 2
+
+
+def write_documents(filename, documents):
+    filename.write_text("".join(dumps(document) + "\n" for document in documents))
+    return str(filename)
+
+
+def test_validate_command_reports_each_invalid_line(escli, tmp_path, caplog):
+    schema = tmp_path / "schema.json"
+    schema.write_text(dumps({"properties": {"n": {"type": "long"}}}))
+    filename = tmp_path / "data.ndjson"
+    filename.write_text('{"n": 1}\n{"n": "x"}\nnot json\n{"n": ""}\n')
+    with caplog.at_level(INFO):
+        result = escli("ingest", "data", str(filename), "-f", "ndjson", "--validate", "--schema", str(schema))
+    assert result.status == 1
+    messages = [record.getMessage() for record in caplog.records]
+    assert [message for message in messages if message.startswith("Invalid")] == [
+        "Invalid document in file %r, line 2 (field 'n': expected long, found \"x\")" % str(filename),
+        "Invalid document in file %r, line 3 (invalid JSON: Expecting value: line 1 column 1 (char 0))"
+        % str(filename),
+    ]
+    assert messages[-1] == "Validated 4 documents (2 invalid)"
+
+
+def test_validate_command_in_parallel(escli, tmp_path, caplog):
+    schema = tmp_path / "schema.json"
+    schema.write_text(dumps({"properties": {"n": {"type": "long"}}}))
+    files = [write_documents(tmp_path / ("%d.ndjson" % i), [{"n": i}, {"n": "x"}]) for i in range(3)]
+    with caplog.at_level(INFO):
+        result = escli("ingest", "data", *files, "-f", "ndjson", "--validate", "--schema", str(schema), "-j", "2")
+    assert result.status == 1
+    assert caplog.records[-1].getMessage() == "Validated 6 documents (3 invalid)"
+
+
+@mark.parametrize("fmt, data", [
+    ("csv", b"n\n1\n\xff\n2\n"),
+    ("ndjson", b'{"n": 1}\n{"n": "\xff"}\n{"n": 2}\n'),
+], ids=["csv", "ndjson"])
+def test_sample_errors_are_only_reported_by_workers(escli, tmp_path, caplog, fmt, data):
+    filename = tmp_path / ("data." + fmt)
+    filename.write_bytes(data)
+    with caplog.at_level(INFO):
+        result = escli("ingest", "data", str(filename), "-f", fmt, "--validate", "--create", "-j", "2")
+    assert result.status == 1
+    messages = [record.getMessage() for record in caplog.records]
+    assert not [message for message in messages if message.startswith(("Invalid", "Failed"))]
+    assert messages[-1] == "Validated 3 documents (1 invalid)"
+